@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+"""
+端到端基准: 用合成的采集器跑 thread_main / process_main / asyncio_main, 统计吞吐、延迟和资源占用
+
+    python benchmarks/bench_e2e.py --mode thread --duration 10
+    python benchmarks/bench_e2e.py --mode process --workers 2 --check
+    python benchmarks/bench_e2e.py --mode asyncio --rate 0 --update-baseline
+
+合成采集器的每一行的值是生成时刻的时间戳, CaptureSink 收到后计算端到端延迟;
+吞吐是 [预热结束, 结束] 之间收到的行数, 延迟只统计这段时间里生成的行.
+--repeat 次运行取中位数, 和 baseline.json 里同一个场景比较:
+
+- 限速的场景(--rate 大于 0)吞吐等于采集器的输出速度, 只比较延迟, p99 上升超过
+  --latency-tolerance 时返回 1
+- 不限速的场景(--rate 0)采集器一直输出, 吞吐就是 octopus 能处理的速度, 延迟由
+  排队决定, 只比较吞吐, 下降超过 --tolerance 时返回 1
+
+baseline.json 里每种模式各有一个不限速的吞吐基准和一个默认速率的延迟基准
+"""
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from octopus.comm.telemetry import Histogram  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+LATENCY_FLOOR = 0.005  # p99 延迟的比较忽略 5ms 以内的抖动
+
+COLLECTOR = '''#!%(python)s
+import os
+import sys
+import time
+
+RATE = %(rate)d  # 每秒行数, 0 表示尽可能快
+BURST = %(burst)r  # 大于 0 时每隔这么多秒集中输出一次
+CARDINALITY = %(cardinality)d
+PAD = "x" * %(pad)d
+
+ppid = os.getppid()
+out = sys.stdout
+if BURST > 0:
+    tick = BURST
+elif RATE:
+    tick = max(0.01, 1.0 / RATE)  # 最多每 10ms 醒一次
+else:
+    tick = 0
+per_tick = max(1, round(RATE * tick)) if RATE else 100
+i = 0
+next_tick = time.time()
+while os.getppid() == ppid:  # octopus 退出后自己退出
+    buf = []
+    for _ in range(per_tick):
+        buf.append("bench.%(name)s %%d %%.6f series=%%d pad=%%s\\n" %% (time.time(), time.time(), i %% CARDINALITY, PAD))
+        i += 1
+    out.write("".join(buf))
+    out.flush()
+    if RATE:
+        next_tick += tick
+        delay = next_tick - time.time()
+        if delay > 0:
+            time.sleep(delay)
+'''
+
+
+class CaptureSink:
+    """
+    capture sink
+
+    基准测试用的发送中间件: 统计窗口内生成的行数和端到端延迟, 定期把结果写到
+    BENCH_CAPTURE_DIR/<pid>.json, 多个发送进程各写各的
+    """
+
+    def __init__(self):
+        self.directory = os.environ["BENCH_CAPTURE_DIR"]
+        self.start = float(os.environ["BENCH_WINDOW_START"])
+        self.end = float(os.environ["BENCH_WINDOW_END"])
+        self.latency = Histogram("latency")
+        self.count = 0  # 窗口内生成的行
+        self.received = 0  # 窗口内收到的行
+        self.last_dump = 0
+
+    def send_batch(self, lines, collectors=None):
+        now = time.time()
+        in_window = self.start <= now <= self.end
+        for line in lines:
+            parts = line.split(" ", 3)
+            if len(parts) < 3 or not parts[0].startswith("bench."):
+                continue
+            if in_window:
+                self.received += 1
+            created = float(parts[2])
+            if self.start <= created <= self.end:
+                self.count += 1
+                self.latency.record(now - created)
+        if now - self.last_dump >= 0.2:
+            self.last_dump = now
+            self.dump()
+
+    def send(self, line, collector=None):
+        self.send_batch([line], [collector])
+
+    def dump(self):
+        path = os.path.join(self.directory, "%d.json" % os.getpid())
+        with open(path + ".tmp", "w") as f:
+            json.dump({"count": self.count, "received": self.received, "buckets": self.latency.buckets,
+                       "max": self.latency.max, "sum": self.latency.sum}, f)
+        os.replace(path + ".tmp", path)
+
+
+def child_main(args):
+    """在子进程里修改配置后运行 octopus.py 的 thread_main / process_main / asyncio_main"""
+    import octopus.settings as settings
+
+    settings.BASE_DIR = args.base_dir
+    settings.SEND_MIDDLEWARES = {"bench_e2e.CaptureSink": 1}
+    settings.TELEMETRY_HTTP_ADDRESS = None
+    settings.TELEMETRY_UNIX_SOCKET = None
+    settings.TELEMETRY_DIR = os.path.join(args.base_dir, "telemetry")
+    settings.SPOOL_DIR = os.path.join(args.base_dir, "spool")
+    if args.workers:
+        settings.PROCESS_READER_WORKERS = args.workers
+
+    # 根目录的 octopus.py 与 octopus 包同名, 按路径载入
+    spec = importlib.util.spec_from_file_location("octopus_main", os.path.join(ROOT, "octopus.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, "%s_main" % args.child)([])
+
+
+def write_collectors(base_dir, args):
+    directory = os.path.join(base_dir, "collectors", "0")
+    os.makedirs(directory)
+    pad = max(0, args.line_size - len("bench.c000 1600000000 1600000000.000000 series=0 pad="))
+    for n in range(args.collectors):
+        name = "c%03d" % n
+        path = os.path.join(directory, name + ".py")
+        with open(path, "w") as f:
+            f.write(COLLECTOR % {"python": sys.executable, "rate": args.rate, "burst": args.burst,
+                                 "cardinality": args.cardinality, "pad": pad, "name": name})
+        os.chmod(path, 0o755)
+    return directory
+
+
+def process_tree(root_pid, exclude):
+    """root_pid 及其所有子孙进程, 排除命令行里包含 exclude 的(采集器)"""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        parents.setdefault(ppid, []).append(int(entry))
+    pids = []
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        try:
+            with open("/proc/%d/cmdline" % pid, "rb") as f:
+                cmdline = f.read()
+        except OSError:
+            continue
+        if exclude.encode() in cmdline:
+            continue
+        pids.append(pid)
+        stack.extend(parents.get(pid, ()))
+    return pids
+
+
+def sample_resources(pids):
+    """
+    :return: (CPU 秒数, RSS 字节)
+    """
+    ticks = os.sysconf("SC_CLK_TCK")
+    page = os.sysconf("SC_PAGE_SIZE")
+    cpu = 0.0
+    rss = 0
+    for pid in pids:
+        try:
+            with open("/proc/%d/stat" % pid) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+        rss += int(fields[21]) * page
+    return cpu, rss
+
+
+def run(args):
+    base_dir = tempfile.mkdtemp(prefix="octopus-bench-")
+    capture_dir = os.path.join(base_dir, "capture")
+    os.makedirs(capture_dir)
+    collector_dir = write_collectors(base_dir, args)
+
+    launch = time.time()
+    window_start = launch + args.warmup
+    window_end = window_start + args.duration
+    env = dict(os.environ, BENCH_CAPTURE_DIR=capture_dir, BENCH_WINDOW_START=repr(window_start),
+               BENCH_WINDOW_END=repr(window_end), PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", args.mode, "--base-dir", base_dir]
+    if args.workers:
+        cmd += ["--workers", str(args.workers)]
+    proc = subprocess.Popen(cmd, env=env, start_new_session=True,
+                            stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    try:
+        time.sleep(max(0.0, window_start - time.time()))
+        cpu_start, _ = sample_resources(process_tree(proc.pid, collector_dir))
+        rss_max = 0
+        while time.time() < window_end:
+            time.sleep(min(0.5, max(0.0, window_end - time.time())))
+            _, rss = sample_resources(process_tree(proc.pid, collector_dir))
+            rss_max = max(rss_max, rss)
+        cpu_end, _ = sample_resources(process_tree(proc.pid, collector_dir))
+        time.sleep(args.grace)  # 等待窗口内生成的数据发送完
+        if proc.poll() is not None:
+            raise RuntimeError("octopus exited with status %d" % proc.returncode)
+    finally:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+    latency = Histogram("latency")
+    received = 0
+    for file_name in os.listdir(capture_dir):
+        if not file_name.endswith(".json"):
+            continue
+        with open(os.path.join(capture_dir, file_name)) as f:
+            captured = json.load(f)
+        received += captured["received"]
+        for index, n in captured["buckets"].items():
+            latency.buckets[int(index)] = latency.buckets.get(int(index), 0) + n
+        latency.count += captured["count"]
+        latency.sum += captured["sum"]
+        latency.max = max(latency.max, captured["max"])
+    shutil.rmtree(base_dir, ignore_errors=True)
+
+    return {
+        "lines_per_sec": received / args.duration,
+        "p50_ms": latency.quantile(0.5) * 1000,
+        "p99_ms": latency.quantile(0.99) * 1000,
+        "cpu_percent": (cpu_end - cpu_start) / args.duration * 100,
+        "rss_mb": rss_max / 1024 / 1024,
+    }
+
+
+def scenario_name(args):
+    return "%s-w%d-c%d-r%d-s%d-k%d-b%g" % (args.mode, args.workers or 0, args.collectors, args.rate,
+                                           args.line_size, args.cardinality, args.burst)
+
+
+def check(name, result, baseline, tolerance, latency_tolerance, capped):
+    """
+    :param capped: 采集器限速时吞吐由速率决定, 只比较延迟; 否则只比较吞吐
+    :return: list of regression messages
+    """
+    base = baseline.get(name)
+    if base is None:
+        return []
+    problems = []
+    if not capped:
+        if result["lines_per_sec"] < base["lines_per_sec"] * (1 - tolerance):
+            problems.append("throughput %.0f lines/s is below baseline %.0f"
+                            % (result["lines_per_sec"], base["lines_per_sec"]))
+        return problems
+    limit = max(base["p99_ms"] * (1 + latency_tolerance), base["p99_ms"] + LATENCY_FLOOR * 1000)
+    if result["p99_ms"] > limit:
+        problems.append("p99 latency %.1fms is above baseline %.1fms" % (result["p99_ms"], base["p99_ms"]))
+    return problems
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("thread", "process", "asyncio"), default="thread")
+    parser.add_argument("--workers", type=int, default=0, help="process 模式的阅读进程数, 0 使用配置")
+    parser.add_argument("--collectors", type=int, default=20)
+    parser.add_argument("--rate", type=int, default=2000, help="每个采集器每秒的行数, 0 表示不限速")
+    parser.add_argument("--line-size", type=int, default=100, help="每行的字节数")
+    parser.add_argument("--cardinality", type=int, default=100, help="每个采集器的序列数")
+    parser.add_argument("--burst", type=float, default=0, help="大于 0 时每隔这么多秒集中输出")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--grace", type=float, default=2)
+    parser.add_argument("--repeat", type=int, default=1, help="运行次数, 结果取中位数")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="不限速时吞吐允许下降的比例")
+    parser.add_argument("--latency-tolerance", type=float, default=1.0, help="限速时 p99 延迟允许上升的比例")
+    parser.add_argument("--check", action="store_true", help="和 baseline.json 比较, 退化时返回 1")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="显示 octopus 的日志")
+    parser.add_argument("--child", choices=("thread", "process", "asyncio"), help=argparse.SUPPRESS)
+    parser.add_argument("--base-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+
+    if args.child:
+        return child_main(args)
+
+    name = scenario_name(args)
+    results = [run(args) for _ in range(max(1, args.repeat))]
+    result = {k: statistics.median(r[k] for r in results) for k in results[0]}
+    print("%s: %.0f lines/s, p50 %.1fms, p99 %.1fms, cpu %.0f%%, rss %.0fMB"
+          % (name, result["lines_per_sec"], result["p50_ms"], result["p99_ms"],
+             result["cpu_percent"], result["rss_mb"]))
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    if args.update_baseline:
+        baseline[name] = {k: round(v, 2) for k, v in result.items()}
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("baseline updated: %s" % BASELINE)
+    elif args.check:
+        if name not in baseline:
+            print("no baseline for %s, run with --update-baseline first" % name)
+            return 1
+        problems = check(name, result, baseline, args.tolerance, args.latency_tolerance, args.rate > 0)
+        for problem in problems:
+            print("REGRESSION: %s" % problem)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
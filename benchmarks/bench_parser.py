@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+"""
+行协议解析的微基准: python benchmarks/bench_parser.py [行数]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from octopus.comm.datapoint import parse_lines  # noqa: E402
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 1000000
+    lines = ["sys.cpu.user %d %d.5 host=web%02d cpu=%d" % (1600000000 + i, i % 100, i % 50, i % 8)
+             for i in range(count)]
+
+    start = time.perf_counter()
+    points, invalid = parse_lines(lines, "octopus.")
+    elapsed = time.perf_counter() - start
+    print("parsed %d lines (%d invalid) in %.3fs: %.0f lines/s"
+          % (len(points), len(invalid), elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
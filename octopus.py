@@ -1,16 +1,24 @@
 #!/usr/bin/env python
+import asyncio
 import logging
-import multiprocessing
 import os
+import socket
 import sys
-import time
 
+from octopus.aio.aio_runtime import AsyncRuntime, install_child_watcher
 from octopus.comm.children_collector import ChildrenCollector
+from octopus.comm.collector_selector import CollectorSelector, ShardedChannel
+from octopus.comm.fork_server import ForkServer
+from octopus.comm.telemetry import Publisher, TelemetryServer
+from octopus.comm.upgrade import UPGRADE_ENV, Upgrade, adopt
 from octopus.process.process_queue import ProcessQueue
 from octopus.process.process_read import ReadProcess
 from octopus.process.process_sender import SenderProcess
+from octopus.process.shm_registry import ShmRegistry
 from octopus.thread.thread_queue import ThreadQueue
-from octopus.settings import BASE_DIR
+from octopus.settings import (BASE_DIR, FORK_SERVER_ENABLED, FORK_SERVER_PRELOAD,
+                              PROCESS_READER_WORKERS, TELEMETRY_DIR, TELEMETRY_HTTP_ADDRESS,
+                              TELEMETRY_PUBLISH_INTERVAL, TELEMETRY_UNIX_SOCKET, UPGRADE_DRAIN_TIMEOUT)
 from octopus.thread.thread_read import ReadThread
 from octopus.thread.thread_sender import SenderThread
 
@@ -26,62 +34,116 @@ def write_pid(pid_file):
         f.close()
 
 
+def start_fork_server():
+    """fork-server 需要在创建其他线程/进程之前启动"""
+    if not FORK_SERVER_ENABLED:
+        return None
+    fork_server = ForkServer(FORK_SERVER_PRELOAD)
+    fork_server.start()
+    return fork_server
+
+
+def start_telemetry(directory=None, worker=None):
+    """本地的指标接口, 进程模式下同时汇总 directory 里其他进程的快照"""
+    server = TelemetryServer(TELEMETRY_HTTP_ADDRESS, TELEMETRY_UNIX_SOCKET, directory,
+                             3 * TELEMETRY_PUBLISH_INTERVAL, worker=worker)
+    try:
+        return server.start()
+    except OSError as e:
+        LOG.error('can not start telemetry server: %s', e)
+        return None
+
+
 def thread_main(argv):
+    fork_server = start_fork_server()
+
+    __col_dict: dict = {}
+    selector = CollectorSelector()  # 监听所有采集器的输出
+    cc = ChildrenCollector(collection_dict=__col_dict, selector=selector, fork_server=fork_server)
+    upgrade_from = os.environ.pop(UPGRADE_ENV, None)
+    if upgrade_from:
+        # 升级启动的新进程: 接管旧进程的采集器, 旧进程退出之后才开始读取和发送
+        adopt(cc, upgrade_from)
     # 写入进程ID
     write_pid("{}/octopus.pid".format(BASE_DIR))
 
-    __col_dict: dict = {}
     thread_queue = ThreadQueue()
-    thread_list = [
-        ReadThread(thread_queue, __col_dict),
-        SenderThread(thread_queue)
-    ]
+    reader = ReadThread(thread_queue, __col_dict, selector, daemon=True)
+    cc.rate_limits = reader.rate_limits
+    sender = SenderThread(thread_queue, daemon=True)
+    thread_list = [reader, sender]
 
     # 启动阅读线程与发送线程
     for p in thread_list:
         p.start()
+    telemetry = start_telemetry()
+    upgrade = Upgrade(cc, selector)
 
     # 扫描采集器
-    def scan_collection():
-        cc = ChildrenCollector(collection_dict=__col_dict)
-        while True:
-            cc.populate_collectors("{}/collectors".format(BASE_DIR))  # 载入采集器
-            cc.reap_children()  # 维护子采集器
-            cc.check_children()  # 检测子采集器
-            cc.spawn_children()  # 执行收集器
-            time.sleep(1)  # 1S扫描一次采集器
-
-    scan_collection()
-
-    for p in thread_list:
-        p.join()
+    while True:
+        cc.populate_collectors("{}/collectors".format(BASE_DIR))  # 载入采集器
+        cc.populate_plugins("{}/plugins".format(BASE_DIR))  # 载入进程内的插件
+        cc.reap_children()  # 维护子采集器
+        cc.check_children()  # 检测子采集器
+        cc.spawn_children()  # 执行收集器
+        cc.wait(1)  # 等到下一个调度事件, 最多 1S
+        if upgrade.requested:
+            if telemetry is not None:
+                telemetry.stop()  # 新进程需要监听同一个地址
+            conn = upgrade.hand_off()
+            if conn is not None:
+                break
+            telemetry = start_telemetry()
+
+    # 采集器已经交给新进程, 发送完队列里剩余的数据后退出
+    if not sender.drain(UPGRADE_DRAIN_TIMEOUT):
+        LOG.warning('%d items were not delivered within %ds after the hand-over',
+                    thread_queue.qsize(), UPGRADE_DRAIN_TIMEOUT)
+    conn.close()
+    return 0
 
 
 def process_main(argv):
     # 写入进程ID
     write_pid("{}/octopus.pid".format(BASE_DIR))
-
-    process_queue = ProcessQueue()  # 进程间通信的队列
-    collection_dict = multiprocessing.Manager().dict()  # 采集器字典
-
-    process_list = [
-        ReadProcess(process_queue, collection_dict),
-        SenderProcess(process_queue)
-    ]
+    fork_server = start_fork_server()
+
+    collection_dict: dict = {}  # 采集器字典, 只在监控进程内维护
+    registry = ShmRegistry()  # 采集器状态的只读快照, 工作进程 fork 之后继承
+    workers = max(1, PROCESS_READER_WORKERS)
+    supervisor_socks = []
+    process_list = []
+    for i in range(workers):
+        # 每个分片一个阅读进程和一个发送进程, 通过各自的队列通信
+        process_queue = ProcessQueue(shard=i if workers > 1 else None)
+        # 采集器的管道通过这个 socket 交给阅读进程
+        reader_sock, supervisor_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        supervisor_socks.append(supervisor_sock)
+        process_list.append(ReadProcess(process_queue, reader_sock, name="reader-%d" % i,
+                                        registry=registry))
+        process_list.append(SenderProcess(process_queue, name="sender-%d" % i, registry=registry))
 
     # 启动阅读线程与发送线程
     for p in process_list:
         p.start()
+    start_telemetry(TELEMETRY_DIR, "supervisor")
 
     # 扫描采集器
     def scan_collection():
-        cc = ChildrenCollector(collection_dict=collection_dict)
+        cc = ChildrenCollector(collection_dict=collection_dict,
+                               selector=ShardedChannel(supervisor_socks),
+                               fork_server=fork_server)
+        cc.worker_pids = [p.pid for p in process_list]
+        publisher = Publisher(TELEMETRY_DIR, "supervisor", TELEMETRY_PUBLISH_INTERVAL)
         while True:
             cc.populate_collectors("{}/collectors".format(BASE_DIR))  # 载入采集器
+            cc.populate_plugins("{}/plugins".format(BASE_DIR))  # 载入进程内的插件
             cc.reap_children()  # 维护子采集器
             cc.check_children()  # 检测子采集器
             cc.spawn_children()  # 执行收集器
-            time.sleep(0.1)  # 1S扫描一次采集器
+            publisher.maybe_publish()  # 发送进程汇总指标时需要监控进程的快照
+            registry.maybe_publish(collection_dict)  # 阅读进程据此释放已经移除的采集器
+            cc.wait(0.1)  # 等到下一个调度事件, 最多 0.1S
 
     scan_collection()
 
@@ -89,5 +151,16 @@ def process_main(argv):
         p.join()
 
 
+def asyncio_main(argv):
+    # 写入进程ID
+    write_pid("{}/octopus.pid".format(BASE_DIR))
+    start_telemetry()
+
+    # 发现、调度、读取和发送都在一个事件循环里
+    install_child_watcher()
+    runtime = AsyncRuntime("{}/collectors".format(BASE_DIR), "{}/plugins".format(BASE_DIR))
+    asyncio.run(runtime.run())
+
+
 if __name__ == '__main__':
     sys.exit(thread_main(sys.argv))
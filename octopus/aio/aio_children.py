@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import signal
+import subprocess
+import time
+
+from octopus.comm.children_collector import ChildrenCollector
+from octopus.comm.collector import Collector
+from octopus.comm.plugin import PluginCollector
+from octopus.comm.reaper import signal_group
+from octopus.comm.scheduler import INACTIVITY, SPAWN, LoopScheduler
+from octopus.settings import ALIVE, TERMINATE_GRACE
+
+LOG = logging.getLogger('octopus')
+
+
+class AsyncProcess:
+    """
+    async process
+
+    asyncio.subprocess.Process 加上采集器用到的 Popen 接口
+    """
+
+    def __init__(self, proc):
+        self.proc: asyncio.subprocess.Process = proc
+        self.pid = proc.pid
+
+    def poll(self):
+        return self.proc.returncode
+
+    def send_signal(self, sig):
+        if self.proc.returncode is None:
+            try:
+                self.proc.send_signal(sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class AsyncCollector(Collector):
+    """
+    async collector
+
+    shutdown 不能阻塞事件循环: 先给进程组 SIGTERM, TERMINATE_GRACE 秒后还没有退出再 SIGKILL
+    """
+    __slots__ = ()
+
+    def shutdown(self, grace=TERMINATE_GRACE):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        signal_group(self.proc, signal.SIGTERM)
+        asyncio.get_running_loop().call_later(grace, self._kill, self.proc)
+
+    @staticmethod
+    def _kill(proc):
+        if proc.poll() is None:
+            signal_group(proc, signal.SIGKILL)
+
+
+class AsyncChildrenCollector(ChildrenCollector):
+    """
+    async children collector
+
+    发现与注册沿用 ChildrenCollector; 调度事件交给事件循环的定时器, 子进程用
+    asyncio.create_subprocess_exec 创建, 输出由 StreamReader 读取, 退出由 child watcher
+    通知, 不再轮询 poll()
+    """
+
+    def __init__(self, collection_dict, loop, on_lines):
+        super().__init__(collection_dict)
+        self.collector_class = AsyncCollector
+        self.loop = loop
+        self.on_lines = on_lines  # 协程, 采集器有新的完整行时调用
+        self.scheduler = LoopScheduler(loop, {
+            SPAWN: self.spawn_child,
+            INACTIVITY: self.check_child,
+        })
+        self.tasks = set()
+
+    def terminate(self, col):
+        """子进程由 child watcher 回收, 终止交给 AsyncCollector.shutdown 的定时器"""
+        col.shutdown()
+
+    async def discover(self, collector_dir, plugin_dir=None, max_sleep=1):
+        """
+        inotify 可用时等待目录变化, 否则每 max_sleep 秒检查一次
+        """
+        changed = asyncio.Event()
+        fds = set()
+        while ALIVE:
+            self.populate_collectors(collector_dir)
+            if plugin_dir is not None:
+                self.populate_plugins(plugin_dir)
+            self.account()  # 常驻采集器的资源采样与按负载调整间隔
+            polled = plugin_dir is not None and self.plugin_discovery is None  # 插件目录还不存在
+            for discovery in (self.discovery, self.plugin_discovery):
+                if discovery is None:
+                    continue
+                fd = discovery.fileno()
+                if fd is None:
+                    polled = True
+                elif fd not in fds:
+                    fds.add(fd)
+                    self.loop.add_reader(fd, changed.set)
+            changed.clear()
+            try:
+                await asyncio.wait_for(changed.wait(),
+                                       max_sleep if polled else self.resources.sample_interval or None)
+            except asyncio.TimeoutError:
+                pass
+
+    def spawn_child(self, due, col, now):
+        if not ALIVE or not self.is_current(col) or col.dead or due != col.next_spawn:
+            return
+        if col.proc is None:
+            task = self.loop.create_task(self.run_collector(col))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            return
+        super().spawn_child(due, col, now)  # 超时没有退出
+
+    async def run_collector(self, col):
+        """启动采集器, 读完输出并等待退出"""
+        LOG.info('%s (interval=%d) needs to be spawned', col.name, col.interval)
+        start = time.monotonic()
+        try:
+            if isinstance(col, PluginCollector):
+                proc = self.plugin_runner.start(col)
+                stdout, stderr = await self.open_pipe(proc.stdout), await self.open_pipe(proc.stderr)
+                exited = asyncio.wrap_future(proc.future)
+            else:
+                aproc = await asyncio.create_subprocess_exec(
+                    col.file_name, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, start_new_session=True)
+                proc, stdout, stderr, exited = AsyncProcess(aproc), aproc.stdout, aproc.stderr, aproc.wait()
+        except OSError as e:
+            self.spawn_failures.inc()
+            LOG.error('Failed to spawn collector %s: %s', col.file_name, e)
+            self.schedule_spawn(col, time.time() + max(col.interval, 1))
+            return
+        self.spawn_seconds.record(time.monotonic() - start)
+        self.spawns.inc()
+        col.proc = proc
+        col.last_spawn = time.time()
+        col.last_datapoint = col.last_spawn
+        col.dead = False
+        LOG.info('spawned %s (pid=%d)', col.name, proc.pid)
+        if self.is_current(col):
+            self.schedule_next(col)
+
+        pumps = [self.loop.create_task(self.pump(col, stdout, False)),
+                 self.loop.create_task(self.pump(col, stderr, True))]
+        status = await exited
+        # child watcher 已经回收, 拿不到 rusage, 只记录耗时
+        self.resources.finished(col, proc, getattr(proc, "usage", None))
+        # 采集器的子进程可能还持有管道, 退出后最多再读 1 秒
+        _, pending = await asyncio.wait(pumps, timeout=1)
+        for task in pending:
+            task.cancel()
+        if self.is_current(col):
+            self.reaped(col, status)
+        else:
+            col.proc = None  # 已经被新的采集器替换
+
+    async def open_pipe(self, pipe):
+        """插件的管道读端交给事件循环, 与子进程的输出一样用 StreamReader 读取"""
+        reader = asyncio.StreamReader()
+        await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        return reader
+
+    async def pump(self, col, stream: asyncio.StreamReader, stderr):
+        while True:
+            data = await stream.read(65536)
+            col.feed(data, stderr)
+            if col.data_lines:
+                await self.on_lines(col)
+            if not data:
+                return
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+
+from octopus.aio.aio_children import AsyncChildrenCollector
+from octopus.comm.collector import Collector
+from octopus.comm.datapoint import DataPoint, parse_lines
+from octopus.comm.rate_limit import default_rate_limits
+from octopus.comm.rollup import Rollup
+from octopus.comm.sender import MiddlewareChain, batch_lag
+from octopus.comm.telemetry import REGISTRY, collector_stats, gather, to_datapoints
+from octopus.settings import (ALIVE, DEDUP_INTERVAL, EVICT_INTERVAL, FAIR_QUEUE_ENABLED,
+                              FAIR_QUEUE_MAX_PER_COLLECTOR, KEEP_INVALID_LINES, NS_PREFIX,
+                              SENDER_FLUSH_INTERVAL, SENDER_MAX_BATCH_SIZE, SENDER_MAX_LINGER_MS,
+                              TELEMETRY_EMIT_INTERVAL, TELEMETRY_METRIC_PREFIX)
+
+LOG = logging.getLogger('octopus')
+
+MAX_PENDING = 10000  # 等待发送的数据超过这个数量时暂停读取采集器, 与 ThreadQueue 的大小一致
+
+
+def install_child_watcher():
+    """
+    Python 3.12 之前默认的 ThreadedChildWatcher 每个子进程一个线程,
+    有 pidfd 时换成 PidfdChildWatcher, 子进程退出由事件循环直接通知
+    """
+    if sys.version_info >= (3, 12) or not hasattr(asyncio, "PidfdChildWatcher"):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):
+        return
+    asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
+
+
+class AsyncRuntime:
+    """
+    async runtime
+
+    一个事件循环里完成发现、调度、读取、解析去重和发送: 采集器的输出读到之后直接解析
+    放进待发送的批次, 攒够 max_batch_size 条或者等了 max_linger_ms 毫秒就发送,
+    没有线程之间的队列
+    """
+
+    def __init__(self, collector_dir, plugin_dir=None):
+        self.collector_dir = collector_dir
+        self.plugin_dir = plugin_dir
+        self.collection_dict: dict = {}
+        self.dedupinterval = DEDUP_INTERVAL
+        self.evictinterval = EVICT_INTERVAL
+        self.ns_prefix = NS_PREFIX
+        self.keep_invalid = KEEP_INVALID_LINES
+        self.rate_limits = default_rate_limits()  # 按采集器名称保存的令牌桶
+        self.rollup: Rollup = None
+        self.max_batch_size = SENDER_MAX_BATCH_SIZE
+        self.max_linger_ms = SENDER_MAX_LINGER_MS
+        self.emit_interval = TELEMETRY_EMIT_INTERVAL
+        self.batch = []
+        self.pending: dict = {}  # 采集器名称 -> 批次里的条数
+        self.max_per_collector = FAIR_QUEUE_MAX_PER_COLLECTOR if FAIR_QUEUE_ENABLED else 0
+        self.chain: MiddlewareChain = None
+        self.children: AsyncChildrenCollector = None
+        self._ready: asyncio.Event = None  # 批次可以发送
+        self._drained: asyncio.Event = None  # 批次已经取走
+        self._linger = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+        self._drained = asyncio.Event()
+        self.chain = MiddlewareChain()
+        self.init_metrics()
+        self.rollup = Rollup()
+        self.children = AsyncChildrenCollector(self.collection_dict, loop, self.process_lines)
+        self.children.rate_limits = self.rate_limits
+        await asyncio.gather(
+            self.children.discover(self.collector_dir, self.plugin_dir),
+            self.sender(),
+            self.evictor(),
+            self.roller(),
+        )
+
+    def init_metrics(self):
+        self.lines_read = REGISTRY.counter("octopus_lines_read_total", "lines read from collectors")
+        self.lines_invalid = REGISTRY.counter("octopus_lines_invalid_total", "lines that could not be parsed")
+        self.lines_deduped = REGISTRY.counter("octopus_lines_deduped_total", "datapoints suppressed by dedup")
+        self.lines_enqueued = REGISTRY.counter("octopus_lines_enqueued_total", "items put into the send queue")
+        self.read_seconds = REGISTRY.histogram("octopus_read_seconds",
+                                               "parse, dedup and enqueue time per collector batch")
+        self.batch_size = REGISTRY.histogram("octopus_sender_batch_size", "items per sender batch", scale=1)
+        self.send_lag = REGISTRY.histogram("octopus_send_lag_seconds",
+                                           "read from the collector to hand-off to the middlewares, "
+                                           "oldest item per batch")
+        REGISTRY.gauge("octopus_queue_depth", "items waiting to be sent", fn=lambda: len(self.batch))
+        REGISTRY.add_collector(collector_stats(self.collection_dict))
+
+    async def process_lines(self, col: Collector):
+        """解析数据, 去重后放进待发送的批次; 批次太大时等待发送, 对采集器形成背压"""
+        start = time.monotonic()
+        lines = list(col.collect())
+        self.lines_read.inc(len(lines))
+        if self.rate_limits.enabled():
+            lines, dropped = self.rate_limits.admit(col.name, lines)
+            col.lines_dropped += dropped
+        # keep_invalid 时不符合行协议的行留在原来的位置, 原样发送
+        points, invalid = parse_lines(lines, self.ns_prefix, self.keep_invalid)
+        if invalid:
+            self.lines_invalid.inc(len(invalid))
+            col.lines_invalid += len(invalid)
+            LOG.debug('%s: %d invalid lines', col.name, len(invalid))
+        if self.rollup.enabled():
+            # 聚合的序列看到的是去重之前的全部数据
+            points = self.rollup.add(col.name, points)
+
+        if self.dedupinterval:
+            deduped = []
+            for dp in points:
+                if isinstance(dp, DataPoint):
+                    deduped.extend(col.values.filter(dp))
+                else:
+                    deduped.append(dp)
+            self.lines_deduped.inc(max(0, len(points) - len(deduped)))
+            points = deduped
+
+        if points:
+            col.lines_sent += len(points)
+            self.pending[col.name] = self.pending.get(col.name, 0) + len(points)
+            self.enqueue([(col.name, dp, start) for dp in points])
+        self.read_seconds.record(time.monotonic() - start)
+
+        # 只暂停输出太多的采集器, 其他采集器的数据照常进入批次
+        while len(self.batch) >= MAX_PENDING or \
+                (self.max_per_collector and self.pending.get(col.name, 0) >= self.max_per_collector):
+            self._drained.clear()
+            await self._drained.wait()
+
+    def enqueue(self, items):
+        self.lines_enqueued.inc(len(items))
+        if not self.batch:
+            self._linger = asyncio.get_running_loop().call_later(
+                self.max_linger_ms / 1000.0, self._ready.set)
+        self.batch.extend(items)
+        if len(self.batch) >= self.max_batch_size:
+            self._ready.set()
+
+    async def roller(self):
+        """发送结束的窗口的聚合值"""
+        if not self.rollup.enabled():
+            return
+        while ALIVE:
+            timeout = self.rollup.next_timeout(time.time())
+            await asyncio.sleep(1 if timeout is None else min(timeout, 1))
+            items = self.rollup.flush(time.time())
+            if items:
+                now = time.monotonic()
+                self.enqueue([(name, dp, now) for name, dp in items])
+
+    async def sender(self):
+        last_emit = time.time()
+        while True:
+            timeout = SENDER_FLUSH_INTERVAL
+            if self.emit_interval > 0:
+                timeout = min(timeout, max(0.0, last_emit + self.emit_interval - time.time()))
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._ready.clear()
+            if self._linger is not None:
+                self._linger.cancel()
+                self._linger = None
+            batch, self.batch = self.batch, []
+            self.pending.clear()
+            self._drained.set()
+            if not batch:
+                # 空闲时中间件按时间换分段、收取在途的响应; 可能阻塞, 放到线程池里
+                await asyncio.get_running_loop().run_in_executor(None, self.chain.flush)
+
+            for i in range(0, len(batch), self.max_batch_size):
+                lines = batch[i:i + self.max_batch_size]
+                self.batch_size.record(len(lines))
+                lag = batch_lag(lines)
+                if lag is not None:
+                    self.send_lag.record(lag)
+                await self.chain.deliver_async(lines)
+
+            if self.emit_interval > 0 and time.time() - last_emit >= self.emit_interval:
+                # 自身的运行指标作为 octopus 采集器的数据发送
+                last_emit = time.time()
+                points = to_datapoints(gather(), TELEMETRY_METRIC_PREFIX)
+                await self.chain.send_batch_async([("octopus", dp) for dp in points])
+
+    async def evictor(self):
+        if self.dedupinterval == 0:  # if 0 we do not use dedup
+            return
+        while ALIVE:
+            now = int(time.time())
+            for col in list(self.collection_dict.values()):
+                col.evict_old_keys(now - self.evictinterval)
+            await asyncio.sleep(self.evictinterval)
@@ -2,13 +2,24 @@
 import fcntl
 import logging
 import os
-import signal
+import random
+import selectors
 import subprocess
 import time
 
-from os import kill
 from octopus.comm.collector import Collector
-from octopus.settings import ALLOWED_INACTIVITY_TIME, REMOVE_INACTIVE_COLLECTORS, ALIVE
+from octopus.comm.discovery import CollectorDiscovery
+from octopus.comm.fork_server import ForkServer, is_python_collector
+from octopus.comm.plugin import PluginCollector, PluginRunner, is_plugin
+from octopus.comm.rate_limit import RateLimits
+from octopus.comm.reaper import Reaper
+from octopus.comm.resources import ResourceUsage, Throttle
+from octopus.comm.scheduler import INACTIVITY, SPAWN, Scheduler
+from octopus.comm.stderr_log import STDERR
+from octopus.comm.telemetry import REGISTRY
+from octopus.settings import (ALLOWED_INACTIVITY_TIME, REMOVE_INACTIVE_COLLECTORS, ALIVE,
+                              DISCOVERY_FULL_RESCAN_INTERVAL, DISCOVERY_USE_INOTIFY,
+                              FORK_SERVER_ALLOWLIST, SPAWN_JITTER, THROTTLE_ENABLED)
 
 LOG = logging.getLogger('octopus')
 
@@ -18,69 +29,199 @@ class ChildrenCollector:
     children collector
     """
 
-    def __init__(self, collection_dict):
+    def __init__(self, collection_dict, selector=None, fork_server=None):
         self.collection_dict = collection_dict
+        self.collector_class = Collector  # 子类可以替换成自己的 Collector
+        # CollectorSelector 或 CollectorChannel, 子进程的管道交给阅读端监听
+        self.selector = selector
+        # Python 采集器交给 fork-server 执行, 为 None 时全部使用 Popen
+        self.fork_server: ForkServer = fork_server
+        self.discovery: CollectorDiscovery = None
+        # 进程内执行的 Python 插件, 见 populate_plugins
+        self.plugin_dir = None
+        self.plugin_discovery: CollectorDiscovery = None
+        self.plugin_runner: PluginRunner = None
+        # 与阅读端在同一个进程时(线程/asyncio 模式)的限流状态, 采集器移除时一起释放;
+        # 进程模式下阅读进程自己按 ShmRegistry 释放
+        self.rate_limits: RateLimits = None
+        self.scheduler = Scheduler()
+        self.spawn_jitter = SPAWN_JITTER
+        self.waiter = selectors.DefaultSelector()  # 等待调度事件、目录变化与子进程退出
+        self.reaper = Reaper()  # 子进程的回收与终止, 都不阻塞
+        if self.reaper.fileno() is not None:
+            self.waiter.register(self.reaper.fileno(), selectors.EVENT_READ)
+        self.resources = ResourceUsage()  # 每个采集器的 CPU/RSS/耗时
+        self.worker_pids = []  # 进程模式的阅读/发送进程, 它们的 CPU 计入 octopus 自身
+        self.throttle: Throttle = Throttle(self.resources, workers=self.octopus_pids) if THROTTLE_ENABLED else None
+        self.spawns = REGISTRY.counter("octopus_spawns_total", "collector processes started")
+        self.spawn_failures = REGISTRY.counter("octopus_spawn_failures_total", "collectors that failed to start")
+        self.exits = REGISTRY.counter("octopus_collector_exits_total", "collector processes reaped")
+        self.failures = REGISTRY.counter("octopus_collector_failures_total",
+                                         "collector processes that exited with an error")
+        self.spawn_seconds = REGISTRY.histogram("octopus_spawn_seconds", "time to start a collector process")
+        self.reap_seconds = REGISTRY.histogram("octopus_reap_seconds", "time to reap exited collectors")
+        REGISTRY.gauge("octopus_collectors", "registered collectors", fn=lambda: len(self.collection_dict))
+        REGISTRY.gauge("octopus_collectors_running", "collectors with a running process",
+                       fn=lambda: sum(1 for _ in self.all_living_collectors()))
+        REGISTRY.add_collector(self.resources.stats(self.throttle))
 
     def populate_collectors(self, collector_dir):
         """
-        查找内部的收集器,同时更新收集器
+        查找内部的收集器,同时更新收集器; 只处理 discovery 报告有变化的目录和文件
         """
-        for interval in os.listdir(collector_dir):
-            if not interval.isdigit():  # 判断是否是数字
-                continue
-            interval = int(interval)
+        self.discovery = self.poll_discovery(self.discovery, collector_dir)
+
+    def populate_plugins(self, plugin_dir):
+        """
+        查找 plugins/<interval>/ 下的 Python 插件, 目录不存在时不处理
+        """
+        if self.plugin_discovery is None and not os.path.isdir(plugin_dir):
+            return
+        self.plugin_dir = plugin_dir
+        if self.plugin_runner is None:
+            self.plugin_runner = PluginRunner()
+        self.plugin_discovery = self.poll_discovery(self.plugin_discovery, plugin_dir)
+
+    def poll_discovery(self, discovery, collector_dir):
+        if discovery is None or discovery.collector_dir != collector_dir:
+            if discovery is not None and discovery.fileno() is not None:
+                self.waiter.unregister(discovery.fileno())
+            discovery = CollectorDiscovery(collector_dir, DISCOVERY_FULL_RESCAN_INTERVAL,
+                                           DISCOVERY_USE_INOTIFY)
+            if discovery.fileno() is not None:
+                self.waiter.register(discovery.fileno(), selectors.EVENT_READ)
+        full, intervals, files = discovery.poll()
+        if full:
+            self.scan_collectors(collector_dir)
+            return discovery
+        for interval in intervals:
+            self.scan_collectors(collector_dir, interval)
+        for interval, collector_name in files:
+            self.update_collector(collector_dir, interval, collector_name)
+        return discovery
+
+    def scan_collectors(self, collector_dir, only_interval=None):
+        """
+        扫描全部或者某一个时间间隔目录, 目录里已经不存在的采集器会被移除
+        :param collector_dir:
+        :param only_interval: None 表示扫描全部
+        :return:
+        """
+        if only_interval is None:
+            try:
+                intervals = [int(i) for i in os.listdir(collector_dir) if i.isdigit()]  # 判断是否是数字
+            except FileNotFoundError:
+                intervals = []
+        else:
+            intervals = [only_interval]
 
+        found = set()
+        for interval in intervals:
             """
             找到具体的采集器的名称
             """
-            for collector_name in os.listdir('%s/%d' % (collector_dir, interval)):
-                if collector_name.startswith('.'):
-                    continue
-
-                file_name = '%s/%d/%s' % (collector_dir, interval, collector_name)
-                if os.path.isfile(file_name) and os.access(file_name, os.X_OK):
-                    m_time = os.path.getmtime(file_name)  # 文件的最近更新时间
-                    """
-                    （1）如果采集器存在，那么就判断采集器的执行时间是否相等，执行时间不想等就直接抛出错误后继续，
-                    再次判断是否是更新过，如果更新过那就检查采集器是否有运行时间，没有运行时间就重新载入采集器
-                    （2）如果采集器不存在，那么就载入采集器
-                    """
-                    if collector_name in self.collection_dict.keys():
-                        col = self.collection_dict.get(collector_name)
-
-                        if col.interval != interval:
-                            LOG.error('two collectors with the same name %s and '
-                                      'different intervals %d and %d',
-                                      collector_name, interval, col.interval)
-                            continue
-
-                        col.generation = int(time.time())
-                        if col.m_time < m_time:
-                            LOG.info('%s has been updated on disk', col.name)
-                            col.m_time = m_time
-
-                            # 如果采集器没有运行时间,那么就重新运行采集器
-                            if not col.interval:
-                                col.shutdown()
-                                LOG.info('Respawning %s', col.name)
-                                self.register_collector(
-                                    Collector(collector_name, interval, file_name, m_time))
-                    else:
-                        self.register_collector(
-                            Collector(collector_name, interval, file_name, m_time))
-                else:
-                    raise Exception("Permission denied")
-
-        # 如果扫描到的版本与新版本相差30S以上,那么就从新版本删除
-        # TODO:这个方法还需要考虑
-        to_delete = []
-        for col in self.collection_dict.values():
-            if col.generation < int(time.time() - 30):
-                LOG.info('collector %s removed from the filesystem, forgetting', col.name)
-                col.shutdown()
-                to_delete.append(col.name)
-        for name in to_delete:
-            del self.collection_dict[name]
+            try:
+                names = os.listdir('%s/%d' % (collector_dir, interval))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for collector_name in names:
+                if self.update_collector(collector_dir, interval, collector_name):
+                    found.add(collector_name)
+
+        prefix = '%s/' % collector_dir  # 采集器和插件在不同的目录, 只移除这个目录下的
+        for col in list(self.collection_dict.values()):
+            if col.name in found or not col.file_name.startswith(prefix):
+                continue
+            if only_interval is None or col.interval == only_interval:
+                self.remove_collector(col.name)
+
+    def update_collector(self, collector_dir, interval, collector_name):
+        """
+        载入或者更新一个采集器, 文件不存在或者不可执行时移除
+        :return: 采集器是否存在
+        """
+        if collector_name.startswith('.') or collector_name == '__pycache__':
+            return False  # 隐藏文件和载入插件时 Python 写的字节码目录
+
+        file_name = '%s/%d/%s' % (collector_dir, interval, collector_name)
+        if collector_dir == self.plugin_dir:
+            usable = os.path.isfile(file_name) and is_plugin(file_name)
+        else:
+            usable = os.path.isfile(file_name) and os.access(file_name, os.X_OK)
+        if not usable:
+            if os.path.exists(file_name):
+                LOG.warning('%s is not an executable file or a plugin, ignoring', file_name)
+            col = self.collection_dict.get(collector_name)
+            if col is not None and col.file_name == file_name:
+                self.remove_collector(collector_name)
+            return False
+
+        m_time = os.path.getmtime(file_name)  # 文件的最近更新时间
+        """
+        （1）如果采集器存在，那么就判断采集器的执行时间是否相等，执行时间不想等就直接抛出错误后继续，
+        再次判断是否是更新过，如果更新过那就检查采集器是否有运行时间，没有运行时间就重新载入采集器
+        （2）如果采集器不存在，那么就载入采集器
+        """
+        if collector_name in self.collection_dict.keys():
+            col = self.collection_dict.get(collector_name)
+
+            if col.interval != interval:
+                LOG.error('two collectors with the same name %s and '
+                          'different intervals %d and %d',
+                          collector_name, interval, col.interval)
+                return False
+            if col.file_name != file_name:
+                LOG.error('two collectors with the same name %s: %s and %s',
+                          collector_name, file_name, col.file_name)
+                return False
+
+            col.generation = int(time.time())
+            if col.m_time < m_time:
+                LOG.info('%s has been updated on disk', col.name)
+                col.m_time = m_time
+
+                # 如果采集器没有运行时间,那么就重新运行采集器
+                if not col.interval:
+                    self.terminate(col)
+                    LOG.info('Respawning %s', col.name)
+                    self.register_collector(
+                        self.new_collector(collector_name, interval, file_name, m_time))
+                elif col.dead:
+                    # 更新过的采集器重新给一次机会
+                    self.register_collector(
+                        self.new_collector(collector_name, interval, file_name, m_time))
+        else:
+            self.register_collector(
+                self.new_collector(collector_name, interval, file_name, m_time))
+        return True
+
+    def new_collector(self, collector_name, interval, file_name, m_time, last_spawn=0):
+        """plugins 目录下的文件是插件, 其余的是可执行文件"""
+        if self.plugin_dir is not None and file_name.startswith('%s/' % self.plugin_dir):
+            return PluginCollector(collector_name, interval, file_name, m_time, last_spawn)
+        return self.collector_class(collector_name, interval, file_name, m_time, last_spawn)
+
+    def renew(self, col):
+        """周期采集器执行结束或者被重启后新建的 Collector, 去重缓存不随之丢失"""
+        new = self.new_collector(col.name, col.interval, col.file_name, col.m_time, col.last_spawn)
+        new.inherit(col)
+        return new
+
+    def remove_collector(self, collector_name):
+        """采集器已经从文件系统中删除"""
+        col = self.collection_dict.pop(collector_name, None)
+        if col is None:
+            return
+        LOG.info('collector %s removed from the filesystem, forgetting', col.name)
+        self.terminate(col)
+        STDERR.forget(col.name)
+        self.resources.forget(col.name)
+        if self.rate_limits is not None:
+            self.rate_limits.forget(col.name)
+        if self.throttle is not None:
+            self.throttle.forget(col.name)
+        if isinstance(col, PluginCollector):
+            self.plugin_runner.forget(col.file_name)
 
     def register_collector(self, collector):
         """
@@ -97,9 +238,25 @@ class ChildrenCollector:
             if col.proc is not None:
                 LOG.error('%s still has a process (pid=%d) and is being reset,'
                           ' terminating', col.name, col.proc.pid)
-                col.shutdown()
+                self.terminate(col)
 
         self.collection_dict[collector.name] = collector
+        self.schedule_spawn(collector)
+
+    def adopt(self, col):
+        """
+        升级前的进程交过来的采集器: 还在运行的继续读取, 不重新启动;
+        周期采集器按原来的 last_spawn 继续调度
+        """
+        self.collection_dict[col.name] = col
+        if col.proc is None:
+            if not col.dead:
+                self.schedule_spawn(col)
+            return
+        self.reaper.watch(col.proc, col)
+        if self.selector is not None:
+            self.selector.add(col)
+        self.schedule_next(col)
 
     def all_living_collectors(self):
         """Generator to return all defined collectors that have
@@ -111,96 +268,163 @@ class ChildrenCollector:
 
     def reap_children(self):
         """
-        维护子进程
+        回收已经退出的子进程, 推进到期的终止; 只处理 pidfd 可读的进程, 不会阻塞
         """
-        for col in self.all_living_collectors():
-            now = int(time.time())
-            # FIXME: this is not robust.  the asyncproc module joins on the
-            # reader threads when you wait if that process has died.  this can cause
-            # slow dying processes to hold up the main loop.  good for now though.
-            status = col.proc.poll()
-            if status is None:
-                continue
-            col.proc = None
+        start = time.monotonic()
+        for col, proc, status, usage in self.reaper.reap():
+            self.resources.finished(col, proc, usage)
+            if col.proc is proc:
+                self.reaped(col, status)
+        self.account()
+        self.reap_seconds.record(time.monotonic() - start)
 
-            # behavior based on status.  a code 0 is normal termination, code 13
-            # is used to indicate that we don't want to restart this collector.
-            # any other status code is an error and is logged.
-            if status == 13:
-                LOG.info('removing %s from the list of collectors (by request)',
-                         col.name)
-                col.dead = True
-            elif status != 0:
-                LOG.warning('collector %s terminated after %d seconds with '
-                            'status code %d, marking dead',
-                            col.name, now - col.last_spawn, status)
-                col.dead = True
-            else:
-                self.register_collector(
-                    Collector(col.name, col.interval, col.file_name, col.m_time, col.last_spawn))
+    def account(self, now=None):
+        """采样常驻采集器的资源, 按负载调整采集间隔; 都按各自的间隔执行"""
+        now = time.time() if now is None else now
+        self.resources.maybe_sample(self.collection_dict, now)
+        if self.throttle is None:
+            return
+        for col in self.throttle.maybe_check(self.collection_dict, now):
+            if self.is_current(col) and col.proc is None and not col.dead:
+                self.schedule_spawn(col)  # 没有在运行的按新的间隔重新登记
+
+    def terminate(self, col):
+        """SIGTERM -> TERMINATE_GRACE 秒 -> SIGKILL, 由 reap_children 推进, 不等待进程退出"""
+        self.reaper.terminate(col.proc, col)
+
+    def reaped(self, col, status):
+        """采集器进程已经退出, status 为退出码"""
+        now = int(time.time())
+        if self.selector is not None:
+            self.selector.remove(col)
+        col.proc = None
+        self.exits.inc()
+        if status != 0:
+            self.failures.inc()
+        if not self.is_current(col):
+            return  # 已经被替换或者移除的采集器, 只需要回收
+
+        # behavior based on status.  a code 0 is normal termination, code 13
+        # is used to indicate that we don't want to restart this collector.
+        # any other status code is an error and is logged.
+        if status == 13:
+            LOG.info('removing %s from the list of collectors (by request)',
+                     col.name)
+            col.dead = True
+        elif status != 0:
+            LOG.warning('collector %s terminated after %d seconds with '
+                        'status code %d, marking dead',
+                        col.name, now - col.last_spawn, status)
+            col.dead = True
+        else:
+            self.register_collector(self.renew(col))
 
     def check_children(self):
         """
         检测子进程，如果子进程心跳没有存活，那么就重新启动子进程，主要针对长期运行的程序
         """
 
-        for col in self.all_living_collectors():
-            now = int(time.time())
+        now = time.time()
+        for due, col in self.scheduler.pop_due(INACTIVITY, now):
+            self.check_child(due, col, now)
 
-            # 最后的检查时间是在设置的时间之前,那么就关掉这个任务,让后重启
-            if (col.interval == 0) and (col.last_datapoint < (now - ALLOWED_INACTIVITY_TIME)):
-                # It's too old, kill it
-                LOG.warning('Terminating collector %s after %d seconds of inactivity',
-                            col.name, now - col.last_datapoint)
-                col.shutdown()
-                if not REMOVE_INACTIVE_COLLECTORS:
-                    self.register_collector(
-                        Collector(col.name, col.interval, col.file_name, col.m_time, col.last_spawn))
+    def check_child(self, due, col, now):
+        if not self.is_current(col) or col.proc is None:
+            return
+
+        # 最后的检查时间是在设置的时间之前,那么就关掉这个任务,让后重启
+        deadline = col.last_datapoint + ALLOWED_INACTIVITY_TIME
+        if deadline > now:
+            self.scheduler.schedule(INACTIVITY, deadline, col)
+            return
+
+        # It's too old, kill it
+        LOG.warning('Terminating collector %s after %d seconds of inactivity',
+                    col.name, now - col.last_datapoint)
+        self.terminate(col)
+        if not REMOVE_INACTIVE_COLLECTORS:
+            self.register_collector(self.renew(col))
 
     def spawn_children(self):
         """
-        执行收集器
+        执行到期的收集器, 到期时还没有退出的开始终止
         :return:
         """
 
         if not ALIVE:
             return
 
-        for col in self.collection_dict.values():
-            now = int(time.time())
-            if col.interval == 0:
-                if col.proc is None:
-                    self.spawn_collector(col)
-            elif col.interval <= now - col.last_spawn:
-                if col.proc is None:
-                    self.spawn_collector(col)
-                    continue
-
-                # I'm not very satisfied with this path.  It seems fragile and
-                # overly complex, maybe we should just reply on the asyncproc
-                # terminate method, but that would make the main tcollector
-                # block until it dies... :|
-                if col.next_kill > now:
-                    continue
-                if col.kill_state == 0:
-                    LOG.warning('warning: %s (interval=%d, pid=%d) overstayed '
-                                'its welcome, SIGTERM sent',
-                                col.name, col.interval, col.proc.pid)
-                    kill(col.proc.pid, signal.SIGKILL)
-                    col.next_kill = now + 5
-                    col.kill_state = 1
-                elif col.kill_state == 1:
-                    LOG.error('error: %s (interval=%d, pid=%d) still not dead, '
-                              'SIGKILL sent',
-                              col.name, col.interval, col.proc.pid)
-                    kill(col.proc.pid, signal.SIGKILL)
-                    col.next_kill = now + 5
-                    col.kill_state = 2
-                else:
-                    LOG.error('error: %s (interval=%d, pid=%d) needs manual '
-                              'intervention to kill it',
-                              col.name, col.interval, col.proc.pid)
-                    col.next_kill = now + 300
+        now = time.time()
+        for due, col in self.scheduler.pop_due(SPAWN, now):
+            self.spawn_child(due, col, now)
+
+    def spawn_child(self, due, col, now):
+        if not self.is_current(col) or col.dead or due != col.next_spawn:
+            return
+        if col.proc is None:
+            self.spawn_collector(col)
+            if col.proc is None:
+                # 启动失败, 下一个周期再试
+                self.schedule_spawn(col, now + max(col.interval, 1))
+            else:
+                self.schedule_next(col)
+            return
+
+        LOG.warning('warning: %s (interval=%d, pid=%d) overstayed '
+                    'its welcome, SIGTERM sent',
+                    col.name, col.interval, col.proc.pid)
+        self.terminate(col)
+
+    def schedule_next(self, col):
+        """采集器启动之后: 周期采集器到下一个周期还没有退出就需要杀掉, 常驻采集器检测是否活跃"""
+        if col.interval:
+            self.schedule_spawn(col, col.last_spawn + self.interval_of(col))
+        else:
+            self.scheduler.schedule(INACTIVITY, col.last_datapoint + ALLOWED_INACTIVITY_TIME, col)
+
+    def octopus_pids(self):
+        """监控进程之外的 octopus 进程"""
+        pids = list(self.worker_pids)
+        if self.fork_server is not None and self.fork_server.alive():
+            pids.append(self.fork_server.pid)
+        return pids
+
+    def interval_of(self, col):
+        """调度使用的间隔, 负载高时被 Throttle 拉长"""
+        if self.throttle is None or not col.interval:
+            return col.interval
+        return col.interval * self.throttle.factor(col.name)
+
+    def is_current(self, col):
+        """调度事件里的采集器是否还是当前注册的那一个, 否则事件已经过期"""
+        return self.collection_dict.get(col.name) is col
+
+    def schedule_spawn(self, col, due=None):
+        """
+        登记采集器的下一次执行时间; 第一次执行加上随机抖动, 避免同一个时间间隔的
+        采集器在同一时刻启动
+        """
+        if due is None:
+            if col.interval and col.last_spawn:
+                due = col.last_spawn + self.interval_of(col)
+            else:
+                jitter = min(col.interval, self.spawn_jitter) if col.interval else self.spawn_jitter
+                due = time.time() + random.uniform(0, jitter)
+        col.next_spawn = due
+        self.scheduler.schedule(SPAWN, due, col)
+
+    def wait(self, max_sleep):
+        """
+        睡眠到下一个调度事件到期, 采集器目录发生变化(inotify)或者子进程退出(pidfd), 最多 max_sleep 秒
+        """
+        timeout = max_sleep
+        for deadline in (self.scheduler.next_deadline(), self.reaper.next_deadline()):
+            if deadline is not None:
+                timeout = max(0.0, min(timeout, deadline - time.time()))
+        if self.waiter.get_map():
+            self.waiter.select(timeout)
+        else:
+            time.sleep(timeout)
 
     def spawn_collector(self, col):
         """Takes a Collector object and creates a process for it."""
@@ -211,25 +435,41 @@ class ChildrenCollector:
             "stderr": subprocess.PIPE,
             "close_fds": True,
             "preexec_fn": os.setsid,
-            "encoding": "utf-8",
         }
 
+        start = time.monotonic()
         try:
-            col.proc = subprocess.Popen(col.file_name, **kwargs)
+            col.proc = None
+            if isinstance(col, PluginCollector):
+                col.proc = self.plugin_runner.start(col)
+            elif self.fork_server is not None and self.fork_server.alive() \
+                    and is_python_collector(col.file_name, FORK_SERVER_ALLOWLIST):
+                try:
+                    col.proc = self.fork_server.spawn(col.file_name)
+                except OSError as e:
+                    LOG.warning('fork server failed to spawn %s, using Popen: %s', col.name, e)
+            if col.proc is None:
+                col.proc = subprocess.Popen(col.file_name, **kwargs)
         except OSError as e:
+            self.spawn_failures.inc()
             LOG.error('Failed to spawn collector %s: %s' % (col.file_name, e))
             return
+        self.spawn_seconds.record(time.monotonic() - start)
+        self.spawns.inc()
         # The following line needs to move below this line because it is used in
         # other logic and it makes no sense to update the last spawn time if the
         # collector didn't actually start.
-        col.last_spawn = int(time.time())
+        col.last_spawn = time.time()
         # Without setting last_datapoint here, a long running check (>15s) will be
         # killed by check_children() the first time check_children is called.
         col.last_datapoint = col.last_spawn
         self.set_nonblocking(col.proc.stdout.fileno())
         self.set_nonblocking(col.proc.stderr.fileno())
-        if col.proc.pid > 0:
+        if col.proc.pid:
             col.dead = False
+            self.reaper.watch(col.proc, col)
+            if self.selector is not None:
+                self.selector.add(col)
             LOG.info('spawned %s (pid=%d)', col.name, col.proc.pid)
             return
         # FIXME: handle errors better
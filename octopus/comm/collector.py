@@ -1,17 +1,34 @@
 #!/usr/bin/env python
 import logging
+import os
 import signal
 import time
-from os import kill
-from subprocess import Popen
+from collections import deque
+from subprocess import Popen, TimeoutExpired
+
+from octopus.comm.dedup import DedupCache
+from octopus.comm.line_framer import LineFramer
+from octopus.comm.reaper import signal_group
+from octopus.comm.stderr_log import STDERR
+from octopus.settings import DEDUP_INTERVAL, DEDUP_MAX_KEYS, DEDUP_ONLY_ZERO, MAX_LINE_LENGTH, TERMINATE_GRACE
 
 LOG = logging.getLogger('octopus')
 
 
+_NO_LINES = ()  # 还没有读到数据的采集器共用, 第一次有完整的行时换成 deque
+
+
 class Collector(object):
     """
     一个采集器对应一个执行的脚本
+
+    使用 __slots__, 分行缓冲、待处理的行和去重缓存在第一次读到数据时才创建:
+    进程模式下监控进程只负责调度, 这些状态都在阅读进程里, 一个空闲的采集器
+    只占几百字节, 子类也需要声明 __slots__
     """
+    __slots__ = ("name", "interval", "file_name", "last_spawn", "proc", "next_spawn", "next_kill",
+                 "kill_state", "dead", "m_time", "generation", "buffer", "data_lines", "_values",
+                 "lines_sent", "lines_received", "lines_invalid", "lines_dropped", "last_datapoint")
 
     def __init__(self, collection_name, interval, file_name, m_time, last_spawn=0):
         """Construct a new Collector."""
@@ -20,104 +37,119 @@ class Collector(object):
         self.file_name = file_name
         self.last_spawn = last_spawn
         self.proc: Popen = None
+        self.next_spawn = 0  # 调度器登记的下一次执行时间
         self.next_kill = 0
         self.kill_state = 0
         self.dead = False
         self.m_time = m_time  # 文件的最近一次更改时间
         self.generation = int(time.time())
-        self.buffer = ""
-        self.data_lines = []
-        # Maps (metric, tags) to (value, repeated, line, timestamp) where:
-        #  value: Last value seen.
-        #  repeated: boolean, whether the last value was seen more than once.
-        #  line: The last line that was read from that collector.
-        #  timestamp: Time at which we saw the value for the first time.
-        # This dict is used to keep track of and remove duplicate values.
-        # Since it might grow unbounded (in case we see many different
-        # combinations of metrics and tags) someone needs to regularly call
-        # evict_old_keys() to remove old entries.
-        self.values = {}
+        self.buffer: LineFramer = None  # stdout 的增量分行
+        self.data_lines = _NO_LINES
+        self._values: DedupCache = None
         self.lines_sent = 0
         self.lines_received = 0
         self.lines_invalid = 0
+        self.lines_dropped = 0  # 超出限流被丢弃的行
         self.last_datapoint = int(time.time())  # 最后的数据时间
 
-    @property
-    def read(self):
-        """Read bytes from our subprocess and store them in our temporary
-           line storage buffer.  This needs to be non-blocking."""
-
-        # we have to use a buffer because sometimes the collectors
-        # will write out a bunch of data points at one time and we
-        # get some weird sized chunk.  This read call is non-blocking.
-
-        # now read stderr for log messages, we could buffer here but since
-        # we're just logging the messages, I don't care to
-        if self.proc.poll() is None:
-            return []
+    def read(self, fd, stderr=False):
+        """Read one chunk from the given (non-blocking) pipe of our subprocess
+           and store complete lines in our temporary line storage buffer.
 
+        :param fd: stdout or stderr file descriptor, ready for reading
+        :param stderr: whether fd is the stderr pipe
+        :return: number of bytes read, 0 on EOF, None if nothing to read
+        """
         try:
-            out = self.proc.stderr.read()
-            if out:
-                LOG.debug('reading %s got %d bytes on stderr', self.name, len(out))
-                for line in out.splitlines():
-                    LOG.warning('%s: %s', self.name, line)
-        except Exception as e:
-            LOG.exception('uncaught exception in stderr read {}'.format(e))
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return None
+        except OSError as e:
+            LOG.exception('uncaught exception in {} read {}'.format(
+                'stderr' if stderr else 'stdout', e))
+            return 0
+        return self.feed(data, stderr)
+
+    def feed(self, data, stderr=False):
+        """Handle one chunk read from stdout or stderr, an empty chunk means EOF.
+
+        :param data: bytes
+        :param stderr: whether data comes from stderr
+        :return: number of bytes, 0 on EOF
+        """
+        if not data:
+            if stderr:
+                STDERR.flush(self.name)
+            elif self.buffer is not None:
+                self._append_lines(self.buffer.flush())
+            return 0
+
+        # stderr 放进采集器的环形缓冲, 日志异步输出并且限流, 见 StderrLog
+        if stderr:
+            STDERR.write(self.name, data)
+            return len(data)
 
         # we have to use a buffer because sometimes the collectors will write
         # out a bunch of data points at one time and we get some weird sized
         # chunk.  This read call is non-blocking.
-        try:
-            self.buffer += self.proc.stdout.read()
-            if len(self.buffer):
-                LOG.debug('reading %s, buffer now %d bytes', self.name, len(self.buffer))
-        except Exception as e:
-            LOG.exception('uncaught exception in stdout read {}'.format(e))
-            return
+        if self.buffer is None:
+            self.buffer = LineFramer(MAX_LINE_LENGTH)
+        oversized = self.buffer.lines_oversized
+        self._append_lines(self.buffer.feed(data))
+        self.lines_invalid += self.buffer.lines_oversized - oversized
+        return len(data)
+
+    def _append_lines(self, lines):
+        if lines:
+            if self.data_lines is _NO_LINES:
+                self.data_lines = deque()
+            self.data_lines.extend(lines)
+            self.lines_received += len(lines)
+            self.last_datapoint = int(time.time())
 
-        # iterate for each line we have
-        while self.buffer:
-            idx = self.buffer.find('\n')
-            if idx == -1:
-                break
+    def collect(self):
+        """Returns the lines read so far up to whomever is calling us.  This
+           is a generator that returns a line as it becomes available."""
 
-            # one full line is now found and we can pull it out of the buffer
-            line = self.buffer[0:idx].strip()
-            if line:
-                self.data_lines.append(line)
-                self.last_datapoint = int(time.time())
-            self.buffer = self.buffer[idx + 1:]
+        while self.data_lines:
+            yield self.data_lines.popleft()
 
-    def collect(self):
-        """Reads input from the collector and returns the lines up to whomever
-           is calling us.  This is a generator that returns a line as it
-           becomes available."""
+    @property
+    def values(self):
+        """去重缓存, 见 DedupCache; 由阅读端定期调用 evict_old_keys() 清理"""
+        if self._values is None:
+            self._values = DedupCache(DEDUP_INTERVAL, DEDUP_MAX_KEYS, DEDUP_ONLY_ZERO)
+        return self._values
+
+    def inherit(self, previous):
+        """同一个采集器的下一次执行, 沿用上一次的去重缓存"""
+        self._values = previous._values
+
+    def dedup_keys(self):
+        return 0 if self._values is None else len(self._values)
 
-        while self.proc is not None:
-            self.read
-            if not len(self.data_lines):
-                return
-            while len(self.data_lines):
-                yield self.data_lines.pop(0)
+    def dedup_stats(self):
+        """去重缓存的命中/未命中/淘汰次数, 还没有缓存时为 None"""
+        return None if self._values is None else self._values.stats()
 
-    def shutdown(self):
-        """Cleanly shut down the collector"""
+    def shutdown(self, grace=TERMINATE_GRACE):
+        """Cleanly shut down the collector
+
+        会阻塞最多 grace 秒, 只用于退出时; 监控进程的循环里使用 ChildrenCollector.terminate
+        """
 
         if not self.proc:
             return
         try:
             if self.proc.poll() is None:
-                # kill(self.proc, signal.SIGKILL)
-                for attempt in range(5):
-                    if self.proc.poll() is not None:
-                        self.proc = None
-                        return
-                    LOG.info('Waiting %ds for PID %d (%s) to exit...'
-                             % (5 - attempt, self.proc.pid, self.name))
-                    time.sleep(1)
-                kill(self.proc, signal.SIGKILL)
-                self.proc.wait()
+                signal_group(self.proc, signal.SIGTERM)
+                try:
+                    self.proc.wait(grace)
+                except (TimeoutExpired, TimeoutError):
+                    LOG.info('PID %d (%s) did not exit after %ds, SIGKILL sent',
+                             self.proc.pid, self.name, grace)
+                    signal_group(self.proc, signal.SIGKILL)
+                    self.proc.wait()
         except Exception as e:
             # we really don't want to die as we're trying to exit gracefully
             LOG.exception('ignoring uncaught exception while shutting down {}'.format(e))
@@ -129,16 +161,14 @@ class Collector(object):
           cut_off: A UNIX timestamp.  Any value that's older than this will be
             removed from the cache.
         """
-        for key in self.values.keys():
-            __time = self.values[key][3]
-            if __time < cut_off:
-                del self.values[key]
+        if self._values is not None:
+            self._values.evict_old_keys(cut_off)
 
     def to_json(self):
         """Expose collector information in JSON-serializable format."""
         result = {}
         for attr in ["name", "m_time", "last_spawn", "kill_state", "next_kill",
-                     "lines_sent", "lines_received", "lines_invalid",
+                     "lines_sent", "lines_received", "lines_invalid", "lines_dropped",
                      "last_datapoint", "dead"]:
             result[attr] = getattr(self, attr)
         return result
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""
+基于 selectors(Linux 下为 epoll) 的采集器输出事件分发,
+只有子进程的管道可读时才唤醒阅读端
+"""
+import bisect
+import hashlib
+import json
+import logging
+import os
+import selectors
+import socket
+import threading
+from collections import deque
+
+from octopus.comm.collector import Collector
+
+LOG = logging.getLogger('octopus')
+
+_WAKEUP = object()
+_CHANNEL = object()
+
+
+class CollectorSelector:
+    """
+    collector selector
+
+    注册/注销操作可以在任意线程调用, 真正的 register/unregister 统一在阅读端
+    select() 所在的线程里执行, 通过自唤醒管道打断阻塞中的 select
+    """
+
+    def __init__(self, channel=None):
+        self.selector = selectors.DefaultSelector()
+        self._pending = deque()
+        self._streams: dict = {}  # pid -> [stream, ...]
+        self._paused: dict = {}  # 暂停读取的 stdout -> 注册时的 data
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, _WAKEUP)
+
+        # 进程模式下采集器的管道通过 UNIX socket 传递过来
+        self.channel: socket.socket = channel
+        self.collectors: dict = {}
+        if channel is not None:
+            self.selector.register(channel, selectors.EVENT_READ, _CHANNEL)
+
+    def add(self, col):
+        """注册采集器的 stdout/stderr"""
+        self._pending.append((self._register, col.proc.pid, col,
+                              (col.proc.stdout, col.proc.stderr)))
+        self.wakeup()
+
+    def remove(self, col):
+        """采集器已经退出, 读完管道里剩余的数据后注销"""
+        self._pending.append((self._unregister, col.proc.pid, col, ()))
+        self.wakeup()
+
+    def detach(self, timeout=5):
+        """
+        注销全部采集器的管道但不关闭, 升级时交给新的进程; 返回时阅读端已经处理完
+        之前读到的数据, 之后不会再读取
+        :return: {pid: (采集器, stdout, stderr)}, 已经读到 EOF 的管道为 None
+        """
+        detached = {}
+        lock = threading.Lock()
+        state = {"done": False, "cancelled": False}
+
+        def _detach(*args):
+            with lock:
+                if state["cancelled"]:
+                    return
+                for pid, streams in self._streams.items():
+                    entry = [None, None, None]
+                    for stream in streams:
+                        if stream.closed:
+                            continue
+                        col, stderr, _ = self._key_data(stream)
+                        entry[0] = col
+                        entry[2 if stderr else 1] = stream
+                    if entry[0] is not None:
+                        detached[pid] = tuple(entry)
+                self._streams.clear()
+                state["done"] = True
+
+        self._sync(_detach, timeout)
+        with lock:
+            if not state["done"]:
+                state["cancelled"] = True
+                raise TimeoutError("reader did not release the collector pipes")
+        # 阅读端处理完这一轮 select 读到的数据之后才会执行下一个操作
+        self._sync(lambda *args: None, timeout)
+        return detached
+
+    def attach(self, detached):
+        """升级失败, 重新注册 detach 返回的管道"""
+        for pid, (col, stdout, stderr) in detached.items():
+            self._pending.append((self._register, pid, col, (stdout, stderr)))
+        self.wakeup()
+
+    def _sync(self, op, timeout):
+        """在阅读端执行 op 并等待, 最多 timeout 秒"""
+        done = threading.Event()
+
+        def _op(*args):
+            op(*args)
+            done.set()
+
+        self._pending.append((_op, 0, None, ()))
+        self.wakeup()
+        return done.wait(timeout)
+
+    def active_collectors(self):
+        """还有管道注册着或者等待注册的采集器"""
+        active = {key.data[0] for key in self.selector.get_map().values() if isinstance(key.data, tuple)}
+        active.update(col for _, _, col, _ in list(self._pending))
+        return active
+
+    def pause(self, col):
+        """暂停读取采集器的 stdout, 管道满了之后采集器的写入阻塞; 只能在阅读端调用"""
+        for key in list(self.selector.get_map().values()):
+            data = key.data
+            if isinstance(data, tuple) and data[0] is col and not data[1]:
+                self.selector.unregister(key.fileobj)
+                self._paused[key.fileobj] = data
+
+    def resume(self, col):
+        """恢复读取 pause 暂停的采集器; 只能在阅读端调用"""
+        for stream, data in list(self._paused.items()):
+            if data[0] is col:
+                del self._paused[stream]
+                if not stream.closed:
+                    self.selector.register(stream, selectors.EVENT_READ, data)
+
+    def _key_data(self, stream):
+        """注册时的 data, 暂停中的 stream 不在 selector 里, 从 _paused 取出"""
+        data = self._paused.pop(stream, None)
+        if data is not None:
+            return data
+        data = self.selector.get_key(stream).data
+        self.selector.unregister(stream)
+        return data
+
+    def wakeup(self):
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            pass  # 管道已满, 说明已经有待处理的唤醒
+
+    def select(self, timeout=None):
+        """
+        等待管道可读并读取数据, 返回有新数据的采集器
+        :param timeout: 秒, None 表示一直等待
+        :return: set of Collector
+        """
+        ready = set()
+        for key, _ in self.selector.select(timeout):
+            if key.data is _WAKEUP:
+                self._drain_wakeup()
+            elif key.data is _CHANNEL:
+                self._recv_channel()
+            else:
+                col, stderr, pid = key.data
+                if col.read(key.fileobj.fileno(), stderr) == 0:
+                    self._close(key.fileobj)
+                    if all(s.closed for s in self._streams.get(pid, ())):
+                        self._streams.pop(pid, None)
+                ready.add(col)
+
+        while self._pending:
+            op, pid, col, streams = self._pending.popleft()
+            op(pid, col, streams, ready)
+        return ready
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _register(self, pid, col, streams, ready):
+        self._streams[pid] = []
+        for stderr, stream in enumerate(streams):
+            if stream is None:
+                continue
+            self.selector.register(stream, selectors.EVENT_READ, (col, bool(stderr), pid))
+            self._streams[pid].append(stream)
+
+    def _unregister(self, pid, col, streams, ready):
+        for stream in self._streams.pop(pid, ()):
+            if stream.closed:
+                continue
+            stderr = self._key_data(stream)[1]
+            # 读到 EAGAIN 或 EOF 为止, 退出前写入的数据不能丢
+            while col.read(stream.fileno(), stderr):
+                pass
+            self._close(stream)
+            ready.add(col)
+
+    def _close(self, stream):
+        try:
+            self.selector.unregister(stream)
+        except (KeyError, ValueError):
+            pass
+        stream.close()
+
+    def _recv_channel(self):
+        """接收监控进程传过来的采集器管道"""
+        try:
+            msg, fds, _, _ = socket.recv_fds(self.channel, 65536, 2)
+        except BlockingIOError:
+            return
+        if not msg:
+            self.selector.unregister(self.channel)
+            return
+        msg = json.loads(msg)
+        col = self.collectors.get(msg["name"])
+        if col is None or col.interval != msg["interval"]:
+            col = Collector(msg["name"], msg["interval"], msg["file_name"], msg["m_time"])
+            self.collectors[col.name] = col
+
+        if msg["op"] == "add":
+            streams = tuple(os.fdopen(fd, "rb", buffering=0) for fd in fds)
+            self._pending.append((self._register, msg["pid"], col, streams))
+        else:
+            self._pending.append((self._unregister, msg["pid"], col, ()))
+
+
+class CollectorChannel:
+    """
+    collector channel
+
+    进程模式下监控进程这一端, 与 CollectorSelector 的 add/remove 接口一致,
+    通过 SCM_RIGHTS 把子进程的管道交给阅读进程
+    """
+
+    def __init__(self, sock):
+        self.sock: socket.socket = sock
+
+    def _send(self, op, col, fds=()):
+        msg = json.dumps({
+            "op": op,
+            "pid": col.proc.pid,
+            "name": col.name,
+            "interval": col.interval,
+            "file_name": col.file_name,
+            "m_time": col.m_time,
+        }).encode()
+        socket.send_fds(self.sock, [msg], list(fds))
+
+    def add(self, col):
+        self._send("add", col, (col.proc.stdout.fileno(), col.proc.stderr.fileno()))
+        # 管道已经交给阅读进程, 本进程不再持有
+        col.proc.stdout.close()
+        col.proc.stderr.close()
+
+    def remove(self, col):
+        self._send("remove", col)
+
+
+class ShardedChannel:
+    """
+    sharded channel
+
+    多个阅读进程时按采集器名称的一致性哈希选择 CollectorChannel, 同一个采集器
+    每次执行都交给同一个阅读进程, 去重缓存和统计都留在这个进程里
+    """
+
+    def __init__(self, socks, replicas=100):
+        self.channels = [CollectorChannel(sock) for sock in socks]
+        self._ring = []  # (哈希值, 分片序号), 每个分片 replicas 个虚拟节点
+        for shard in range(len(self.channels)):
+            for replica in range(replicas):
+                self._ring.append((self._hash("%d-%d" % (shard, replica)), shard))
+        self._ring.sort()
+        self._points = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        # 内置 hash() 每个进程的种子不同, 这里需要稳定的哈希
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def shard_of(self, name):
+        index = bisect.bisect(self._points, self._hash(name)) % len(self._ring)
+        return self._ring[index][1]
+
+    def add(self, col):
+        self.channels[self.shard_of(col.name)].add(col)
+
+    def remove(self, col):
+        self.channels[self.shard_of(col.name)].remove(col)
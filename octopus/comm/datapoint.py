@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+采集器输出的行协议解析:
+
+    metric timestamp value tag1=v1 tag2=v2 ...
+
+也支持 JSON 行: {"metric": "...", "timestamp": 0, "value": 0, "tags": {"k": "v"}}
+"""
+import json
+import logging
+import math
+
+LOG = logging.getLogger('octopus')
+
+
+class DataPoint:
+    """
+    datapoint
+
+    tags 是排好序的 "k=v" 元组, (metric, tags) 即为一个序列的 key
+    """
+    __slots__ = ("metric", "timestamp", "value", "tags")
+
+    def __init__(self, metric, timestamp, value, tags=()):
+        self.metric = metric
+        self.timestamp = timestamp
+        self.value = value  # 保留原始的文本, 避免浮点数格式化带来的变化
+        self.tags = tags
+
+    @property
+    def key(self):
+        return self.metric, self.tags
+
+    def __str__(self):
+        if self.tags:
+            return "%s %d %s %s" % (self.metric, self.timestamp, self.value, " ".join(self.tags))
+        return "%s %d %s" % (self.metric, self.timestamp, self.value)
+
+    def __repr__(self):
+        return "DataPoint(%r)" % str(self)
+
+    def __eq__(self, other):
+        return isinstance(other, DataPoint) and self.key == other.key \
+            and self.timestamp == other.timestamp and self.value == other.value
+
+    def __hash__(self):
+        return hash((self.metric, self.tags, self.timestamp, self.value))
+
+    def __getstate__(self):
+        return self.metric, self.timestamp, self.value, self.tags
+
+    def __setstate__(self, state):
+        self.metric, self.timestamp, self.value, self.tags = state
+
+
+def _finite(text):
+    """inf/nan 不是有效的时间戳和值, int() 转换 inf 时还会抛出 OverflowError"""
+    number = float(text)
+    if not math.isfinite(number):
+        raise ValueError(text)
+    return number
+
+
+def _parse_json(line, ns_prefix):
+    obj = json.loads(line)
+    value = obj["value"]
+    _finite(value)
+    tags = obj.get("tags") or {}
+    return DataPoint(ns_prefix + obj["metric"], int(_finite(obj["timestamp"])), str(value),
+                     tuple(sorted("%s=%s" % (k, v) for k, v in tags.items())))
+
+
+def parse_lines(lines, ns_prefix="", keep_invalid=False):
+    """
+    批量解析, 循环内只做最少的工作
+    :param lines: list of str
+    :param ns_prefix: metric 前缀
+    :param keep_invalid: 不符合行协议的行也按原来的位置留在第一个列表里(str)
+    :return: (list of DataPoint, list of invalid line)
+    """
+    points = []
+    invalid = []
+    append = points.append
+    for line in lines:
+        try:
+            if line[0] == "{":
+                append(_parse_json(line, ns_prefix))
+                continue
+            parts = line.split()
+            if len(parts) < 3:
+                raise ValueError(line)
+            try:
+                timestamp = int(parts[1])
+            except ValueError:
+                timestamp = int(_finite(parts[1]))
+            value = parts[2]
+            _finite(value)
+            tags = parts[3:]
+            if tags:
+                for tag in tags:
+                    # k=v, 两边都不能为空
+                    if not 0 < tag.find("=") < len(tag) - 1:
+                        raise ValueError(tag)
+                tags.sort()
+                tags = tuple(tags)
+            else:
+                tags = ()
+            append(DataPoint(ns_prefix + parts[0], timestamp, value, tags))
+        except (ValueError, KeyError, TypeError, AttributeError, OverflowError):
+            invalid.append(line)
+            if keep_invalid:
+                append(line)
+    return points, invalid
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+按时间窗口去重: 同一个序列 (metric, tags) 在 dedup_interval 内值没有变化时不重复发送
+"""
+import logging
+from collections import OrderedDict
+
+LOG = logging.getLogger('octopus')
+
+
+def _is_zero(value):
+    try:
+        return float(value) == 0.0
+    except ValueError:
+        return False
+
+
+class DedupCache:
+    """
+    dedup cache
+
+    entries 按最近一次出现的时间排序, 最旧的在最前面, 清理和超出上限时
+    只需要从头部弹出, 均摊 O(1)
+    """
+
+    def __init__(self, dedup_interval=300, max_keys=10000, only_zero=False):
+        self.dedup_interval = dedup_interval
+        self.max_keys = max_keys
+        self.only_zero = only_zero
+        # Maps (metric, tags) to [value, repeated, line, timestamp, last_seen] where:
+        #  value: Last value seen.
+        #  repeated: boolean, whether the last value was seen more than once.
+        #  line: The last datapoint that was read from that collector.
+        #  timestamp: Time at which we saw the value for the first time.
+        #  last_seen: Time at which we saw the series for the last time.
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def filter(self, dp):
+        """
+        :param dp: DataPoint
+        :return: list of DataPoint, 需要发送的数据, 被去重时为空
+        """
+        key = dp.key
+        value = dp.value
+        timestamp = dp.timestamp
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            self.entries[key] = [value, False, dp, timestamp, timestamp]
+            if len(self.entries) > self.max_keys:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            return [dp]
+
+        self.entries.move_to_end(key)
+        entry[4] = timestamp
+        if entry[0] == value and timestamp - entry[3] < self.dedup_interval \
+                and (not self.only_zero or _is_zero(value)):
+            self.hits += 1
+            entry[1] = True
+            entry[2] = dp
+            return []
+
+        self.misses += 1
+        # 值变化时先补发上一次被去重的值, 保证序列在变化点之前是连续的
+        points = [entry[2], dp] if entry[1] else [dp]
+        entry[0:4] = [value, False, dp, timestamp]
+        return points
+
+    def evict_old_keys(self, cut_off):
+        """Remove old entries from the cache used to detect duplicate values.
+
+        Args:
+          cut_off: A UNIX timestamp.  Any series that hasn't been seen since
+            this time will be removed from the cache.
+        """
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if entry[4] >= cut_off:
+                break
+            del self.entries[key]
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "keys": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
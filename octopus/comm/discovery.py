@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+采集器发现: Linux 下通过 inotify(ctypes 调用, 不需要额外依赖) 监听 collectors
+目录, 只在文件创建/修改/删除/权限变化时更新; 不支持 inotify 时退回到
+检查目录 mtime, 只重新扫描 mtime 变化过的目录
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import time
+
+LOG = logging.getLogger('octopus')
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """
+    inotify
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: %s' % path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read(self):
+        """
+        :return: list of (wd, mask, name)
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+                offset += length
+                events.append((wd, mask, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class CollectorDiscovery:
+    """
+    collector discovery
+
+    poll() 返回 (full, intervals, files):
+      full: 需要全量扫描
+      intervals: 需要重新扫描的时间间隔目录
+      files: 发生变化的 (interval, 采集器名称)
+    """
+
+    def __init__(self, collector_dir, full_rescan_interval=60, use_inotify=True):
+        self.collector_dir = collector_dir
+        self.full_rescan_interval = full_rescan_interval  # 只对 mtime 模式生效
+        self.inotify: Inotify = None
+        self._watches: dict = {}  # wd -> interval, None 表示 collectors 目录本身
+        self._mtimes: dict = {}  # interval -> 目录的 mtime, None 表示 collectors 目录本身
+        self._last_full = 0
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                LOG.warning('inotify is not available (%s), falling back to mtime scanning', e)
+
+    def fileno(self):
+        """inotify 模式下可以放进 selector 等待变化"""
+        return self.inotify.fileno() if self.inotify is not None else None
+
+    def _interval_dir(self, interval):
+        return os.path.join(self.collector_dir, str(interval))
+
+    def _list_intervals(self):
+        try:
+            return [int(d) for d in os.listdir(self.collector_dir) if d.isdigit()]
+        except FileNotFoundError:
+            return []
+
+    def poll(self):
+        if not self._last_full:
+            self._full_reset()
+            return True, set(), set()
+        if self.inotify is not None:
+            return self._poll_inotify()
+        return self._poll_mtime()
+
+    def _full_reset(self):
+        """重新建立监听/记录 mtime, 调用方随后做一次全量扫描"""
+        self._last_full = time.time()
+        if self.inotify is not None:
+            for wd in list(self._watches):
+                self.inotify.rm_watch(wd)
+            self._watches.clear()
+            self.inotify.read()  # 丢弃旧的事件
+            self._watches[self.inotify.add_watch(self.collector_dir)] = None
+            for interval in self._list_intervals():
+                self._watch_interval(interval)
+        else:
+            self._mtimes = {None: self._mtime(self.collector_dir)}
+            for interval in self._list_intervals():
+                self._mtimes[interval] = self._mtime(self._interval_dir(interval))
+
+    def _watch_interval(self, interval):
+        try:
+            self._watches[self.inotify.add_watch(self._interval_dir(interval))] = interval
+        except OSError as e:
+            LOG.warning('can not watch %s: %s', self._interval_dir(interval), e)
+
+    def _poll_inotify(self):
+        intervals = set()
+        files = set()
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                LOG.warning('inotify queue overflow, rescanning %s', self.collector_dir)
+                self._full_reset()
+                return True, set(), set()
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if wd not in self._watches:
+                continue
+            interval = self._watches[wd]
+            if interval is None:
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    self._full_reset()
+                    return True, set(), set()
+                # collectors 目录下的时间间隔目录发生变化
+                if not name.isdigit():
+                    continue
+                interval = int(name)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_interval(interval)
+                intervals.add(interval)
+            elif not name:
+                # 目录本身被删除或者移走
+                intervals.add(interval)
+            else:
+                files.add((interval, name))
+        files = {f for f in files if f[0] not in intervals}
+        return False, intervals, files
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _poll_mtime(self):
+        if time.time() - self._last_full >= self.full_rescan_interval:
+            # 原地修改文件不会改变目录的 mtime, 定期做一次全量扫描
+            self._full_reset()
+            return True, set(), set()
+
+        intervals = set()
+        mtime = self._mtime(self.collector_dir)
+        if mtime != self._mtimes.get(None):
+            self._mtimes[None] = mtime
+            current = set(self._list_intervals())
+            for interval in current.symmetric_difference(k for k in self._mtimes if k is not None):
+                intervals.add(interval)
+                self._mtimes.setdefault(interval, None)
+        for interval in [k for k in self._mtimes if k is not None]:
+            mtime = self._mtime(self._interval_dir(interval))
+            if mtime != self._mtimes[interval]:
+                intervals.add(interval)
+                if mtime is None:
+                    del self._mtimes[interval]
+                else:
+                    self._mtimes[interval] = mtime
+        return False, intervals, set()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+按采集器分队列的公平调度: 每个采集器一个子队列, 取数据时按 deficit round-robin
+轮流取, 一个采集器突然输出大量数据时不会排在其他采集器前面
+"""
+import threading
+import time
+from collections import deque
+from queue import Empty, Full
+
+
+class DrrBuffer:
+    """
+    deficit round-robin buffer
+
+    不加锁的按采集器分队列的缓冲, 元素为 (采集器名称, 数据), 只能在一个线程里使用:
+      per_collector: 单个子队列的上限, push 不检查也不丢弃数据, 由调用方用 full 判断后背压
+      quantum: 每一轮每个采集器最多取的条数
+    """
+
+    def __init__(self, quantum=100, per_collector=5000):
+        self.quantum = quantum
+        self.per_collector = per_collector
+        self.queues: dict = {}  # 采集器名称 -> deque
+        self.deficit: dict = {}  # 采集器名称 -> 本轮剩余的条数
+        self.active = deque()  # 有数据的采集器, 按轮转顺序
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def full(self, name):
+        q = self.queues.get(name)
+        return q is not None and len(q) >= self.per_collector
+
+    def push(self, item):
+        name = item[0]
+        q = self.queues.get(name)
+        if q is None:
+            q = self.queues[name] = deque()
+        if not q:
+            self.active.append(name)
+            self.deficit[name] = self.quantum
+        q.append(item)
+        self.size += 1
+
+    def pop(self):
+        while True:
+            name = self.active[0]
+            if self.deficit[name] <= 0:
+                # 本轮额度用完, 下一轮再补充
+                self.deficit[name] = self.quantum
+                self.active.rotate(-1)
+                continue
+            q = self.queues[name]
+            item = q.popleft()
+            self.size -= 1
+            self.deficit[name] -= 1
+            if not q:
+                self.active.popleft()
+                del self.queues[name]
+                del self.deficit[name]
+            return item
+
+
+class FairQueue:
+    """
+    fair queue
+
+    与 queue.Queue 相同的 put/get/qsize 接口, 多个线程之间使用的 DrrBuffer:
+      maxsize: 所有子队列的总数上限, 满了之后 put 阻塞(全局背压)
+      per_collector: 单个子队列的上限, 满了之后这个采集器的 put 阻塞(或者 Full),
+                     直到它的数据被取走, 不丢弃数据
+      quantum: 每一轮每个采集器最多取的条数
+    """
+
+    def __init__(self, maxsize=10000, quantum=100, per_collector=5000):
+        self.maxsize = maxsize
+        self.buffer = DrrBuffer(quantum, per_collector)
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+
+    def qsize(self):
+        return self.buffer.size
+
+    def empty(self):
+        return not self.buffer.size
+
+    def _full(self, name):
+        return (self.maxsize > 0 and self.buffer.size >= self.maxsize) or self.buffer.full(name)
+
+    def put(self, item, block=True, timeout=None):
+        name = item[0]
+        with self.not_full:
+            if self._full(name):
+                if not block:
+                    raise Full
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while self._full(name):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise Full
+                    self.not_full.wait(remaining)
+            self.buffer.push(item)
+            self.not_empty.notify()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        buffer = self.buffer
+        with self.not_empty:
+            if not block:
+                if not buffer.size:
+                    raise Empty
+            else:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not buffer.size:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+            item = buffer.pop()
+            # 等待的 put 可能在等不同采集器的子队列, 都唤醒后各自检查
+            self.not_full.notify_all()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""
+Python 采集器的 fork-server: 预先导入常用模块的常驻进程, 每次执行采集器时
+fork 一个子进程直接运行脚本, 省掉解释器启动和模块导入的开销
+
+子进程的 stdout/stderr 是监控进程创建的管道, 通过 SCM_RIGHTS 传给 fork-server,
+退出码由 fork-server 回收后通知监控进程, 语义与 subprocess.Popen 一致
+"""
+import importlib
+import json
+import logging
+import os
+import runpy
+import selectors
+import shutil
+import signal
+import socket
+import sys
+import time
+import traceback
+from fnmatch import fnmatchcase
+
+LOG = logging.getLogger('octopus')
+
+
+def is_python_collector(file_name, allowlist=()):
+    """
+    能否在 fork-server 里用 octopus 自己的解释器运行: shebang 指向的解释器就是
+    sys.executable 并且没有参数, 或者匹配 allowlist(路径或者文件名的通配符);
+    其他解释器、版本或者带参数(例如 -u, -O)的脚本都用 Popen 执行
+    """
+    name = os.path.basename(file_name)
+    if any(fnmatchcase(file_name, pattern) or fnmatchcase(name, pattern) for pattern in allowlist):
+        return True
+    try:
+        with open(file_name, "rb") as f:
+            first = f.readline(256)
+    except OSError:
+        return False
+    if not first.startswith(b"#!"):
+        return False
+    args = first[2:].decode("utf-8", "replace").split()
+    if args and os.path.basename(args[0]) == "env":
+        args = args[1:]
+        if len(args) != 1 or args[0].startswith("-"):
+            return False
+        interpreter = shutil.which(args[0])
+    elif len(args) == 1:
+        interpreter = args[0]
+    else:
+        return False
+    return interpreter is not None and _same_interpreter(interpreter)
+
+
+def _same_interpreter(interpreter):
+    """
+    同一个可执行文件, 并且在同一个目录下: virtualenv 里的 python 是系统 python 的符号链接,
+    但 sys.path 不同, 不能混用
+    """
+    interpreter = os.path.abspath(interpreter)
+    if os.path.dirname(interpreter) != os.path.dirname(os.path.abspath(sys.executable)):
+        return False
+    try:
+        return os.path.samefile(interpreter, sys.executable)
+    except OSError:
+        return False
+
+
+class ForkedProcess:
+    """
+    forked process
+
+    由 fork-server 创建的采集器进程, 提供采集器用到的 Popen 接口
+    """
+
+    def __init__(self, server, pid, stdout, stderr):
+        self.server: ForkServer = server
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self.usage = None  # (CPU 秒数, 最大 RSS 字节数), fork-server 回收时用 wait4 得到
+
+    def poll(self):
+        if self.returncode is None:
+            self.server.pump()
+            self.returncode = self.server.exits.pop(self.pid, None)
+            if self.returncode is not None:
+                self.usage = self.server.usages.pop(self.pid, None)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError("pid %d did not exit" % self.pid)
+            self.server.pump(0.05)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class ForkServer:
+    """
+    fork server
+    """
+
+    def __init__(self, preload=()):
+        self.preload = list(preload)
+        self.pid = None
+        self.sock: socket.socket = None
+        self.exits: dict = {}  # pid -> 退出码, 等待 ForkedProcess.poll 取走
+        self.usages: dict = {}  # pid -> (CPU 秒数, 最大 RSS 字节数)
+        self._next_id = 0
+
+    def start(self):
+        """需要在创建其他线程之前调用"""
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            parent.close()
+            code = 0
+            try:
+                _serve(child, self.preload)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        child.close()
+        self.pid = pid
+        self.sock = parent
+        LOG.info('fork server started (pid=%d), preloaded %s', pid, ", ".join(self.preload))
+
+    def alive(self):
+        return self.sock is not None
+
+    def spawn(self, file_name):
+        """
+        :return: ForkedProcess
+        """
+        if self.sock is None:
+            raise OSError("fork server is not running")
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        try:
+            self._next_id += 1
+            request_id = self._next_id
+            msg = json.dumps({"id": request_id, "file_name": file_name}).encode()
+            socket.send_fds(self.sock, [msg], [out_w, err_w])
+            pid = self._wait_spawned(request_id)
+        except OSError:
+            os.close(out_r)
+            os.close(err_r)
+            raise
+        finally:
+            os.close(out_w)
+            os.close(err_w)
+        return ForkedProcess(self, pid,
+                             os.fdopen(out_r, "rb", buffering=0),
+                             os.fdopen(err_r, "rb", buffering=0))
+
+    def _wait_spawned(self, request_id, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for msg in self._recv(deadline - time.monotonic()):
+                if msg["op"] == "spawned" and msg["id"] == request_id:
+                    if msg["pid"] < 0:
+                        raise OSError(msg.get("error", "fork failed"))
+                    return msg["pid"]
+        raise OSError("fork server did not answer")
+
+    def pump(self, timeout=0):
+        """读取 fork-server 发来的退出通知"""
+        if self.sock is not None:
+            for _ in self._recv(timeout):
+                pass
+
+    def _recv(self, timeout):
+        """最多等待 timeout 秒, 读取所有已经到达的消息"""
+        if timeout > 0:
+            self.sock.settimeout(timeout)
+        else:
+            self.sock.setblocking(False)
+        while self.sock is not None:
+            try:
+                data = self.sock.recv(4096)
+            except (BlockingIOError, socket.timeout):
+                return
+            if not data:
+                LOG.error('fork server (pid=%d) exited', self.pid)
+                self.sock.close()
+                self.sock = None
+                return
+            msg = json.loads(data)
+            if msg["op"] == "exit":
+                self.exits[msg["pid"]] = msg["status"]
+                if "cpu" in msg:
+                    self.usages[msg["pid"]] = (msg["cpu"], msg["max_rss"])
+            yield msg
+            # 收到第一条消息之后不再等待
+            if self.sock is not None:
+                self.sock.setblocking(False)
+
+    def stop(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def _serve(sock, preload):
+    """fork-server 进程的主循环"""
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print("fork server can not preload %s: %s" % (name, e), file=sys.stderr)
+
+    # 子进程退出时通过 wakeup fd 唤醒 select
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    sel = selectors.DefaultSelector()
+    sel.register(sock, selectors.EVENT_READ)
+    sel.register(wakeup_r, selectors.EVENT_READ)
+    while True:
+        for key, _ in sel.select(1):
+            if key.fileobj is sock:
+                try:
+                    msg, fds, _, _ = socket.recv_fds(sock, 4096, 2)
+                except InterruptedError:
+                    continue
+                if not msg:
+                    return  # 监控进程已经退出
+                request = json.loads(msg)
+                try:
+                    pid = os.fork()
+                except OSError as e:
+                    sock.send(json.dumps({"op": "spawned", "id": request["id"], "pid": -1,
+                                          "error": str(e)}).encode())
+                    for fd in fds:
+                        os.close(fd)
+                    continue
+                if pid == 0:
+                    sel.close()
+                    sock.close()
+                    os.close(wakeup_r)
+                    os.close(wakeup_w)
+                    _run_collector(request["file_name"], fds)
+                for fd in fds:
+                    os.close(fd)
+                sock.send(json.dumps({"op": "spawned", "id": request["id"], "pid": pid}).encode())
+            else:
+                try:
+                    while os.read(wakeup_r, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+        while True:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            sock.send(json.dumps({"op": "exit", "pid": pid,
+                                  "status": os.waitstatus_to_exitcode(status),
+                                  "cpu": rusage.ru_utime + rusage.ru_stime,
+                                  "max_rss": rusage.ru_maxrss * 1024}).encode())
+
+
+def _run_collector(file_name, fds):
+    """在 fork 出来的子进程里执行采集器脚本, 不会返回"""
+    code = 0
+    try:
+        signal.set_wakeup_fd(-1)
+        for sig in (signal.SIGCHLD, signal.SIGINT, signal.SIGTERM, signal.SIGPIPE):
+            signal.signal(sig, signal.SIG_DFL)
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1], 2)
+        for fd in (devnull, *fds):
+            os.close(fd)
+        sys.argv = [file_name]
+        sys.path[0] = os.path.dirname(os.path.abspath(file_name))
+        runpy.run_path(file_name, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+采集器输出的增量分行, 只保留最后一段不完整的行
+"""
+import logging
+
+LOG = logging.getLogger('octopus')
+
+
+class LineFramer:
+    """
+    line framer
+
+    每次 feed 的数据只会被拷贝常数次, 总开销与数据量成线性关系
+    """
+
+    def __init__(self, max_line_length=0):
+        self.max_line_length = max_line_length  # 单行最大字节数, 0 表示不限制
+        self.partial = bytearray()  # 最后一段还没有换行的数据
+        self.discarding = False  # 当前行已经超长, 丢弃到下一个换行为止
+        self.lines_oversized = 0
+
+    def feed(self, data):
+        """
+        :param data: bytes, 从管道读到的原始数据
+        :return: list of str, 完整的非空行
+        """
+        idx = data.rfind(b'\n')
+        if idx == -1:
+            self._append_partial(memoryview(data))
+            return []
+
+        view = memoryview(data)
+        if self.discarding:
+            # 跳过超长行剩余的部分
+            first = data.find(b'\n')
+            view = view[first + 1:]
+            self.discarding = False
+            if first == idx:
+                self._append_partial(view)
+                return []
+            idx -= first + 1
+
+        if self.partial:
+            self.partial += view[:idx]
+            block = bytes(self.partial)
+            self.partial.clear()
+        else:
+            block = bytes(view[:idx])
+        self._append_partial(view[idx + 1:])
+
+        if self.max_line_length:
+            # 按解码前的字节数判断, 多字节字符不能让超长行漏过去
+            limit = self.max_line_length
+            raw = block.split(b'\n')
+            kept = [line for line in raw if len(line) <= limit]
+            if len(kept) != len(raw):
+                self.lines_oversized += len(raw) - len(kept)
+                block = b'\n'.join(kept)
+        lines = block.decode('utf-8', 'replace').split('\n')
+        return [line for line in map(str.strip, lines) if line]
+
+    def flush(self):
+        """管道关闭时把最后一段没有换行的数据当成一行"""
+        line = b'' if self.discarding else bytes(self.partial)
+        self.partial.clear()
+        self.discarding = False
+        line = line.decode('utf-8', 'replace').strip()
+        return [line] if line else []
+
+    def _append_partial(self, view):
+        if self.discarding or not len(view):
+            return
+        if self.max_line_length and len(self.partial) + len(view) > self.max_line_length:
+            LOG.debug('dropping line longer than %d bytes', self.max_line_length)
+            self.lines_oversized += 1
+            self.partial.clear()
+            self.discarding = True
+            return
+        self.partial += view
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+进程内的 Python 插件采集器: plugins/<interval>/<name>.py 里定义一个带 collect()
+生成器的类, 在 octopus 的线程里执行, 不需要 fork/exec 和解释器启动
+
+    class LoadAvg:
+        timeout = 5  # 可选, 超时后停止这一次执行
+
+        def collect(self):
+            with open("/proc/loadavg") as f:
+                yield "proc.loadavg.1min %d %s" % (time.time(), f.read().split()[0])
+
+collect() 每次 yield 一行(或者一批行), 写入一个管道, 阅读端和子进程的 stdout 一样读取,
+所以后面的解析、去重、计数和发送与普通采集器完全相同. 类只在文件变化时重新载入,
+实例在多次执行之间保留, 可以保存上一次的计数器.
+插件抛出异常时退出码为 1, 异常写到 "stderr"; SystemExit(13) 表示不再执行
+
+collect() 不能阻塞: 超时只在两次 yield 之间检查, 线程也没有办法强制结束, 卡住的插件
+一直占用一个工作线程. 上一次执行的线程还没有返回(包括超时之后被放弃的)时不会再提交
+这个插件, 一个卡住的插件最多占用一个工作线程; 可能阻塞的采集应该写成普通的采集器
+"""
+import importlib.util
+import itertools
+import logging
+import os
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from octopus.comm.collector import Collector
+from octopus.settings import PLUGIN_TIMEOUT, PLUGIN_WORKERS
+
+LOG = logging.getLogger('octopus')
+
+_ids = itertools.count(1)
+
+
+class PluginCollector(Collector):
+    """
+    plugin collector
+
+    与 Collector 相同, proc 为 PluginProcess; 线程不能等待结束, shutdown 直接放弃这次执行
+    """
+    __slots__ = ()
+
+    def shutdown(self):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self.proc.kill()
+
+
+class PluginProcess:
+    """
+    plugin process
+
+    插件的一次执行, 提供采集器用到的 Popen 接口; stdout/stderr 是管道的读端.
+    线程没有办法强制结束: SIGTERM 让插件在下一次 yield 时停止, SIGKILL 直接放弃
+    这次执行, 卡住的线程之后写管道会失败退出
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.pid = -next(_ids)  # 不是真正的进程, 负数避免和进程号混淆
+        self.returncode = None
+        self.future = Future()  # 结果为退出码
+        self.cancelled = False
+        self.usage = None  # (线程的 CPU 秒数, None), 插件和 octopus 共用内存, 没有单独的 RSS
+        self.finished = False  # 线程已经返回, 被放弃时 returncode 已经有值但线程可能还卡着
+        stdout_r, self._stdout = os.pipe()
+        stderr_r, self._stderr = os.pipe()
+        self.stdout = os.fdopen(stdout_r, "rb", buffering=0)
+        self.stderr = os.fdopen(stderr_r, "rb", buffering=0)
+
+    def run(self, plugin, timeout):
+        """在工作线程里执行"""
+        status = 0
+        cpu = time.thread_time()
+        deadline = None if not timeout else time.monotonic() + timeout
+        try:
+            for item in plugin.collect():
+                if isinstance(item, (list, tuple)):
+                    data = "".join("%s\n" % line for line in item)
+                else:
+                    data = "%s\n" % item
+                _write(self._stdout, data.encode("utf-8"))
+                if self.cancelled:
+                    break
+                if deadline is not None and time.monotonic() > deadline:
+                    _write(self._stderr, b"timed out after %ds\n" % timeout)
+                    status = 1
+                    break
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except BrokenPipeError:
+            status = -signal.SIGKILL  # 已经被放弃
+        except Exception:
+            status = 1
+            try:
+                _write(self._stderr, traceback.format_exc().encode("utf-8"))
+            except OSError:
+                pass
+        finally:
+            os.close(self._stdout)
+            os.close(self._stderr)
+        self.usage = (time.thread_time() - cpu, None)
+        self._exit(status)
+        self.finished = True
+
+    def _exit(self, status):
+        if self.returncode is None:
+            self.returncode = status
+            self.future.set_result(status)
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        return self.future.result(timeout)
+
+    def send_signal(self, sig):
+        if self.returncode is not None:
+            return
+        self.cancelled = True
+        if sig == signal.SIGKILL:
+            LOG.warning('abandoning the thread of plugin %s', self.name)
+            self._exit(-signal.SIGKILL)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class PluginRunner:
+    """
+    plugin runner
+
+    载入插件并在线程池里执行; 常驻插件(interval 为 0)一直占用线程, 单独启动一个线程
+    """
+
+    def __init__(self, workers=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers or PLUGIN_WORKERS,
+                                           thread_name_prefix="plugin")
+        self.plugins: dict = {}  # 文件名 -> (m_time, 插件实例)
+        self.running: dict = {}  # 文件名 -> 最近一次提交的 PluginProcess
+
+    def load(self, col: PluginCollector):
+        cached = self.plugins.get(col.file_name)
+        if cached is not None and cached[0] == col.m_time:
+            return cached[1]
+        module_name = "octopus_plugin_%d_%s" % (col.interval, os.path.splitext(col.name)[0])
+        spec = importlib.util.spec_from_file_location(module_name, col.file_name)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        cls = next((obj for obj in vars(module).values()
+                    if isinstance(obj, type) and obj.__module__ == module_name
+                    and callable(getattr(obj, "collect", None))), None)
+        if cls is None:
+            raise ImportError("no class with a collect() method in {}".format(col.file_name))
+        plugin = cls()
+        self.plugins[col.file_name] = (col.m_time, plugin)
+        return plugin
+
+    def start(self, col: PluginCollector):
+        """
+        :return: PluginProcess
+        """
+        previous = self.running.get(col.file_name)
+        if previous is not None and not previous.finished:
+            # 上一次执行还占用着工作线程, 再提交只会让卡住的插件占满线程池
+            raise OSError("previous run of plugin {} has not returned yet".format(col.file_name))
+        try:
+            plugin = self.load(col)
+        except Exception as e:
+            raise OSError("can not load plugin {}: {}".format(col.file_name, e)) from e
+        proc = PluginProcess(col.name)
+        timeout = getattr(plugin, "timeout", None) or PLUGIN_TIMEOUT or col.interval
+        if col.interval:
+            self.executor.submit(proc.run, plugin, timeout)
+        else:
+            threading.Thread(target=proc.run, args=(plugin, None), name="plugin-%s" % col.name,
+                             daemon=True).start()
+        self.running[col.file_name] = proc
+        return proc
+
+    def forget(self, file_name):
+        self.plugins.pop(file_name, None)
+
+
+def is_plugin(file_name):
+    return file_name.endswith(".py")
+
+
+def _write(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+采集器限流: 每个采集器两个令牌桶(行数/字节数), 超出的行丢弃或者抽样保留
+"""
+import time
+
+from octopus.comm.telemetry import REGISTRY
+from octopus.settings import (COLLECTOR_MAX_BYTES_PER_SEC, COLLECTOR_MAX_LINES_PER_SEC,
+                              COLLECTOR_RATE_LIMITS, RATE_LIMIT_ACTION, RATE_LIMIT_BURST,
+                              RATE_LIMIT_SAMPLE)
+
+DROP = "drop"
+SAMPLE = "sample"
+
+
+class TokenBucket:
+    """
+    token bucket
+
+    每秒补充 rate 个令牌, 最多攒 burst 秒
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, burst=1.0):
+        self.rate = rate
+        self.capacity = rate * burst
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateLimits:
+    """
+    rate limits
+
+    由阅读端持有, 按采集器名称保存令牌桶; 采集器每次执行都会新建 Collector,
+    限流状态不能放在 Collector 上
+    """
+
+    def __init__(self, max_lines=0, max_bytes=0, overrides=None, burst=1.0, action=DROP, sample=10):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.overrides = overrides or {}  # 采集器名称 -> (行数/秒, 字节数/秒)
+        self.burst = burst
+        self.action = action
+        self.sample = max(1, sample)
+        self.buckets: dict = {}  # 采集器名称 -> (行数桶, 字节数桶, 超出的计数)
+
+    def enabled(self):
+        return bool(self.max_lines or self.max_bytes or self.overrides)
+
+    def _buckets(self, name):
+        buckets = self.buckets.get(name)
+        if buckets is None:
+            max_lines, max_bytes = self.overrides.get(name, (self.max_lines, self.max_bytes))
+            buckets = [TokenBucket(max_lines, self.burst) if max_lines else None,
+                       TokenBucket(max_bytes, self.burst) if max_bytes else None,
+                       0]
+            self.buckets[name] = buckets
+        return buckets
+
+    def forget(self, name):
+        self.buckets.pop(name, None)
+
+    def admit(self, name, lines):
+        """
+        :return: (允许通过的行, 丢弃的行数)
+        """
+        buckets = self._buckets(name)
+        line_bucket, byte_bucket, _ = buckets
+        if line_bucket is None and byte_bucket is None:
+            return lines, 0
+
+        now = time.monotonic()
+        if line_bucket is not None:
+            line_bucket.refill(now)
+        if byte_bucket is not None:
+            byte_bucket.refill(now)
+        admitted = []
+        dropped = sampled = 0
+        for line in lines:
+            size = len(line) + 1
+            if (line_bucket is None or line_bucket.tokens >= 1) \
+                    and (byte_bucket is None or byte_bucket.tokens >= size):
+                if line_bucket is not None:
+                    line_bucket.tokens -= 1
+                if byte_bucket is not None:
+                    byte_bucket.tokens -= size
+                admitted.append(line)
+                continue
+            # 超出限制
+            buckets[2] += 1
+            if self.action == SAMPLE and buckets[2] % self.sample == 0:
+                sampled += 1
+                admitted.append(line)
+            else:
+                dropped += 1
+        if dropped:
+            REGISTRY.counter("octopus_rate_limited_total", "lines over the collector's rate limit",
+                             collector=name, action="dropped").inc(dropped)
+        if sampled:
+            REGISTRY.counter("octopus_rate_limited_total", "lines over the collector's rate limit",
+                             collector=name, action="sampled").inc(sampled)
+        return admitted, dropped
+
+
+def default_rate_limits():
+    """按 settings 里的限流配置创建"""
+    return RateLimits(COLLECTOR_MAX_LINES_PER_SEC, COLLECTOR_MAX_BYTES_PER_SEC, COLLECTOR_RATE_LIMITS,
+                      RATE_LIMIT_BURST, RATE_LIMIT_ACTION, RATE_LIMIT_SAMPLE)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+子进程的回收与终止, 监控进程的循环不会因为某一个子进程阻塞
+
+- 回收: 每个子进程一个 pidfd, 注册到 Reaper 自己的 epoll, epoll 的 fd 再注册到
+  ChildrenCollector 的 waiter; 子进程退出时 pidfd 可读, 只对这些进程调用 poll()
+  (此时 waitpid 不会阻塞). 没有 pidfd 的进程(插件、旧内核)每次回收时 poll()
+- 资源: Popen 启动的子进程用 wait4 回收, 同时得到 CPU 时间和最大 RSS;
+  fork-server 与插件的进程对象自己带 usage
+- 终止: SIGTERM -> 等待 grace 秒 -> SIGKILL, 按到期时间推进, 不 sleep;
+  采集器用 setsid 启动, 信号发给整个进程组, 采集器自己启动的子进程也一起结束
+"""
+import heapq
+import itertools
+import logging
+import os
+import selectors
+import signal
+import subprocess
+import time
+
+from octopus.comm.telemetry import REGISTRY
+from octopus.settings import TERMINATE_GRACE
+
+LOG = logging.getLogger('octopus')
+
+TERM = 1  # 已经发送 SIGTERM, 与 Collector.kill_state 相同
+KILL = 2  # 已经发送 SIGKILL
+
+
+def signal_group(proc, sig):
+    """给采集器的进程组发送信号; 插件等没有真实进程号的交给 proc.send_signal"""
+    if proc.pid <= 0:
+        proc.send_signal(sig)
+        return
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+    except PermissionError:
+        # 进程组已经不是采集器启动时的那一个, 只给进程本身发送
+        proc.send_signal(sig)
+
+
+class Reaper:
+    """
+    reaper
+
+    watch 登记子进程, reap 返回已经退出的 (采集器, 进程, 退出码), terminate 开始终止;
+    被替换或者移除的采集器的进程同样在这里回收, 不会留下僵尸进程
+    """
+
+    def __init__(self, grace=None):
+        self.grace = TERMINATE_GRACE if grace is None else grace
+        self.selector = selectors.DefaultSelector()
+        self.use_pidfd = hasattr(os, "pidfd_open")
+        self.pidfds: dict = {}  # proc -> pidfd
+        self.polled: dict = {}  # 没有 pidfd 的 proc -> 采集器
+        self.dying: dict = {}  # proc -> (采集器, 状态, 到期时间)
+        self.deadlines = []  # (到期时间, 序号, proc), 惰性删除
+        self._counter = itertools.count()
+        self.kills = {state: REGISTRY.counter("octopus_collector_kills_total",
+                                              "signals sent to overdue collectors", signal=sig)
+                      for state, sig in ((TERM, "SIGTERM"), (KILL, "SIGKILL"))}
+
+    def fileno(self):
+        """子进程退出时可读, 没有 epoll 时为 None"""
+        try:
+            return self.selector.fileno()
+        except AttributeError:
+            return None
+
+    def __len__(self):
+        return len(self.pidfds) + len(self.polled)
+
+    def watch(self, proc, col):
+        if hasattr(proc, "pidfd"):
+            # 升级时接管的进程自带 pidfd, 已经退出的为 None; 不是本进程的子进程, 不能再 pidfd_open
+            if proc.pidfd is not None:
+                pidfd = os.dup(proc.pidfd)
+                self.pidfds[proc] = pidfd
+                self.selector.register(pidfd, selectors.EVENT_READ, (proc, col))
+            else:
+                self.polled[proc] = col
+            return
+        if self.use_pidfd and proc.pid > 0:
+            try:
+                pidfd = os.pidfd_open(proc.pid)
+            except ProcessLookupError:
+                pass  # 已经退出并被回收(fork-server 的子进程), 交给 poll()
+            except OSError as e:
+                # 内核不支持 pidfd, 之后都用 poll()
+                LOG.info('pidfd_open is not available, polling children: %s', e)
+                self.use_pidfd = False
+            else:
+                self.pidfds[proc] = pidfd
+                self.selector.register(pidfd, selectors.EVENT_READ, (proc, col))
+                return
+        self.polled[proc] = col
+
+    def unwatch(self, proc):
+        self._close_pidfd(proc)
+        self.polled.pop(proc, None)
+        self.dying.pop(proc, None)
+
+    def _close_pidfd(self, proc):
+        pidfd = self.pidfds.pop(proc, None)
+        if pidfd is not None:
+            self.selector.unregister(pidfd)
+            os.close(pidfd)
+
+    def reap(self, now=None):
+        """
+        :return: list of (采集器, proc, 退出码, usage), usage 为 (CPU 秒数, 最大 RSS 字节数)
+            或者 None, 同时推进到期的终止
+        """
+        exited = []
+        if self.pidfds:
+            for key, _ in self.selector.select(0):
+                proc, col = key.data
+                status, usage = self._wait(proc)
+                if status is None:
+                    # fork-server 的子进程: 进程已经退出, 退出码还在路上, 改为 poll()
+                    self._close_pidfd(proc)
+                    self.polled[proc] = col
+                    continue
+                exited.append((col, proc, status, usage))
+        for proc, col in list(self.polled.items()):
+            status, usage = self._wait(proc)
+            if status is not None:
+                exited.append((col, proc, status, usage))
+        for col, proc, status, usage in exited:
+            self.unwatch(proc)
+        self.advance(time.time() if now is None else now)
+        return exited
+
+    @staticmethod
+    def _wait(proc):
+        """不阻塞地回收, :return: (退出码, usage), 还没有退出时退出码为 None"""
+        if not isinstance(proc, subprocess.Popen) or proc.returncode is not None:
+            status = proc.poll()
+            return status, getattr(proc, "usage", None)
+        try:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        except ChildProcessError:
+            return proc.poll(), None  # 已经被别的地方回收
+        if pid == 0:
+            return None, None
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        return proc.returncode, (rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss * 1024)
+
+    def terminate(self, proc, col, now=None):
+        """发送 SIGTERM, grace 秒后还没有退出再 SIGKILL; 已经在终止中的不重复发送"""
+        if proc is None or proc in self.dying or proc.poll() is not None:
+            return
+        if proc not in self.pidfds and proc not in self.polled:
+            self.watch(proc, col)  # 没有经过 watch 的进程也要回收
+        now = time.time() if now is None else now
+        signal_group(proc, signal.SIGTERM)
+        self.kills[TERM].inc()
+        self._schedule(proc, col, TERM, now + self.grace)
+
+    def advance(self, now):
+        while self.deadlines and self.deadlines[0][0] <= now:
+            due, _, proc = heapq.heappop(self.deadlines)
+            entry = self.dying.get(proc)
+            if entry is None or entry[2] != due:
+                continue  # 已经退出或者重新登记过
+            col, state, _ = entry
+            if state == TERM:
+                LOG.error('error: %s (pid=%d) still not dead %ds after SIGTERM, SIGKILL sent',
+                          col.name, proc.pid, self.grace)
+                signal_group(proc, signal.SIGKILL)
+                self.kills[KILL].inc()
+                self._schedule(proc, col, KILL, now + self.grace)
+            else:
+                LOG.error('error: %s (pid=%d) needs manual intervention to kill it',
+                          col.name, proc.pid)
+                self._schedule(proc, col, KILL, now + 300)
+
+    def _schedule(self, proc, col, state, due):
+        self.dying[proc] = (col, state, due)
+        col.kill_state = state
+        col.next_kill = due
+        heapq.heappush(self.deadlines, (due, next(self._counter), proc))
+
+    def next_deadline(self):
+        """下一次需要推进终止的时间, 没有进程在轮询或终止时返回 None"""
+        if self.polled:
+            return time.time() + 1  # 没有 pidfd 的进程至少每秒检查一次
+        return self.deadlines[0][0] if self.deadlines else None
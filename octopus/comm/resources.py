@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""
+采集器的资源统计与按负载调整采集间隔
+
+- 统计: 周期采集器退出时 Reaper 用 wait4 得到 CPU 时间和最大 RSS(fork-server 的子进程由
+  fork-server 回收后转发, 插件记录线程的 CPU 时间); 常驻采集器每 RESOURCE_SAMPLE_INTERVAL
+  秒读一次 /proc/<pid>/stat. 按采集器名称保留最近 RESOURCE_HISTORY 次执行,
+  采集器重新执行之后不会丢失
+- 调整: 见 Throttle, 默认关闭
+"""
+import logging
+import os
+import time
+from collections import deque
+from fnmatch import fnmatchcase
+
+from octopus.comm.telemetry import REGISTRY
+from octopus.settings import (RESOURCE_HISTORY, RESOURCE_SAMPLE_INTERVAL, THROTTLE_CHECK_INTERVAL,
+                              THROTTLE_CPU_BUDGET, THROTTLE_LOAD_PER_CPU, THROTTLE_MAX_FACTOR,
+                              THROTTLE_PROTECTED, THROTTLE_RESTORE_RATIO)
+
+LOG = logging.getLogger('octopus')
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def read_stat(pid, children=True):
+    """
+    :param children: 是否包括已经回收的子进程
+    :return: (CPU 秒数, RSS 字节数), 进程不存在时为 None
+    """
+    try:
+        with open("/proc/%d/stat" % pid, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    # 进程名可能包含空格和括号, 从最后一个 ')' 之后开始分割
+    fields = data[data.rfind(b")") + 2:].split()
+    ticks = int(fields[11]) + int(fields[12])
+    if children:
+        ticks += int(fields[13]) + int(fields[14])
+    return ticks / CLK_TCK, int(fields[21]) * PAGE_SIZE
+
+
+class Usage:
+    """一个采集器的统计"""
+    __slots__ = ("runs", "cost", "max_rss", "sample")
+
+    def __init__(self, history):
+        self.runs = deque(maxlen=history)  # (CPU 秒数, 最大 RSS 字节数, 耗时秒数), 拿不到的为 None
+        self.cost = None  # 按原始间隔执行时每秒用掉的 CPU 秒数
+        self.max_rss = None
+        self.sample = None  # 常驻采集器上一次采样的 (pid, CPU 秒数, 时间)
+
+    def mean(self, index):
+        values = [run[index] for run in self.runs if run[index] is not None]
+        return sum(values) / len(values) if values else None
+
+
+class ResourceUsage:
+    """
+    resource usage
+
+    由监控进程持有; finished 记录一次执行, maybe_sample 采样常驻采集器,
+    take_cpu 取出上一次之后所有采集器用掉的 CPU 秒数, 给 Throttle 计算 CPU 预算
+    """
+
+    def __init__(self, history=None, sample_interval=None):
+        self.history = history or RESOURCE_HISTORY
+        self.sample_interval = RESOURCE_SAMPLE_INTERVAL if sample_interval is None else sample_interval
+        self.usage: dict = {}  # 采集器名称 -> Usage
+        self.window_cpu = 0.0
+        self.next_sample = 0
+
+    def get(self, name):
+        usage = self.usage.get(name)
+        if usage is None:
+            usage = self.usage[name] = Usage(self.history)
+        return usage
+
+    def cost(self, name):
+        usage = self.usage.get(name)
+        return usage.cost if usage is not None else None
+
+    def forget(self, name):
+        self.usage.pop(name, None)
+
+    def finished(self, col, proc, rusage, now=None):
+        """
+        一次执行结束
+        :param rusage: (CPU 秒数, 最大 RSS 字节数) 或者 None
+        """
+        now = time.time() if now is None else now
+        usage = self.get(col.name)
+        cpu, max_rss = rusage if rusage is not None else (None, None)
+        usage.runs.append((cpu, max_rss, now - col.last_spawn if col.last_spawn else None))
+        if max_rss is not None:
+            usage.max_rss = max(usage.max_rss or 0, max_rss)
+        if cpu is None:
+            return
+        sample = usage.sample
+        if col.interval:
+            self.window_cpu += cpu
+            usage.cost = usage.mean(0) / col.interval
+        elif sample is not None and sample[0] == proc.pid:
+            self.window_cpu += max(0.0, cpu - sample[1])  # 采样之前的部分已经计入
+        else:
+            self.window_cpu += cpu
+        usage.sample = None
+
+    def maybe_sample(self, collection_dict, now=None):
+        now = time.time() if now is None else now
+        if not self.sample_interval or now < self.next_sample:
+            return
+        self.next_sample = now + self.sample_interval
+        for col in list(collection_dict.values()):
+            if not col.interval and col.proc is not None and col.proc.pid > 0:
+                self.sample(col, now)
+
+    def sample(self, col, now):
+        stat = read_stat(col.proc.pid)
+        if stat is None:
+            return
+        cpu, rss = stat
+        usage = self.get(col.name)
+        usage.max_rss = max(usage.max_rss or 0, rss)
+        sample = usage.sample
+        if sample is not None and sample[0] == col.proc.pid and now > sample[2]:
+            delta = max(0.0, cpu - sample[1])
+            self.window_cpu += delta
+            rate = delta / (now - sample[2])
+            # 平滑一下, 一次采样的突发不会马上触发调整
+            usage.cost = rate if usage.cost is None else (usage.cost + rate) / 2
+        usage.sample = (col.proc.pid, cpu, now)
+
+    def take_cpu(self):
+        cpu, self.window_cpu = self.window_cpu, 0.0
+        return cpu
+
+    def stats(self, throttle=None):
+        """每个采集器的资源统计, 给 Registry.add_collector 使用"""
+
+        def collect():
+            for name, usage in list(self.usage.items()):
+                labels = {"collector": name}
+                for metric, help_text, value in (
+                        ("octopus_collector_cpu_seconds", "mean CPU seconds per run", usage.mean(0)),
+                        ("octopus_collector_wall_seconds", "mean wall time per run", usage.mean(2)),
+                        ("octopus_collector_max_rss_bytes", "largest resident set size seen",
+                         usage.max_rss),
+                        ("octopus_collector_cpu_ratio", "CPU seconds per second at the configured interval",
+                         usage.cost)):
+                    if value is not None:
+                        yield metric, "gauge", help_text, labels, value
+                if throttle is not None:
+                    yield ("octopus_collector_interval_factor", "gauge",
+                           "interval multiplier applied under load", labels, throttle.factor(name))
+
+        return collect
+
+
+class Throttle:
+    """
+    throttle
+
+    每 check_interval 秒计算压力: 每 CPU 的 1 分钟负载与 load_per_cpu 之比, octopus 自身(监控进程
+    和 workers 返回的工作进程)加上采集器用掉的 CPU(核数)与 cpu_budget 之比, 取较大的一个. 压力超过 1 时把当前最耗 CPU 的
+    周期采集器(不在 protected 里)的间隔加倍, 最多 max_factor 倍; 低于 restore_ratio 时
+    按后拉长先恢复的顺序把一个采集器的间隔减半. 每次检查最多调整一个, 避免来回震荡
+    """
+
+    def __init__(self, usage, load_per_cpu=None, cpu_budget=None, restore_ratio=None,
+                 max_factor=None, check_interval=None, protected=None, workers=None):
+        self.usage: ResourceUsage = usage
+        # 返回 octopus 工作进程(阅读/发送进程、fork-server)的 pid, 不是监控进程的子线程, os.times 不包括
+        self.workers = workers or (lambda: ())
+        self.worker_cpu: dict = {}  # pid -> 上一次检查时的 CPU 秒数
+        self.load_per_cpu = load_per_cpu or THROTTLE_LOAD_PER_CPU
+        self.cpu_budget = cpu_budget or THROTTLE_CPU_BUDGET
+        self.restore_ratio = restore_ratio or THROTTLE_RESTORE_RATIO
+        self.max_factor = max_factor or THROTTLE_MAX_FACTOR
+        self.check_interval = check_interval or THROTTLE_CHECK_INTERVAL
+        self.protected = THROTTLE_PROTECTED if protected is None else protected
+        self.factors: dict = {}  # 采集器名称 -> 间隔的倍数
+        self.stretched = []  # 被拉长的采集器名称, 按拉长的顺序
+        self.next_check = 0
+        self.last = None  # (时间, octopus 自身的 CPU 秒数)
+        self.pressure = 0.0
+        REGISTRY.gauge("octopus_throttle_pressure", "host load or CPU budget ratio, above 1 stretches intervals",
+                       fn=lambda: self.pressure)
+        REGISTRY.gauge("octopus_throttled_collectors", "collectors running at a stretched interval",
+                       fn=lambda: len(self.factors))
+
+    def factor(self, name):
+        return self.factors.get(name, 1)
+
+    def measure(self, now):
+        load = os.getloadavg()[0] / (os.cpu_count() or 1) / self.load_per_cpu
+        times = os.times()
+        own = times.user + times.system  # 不包括子进程, 采集器的 CPU 由 ResourceUsage 统计
+        workers = self._workers_cpu()
+        collectors = self.usage.take_cpu()
+        cpu = 0.0
+        if self.last is not None and now > self.last[0]:
+            cpu = (own - self.last[1] + workers + collectors) / (now - self.last[0]) / self.cpu_budget
+        self.last = (now, own)
+        return max(load, cpu)
+
+    def _workers_cpu(self):
+        """工作进程从上一次检查之后用掉的 CPU 秒数; 不包括回收的子进程, fork-server 回收的采集器已经计入"""
+        delta = 0.0
+        current = {}
+        for pid in self.workers():
+            stat = read_stat(pid, children=False)
+            if stat is None:
+                continue
+            current[pid] = stat[0]
+            delta += max(0.0, stat[0] - self.worker_cpu.get(pid, 0.0))  # 新的(重启的)进程从 0 开始
+        self.worker_cpu = current
+        return delta
+
+    def maybe_check(self, collection_dict, now=None):
+        """
+        :return: 间隔发生变化的采集器
+        """
+        now = time.time() if now is None else now
+        if now < self.next_check:
+            return []
+        self.next_check = now + self.check_interval
+        self.pressure = self.measure(now)
+        if self.pressure > 1:
+            col = self._most_expensive(collection_dict)
+            if col is None:
+                return []
+            self.factors[col.name] = self.factor(col.name) * 2
+            if col.name in self.stretched:
+                self.stretched.remove(col.name)
+            self.stretched.append(col.name)
+            LOG.warning('pressure %.2f, %s interval stretched to %ds', self.pressure, col.name,
+                        col.interval * self.factors[col.name])
+            return [col]
+        if self.pressure < self.restore_ratio and self.stretched:
+            name = self.stretched[-1]
+            factor = self.factors[name] // 2
+            if factor > 1:
+                self.factors[name] = factor
+            else:
+                del self.factors[name]
+                self.stretched.pop()
+            col = collection_dict.get(name)
+            if col is None:
+                return []
+            LOG.info('pressure %.2f, %s interval restored to %ds', self.pressure, name,
+                     col.interval * self.factor(name))
+            return [col]
+        return []
+
+    def _most_expensive(self, collection_dict):
+        best, best_cost = None, 0.0
+        for col in collection_dict.values():
+            if not col.interval or col.dead or self.factor(col.name) >= self.max_factor:
+                continue
+            if any(fnmatchcase(col.name, pattern) for pattern in self.protected):
+                continue
+            cost = self.usage.cost(col.name)
+            if cost is None:
+                continue
+            cost /= self.factor(col.name)  # 按当前的间隔实际用掉的 CPU
+            if cost > best_cost:
+                best, best_cost = col, cost
+        return best
+
+    def forget(self, name):
+        self.factors.pop(name, None)
+        if name in self.stretched:
+            self.stretched.remove(name)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+阅读端的预聚合: 按 ROLLUP_RULES 把匹配的序列在固定的时间窗口内聚合,
+窗口结束后只发送 count/sum/min/max/last 与近似分位数(DDSketch), 不再发送原始数据
+"""
+import math
+import re
+from fnmatch import fnmatchcase
+
+from octopus.comm.datapoint import DataPoint
+from octopus.comm.telemetry import REGISTRY
+from octopus.settings import (ROLLUP_GRACE, ROLLUP_MAX_SERIES, ROLLUP_RULES, ROLLUP_SKETCH_ACCURACY,
+                              ROLLUP_SKETCH_MAX_BINS)
+
+AGGREGATES = ("count", "sum", "min", "max", "last")
+QUANTILE = re.compile(r"^p(\d{1,2}(?:\.\d+)?)$")  # p50, p99, p99.9
+
+
+class DDSketch:
+    """
+    DDSketch
+
+    按对数分桶的分位数草图, 相对误差不超过 accuracy; 桶数超过 max_bins 时
+    合并最小的桶, 内存有上限, 只有最小的分位数会失去精度
+    """
+    __slots__ = ("gamma", "log_gamma", "max_bins", "positive", "negative", "zero", "count")
+
+    def __init__(self, accuracy=0.01, max_bins=512):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.positive: dict = {}  # 桶序号 -> 次数
+        self.negative: dict = {}  # 负数按绝对值分桶
+        self.zero = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value > 0:
+            store = self.positive
+        elif value < 0:
+            store = self.negative
+            value = -value
+        else:
+            self.zero += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        store[key] = store.get(key, 0) + 1
+        if len(store) > self.max_bins:
+            low = min(store)
+            count = store.pop(low)
+            nxt = min(store)
+            store[nxt] += count
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive))
+
+
+class Window:
+    """一个序列当前窗口的聚合状态"""
+    __slots__ = ("start", "count", "total", "min", "max", "last", "sketch")
+
+    def __init__(self, start, sketch):
+        self.start = start
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.last = 0.0
+        self.sketch: DDSketch = sketch
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.last = value
+        if self.sketch is not None:
+            self.sketch.add(value)
+
+
+class Rule:
+    """
+    rule
+
+    collector 与 metric 是 fnmatch 的通配符, window 为秒, aggregates 为
+    count/sum/min/max/last 和 pNN
+    """
+    __slots__ = ("collector", "metric", "window", "aggregates", "quantiles")
+
+    def __init__(self, collector="*", metric="*", window=60, aggregates=AGGREGATES):
+        self.collector = collector
+        self.metric = metric
+        self.window = int(window)
+        self.aggregates = []
+        self.quantiles = False
+        for name in aggregates:
+            match = QUANTILE.match(name)
+            if match is not None:
+                self.aggregates.append((name, float(match.group(1)) / 100))
+                self.quantiles = True
+            elif name in AGGREGATES:
+                self.aggregates.append((name, None))
+            else:
+                raise ValueError("unknown rollup aggregate {}".format(name))
+        if self.window <= 0:
+            raise ValueError("rollup window must be positive")
+
+    def matches(self, collector, metric):
+        return fnmatchcase(collector, self.collector) and fnmatchcase(metric, self.metric)
+
+
+class Series:
+    """一个序列的规则、当前窗口和已经发送的最后一个窗口"""
+    __slots__ = ("rule", "window", "closed")
+
+    def __init__(self, rule):
+        self.rule: Rule = rule
+        self.window: Window = None
+        self.closed = -1  # 已经发送的最后一个窗口的开始时间, 之后早于它的数据丢弃
+
+
+class Rollup:
+    """
+    rollup
+
+    由阅读端持有: add 把匹配规则的数据点放进窗口, 其余的原样返回;
+    flush 发送结束超过 grace 秒的窗口. 序列数达到 max_series 后新的序列不再聚合
+    """
+
+    def __init__(self, rules=None, max_series=None, grace=None, accuracy=None, max_bins=None):
+        if rules is None:
+            rules = ROLLUP_RULES
+        self.rules = [rule if isinstance(rule, Rule) else Rule(**rule) for rule in rules]
+        self.max_series = max_series or ROLLUP_MAX_SERIES
+        self.grace = ROLLUP_GRACE if grace is None else grace
+        self.accuracy = accuracy or ROLLUP_SKETCH_ACCURACY
+        self.max_bins = max_bins or ROLLUP_SKETCH_MAX_BINS
+        self.series: dict = {}  # (采集器名称, metric, tags) -> Series
+        self.matched: dict = {}  # (采集器名称, metric) -> Rule or None
+        self.next_flush = math.inf  # 最早可以发送的窗口的时间
+        self.pending = []  # 已经结束等待发送的窗口
+        self.points_in = REGISTRY.counter("octopus_rollup_points_total", "datapoints folded into rollups")
+        self.points_out = REGISTRY.counter("octopus_rollup_emitted_total", "rollup datapoints emitted")
+        self.late = REGISTRY.counter("octopus_rollup_late_total",
+                                     "datapoints dropped because their window was already emitted")
+        self.invalid = REGISTRY.counter("octopus_rollup_invalid_total",
+                                        "datapoints dropped because their value is not finite")
+        self.overflow = REGISTRY.counter("octopus_rollup_overflow_total",
+                                         "datapoints passed through because max_series was reached")
+        REGISTRY.gauge("octopus_rollup_series", "series with rollup state", fn=lambda: len(self.series))
+
+    def enabled(self):
+        return bool(self.rules)
+
+    def _rule(self, collector, metric):
+        key = (collector, metric)
+        try:
+            return self.matched[key]
+        except KeyError:
+            pass
+        if len(self.matched) >= self.max_series * 4:
+            self.matched.clear()  # 大量不聚合的 metric 时限制缓存的大小
+        rule = next((r for r in self.rules if r.matches(collector, metric)), None)
+        self.matched[key] = rule
+        return rule
+
+    def add(self, collector, points):
+        """
+        :return: 不需要聚合的数据点
+        """
+        passthrough = []
+        folded = 0
+        for dp in points:
+            if not isinstance(dp, DataPoint):
+                passthrough.append(dp)
+                continue
+            rule = self._rule(collector, dp.metric)
+            if rule is None:
+                passthrough.append(dp)
+                continue
+            value = float(dp.value)
+            if not math.isfinite(value):
+                # inf 让 DDSketch 的 log 溢出, nan 无法格式化
+                self.invalid.inc()
+                continue
+            key = (collector, dp.metric, dp.tags)
+            series = self.series.get(key)
+            if series is None:
+                if len(self.series) >= self.max_series:
+                    self.overflow.inc()
+                    passthrough.append(dp)
+                    continue
+                series = self.series[key] = Series(rule)
+            start = dp.timestamp - dp.timestamp % rule.window
+            window = series.window
+            if window is None or start > window.start:
+                if start <= series.closed:
+                    self.late.inc()
+                    continue
+                if window is not None:
+                    # 新窗口的数据到了, 上一个窗口不会再有数据
+                    self._emit(key, series)
+                window = series.window = Window(
+                    start, DDSketch(self.accuracy, self.max_bins) if rule.quantiles else None)
+                self.next_flush = min(self.next_flush, start + rule.window + self.grace)
+            elif start < window.start:
+                self.late.inc()
+                continue
+            window.add(value)
+            folded += 1
+        if folded:
+            self.points_in.inc(folded)
+        return passthrough
+
+    def next_timeout(self, now):
+        """距离下一个窗口可以发送的秒数, 没有窗口时为 None"""
+        if self.pending:
+            return 0.0
+        if self.next_flush == math.inf:
+            return None
+        return max(0.0, self.next_flush - now)
+
+    def _emit(self, key, series):
+        self.pending.append((key, series.rule, series.window))
+        series.closed = series.window.start
+        series.window = None
+
+    def flush(self, now):
+        """
+        :return: list of (采集器名称, DataPoint)
+        """
+        if now >= self.next_flush:
+            self.next_flush = math.inf
+            for key, series in list(self.series.items()):
+                window = series.window
+                rule = series.rule
+                if window is None:
+                    if series.closed + 10 * rule.window < now:
+                        del self.series[key]  # 长时间没有数据的序列
+                    continue
+                due = window.start + rule.window + self.grace
+                if due <= now:
+                    self._emit(key, series)
+                else:
+                    self.next_flush = min(self.next_flush, due)
+
+        pending, self.pending = self.pending, []
+        if not pending:
+            return []
+        out = []
+        for (collector, metric, tags), rule, window in pending:
+            for name, q in rule.aggregates:
+                if q is not None:
+                    # 近似值, 不超出窗口的最小/最大值, 也不需要更多的位数
+                    value = "%.6g" % min(max(window.sketch.quantile(q), window.min), window.max)
+                elif name == "count":
+                    value = str(window.count)
+                elif name == "sum":
+                    value = _format(window.total)
+                else:
+                    value = _format(getattr(window, name))
+                out.append((collector, DataPoint("%s.%s" % (metric, name), window.start, value, tags)))
+        self.points_out.inc(len(out))
+        return out
+
+
+def _format(value):
+    if math.isfinite(value) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
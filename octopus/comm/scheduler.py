@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+基于最小堆的定时调度: 采集器的执行、不活跃检测都登记为到期时间,
+每次只处理已经到期的事件, 不再每个周期遍历所有采集器
+"""
+import heapq
+import itertools
+import time
+
+SPAWN = "spawn"
+INACTIVITY = "inactivity"
+
+
+class Scheduler:
+    """
+    scheduler
+
+    每种事件一个堆, 元素为 (到期时间, 序号, 采集器); 采集器状态变化后旧的元素不删除,
+    由调用方在弹出时判断是否已经过期(惰性删除)
+    """
+
+    def __init__(self):
+        self.heaps = {SPAWN: [], INACTIVITY: []}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return sum(len(h) for h in self.heaps.values())
+
+    def schedule(self, kind, due, col):
+        heapq.heappush(self.heaps[kind], (due, next(self._counter), col))
+
+    def pop_due(self, kind, now=None):
+        """弹出所有到期的事件, 每个 O(log n)"""
+        if now is None:
+            now = time.time()
+        heap = self.heaps[kind]
+        events = []
+        while heap and heap[0][0] <= now:
+            due, _, col = heapq.heappop(heap)
+            events.append((due, col))
+        return events
+
+    def next_deadline(self):
+        """最近一个事件的到期时间, 没有事件时返回 None"""
+        tops = [h[0][0] for h in self.heaps.values() if h]
+        return min(tops) if tops else None
+
+
+class LoopScheduler:
+    """
+    loop scheduler
+
+    与 Scheduler 相同的 schedule 接口, 事件交给 asyncio 事件循环的定时器(同样是最小堆),
+    到期时调用 handlers[kind](due, col, now)
+    """
+
+    def __init__(self, loop, handlers):
+        self.loop = loop
+        self.handlers = handlers
+
+    def schedule(self, kind, due, col):
+        self.loop.call_later(max(0.0, due - time.time()), self._fire, kind, due, col)
+
+    def _fire(self, kind, due, col):
+        self.handlers[kind](due, col, time.time())
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+发送端公共逻辑: 中间件链与按数量/时间攒批
+"""
+import asyncio
+import logging
+import queue
+import time
+from pydoc import locate
+
+from octopus.comm.telemetry import REGISTRY
+from octopus.settings import SEND_MIDDLEWARES, SENDER_RETRY_BACKOFF, SENDER_RETRY_BACKOFF_MAX
+
+LOG = logging.getLogger('octopus')
+
+
+class MiddlewareChain:
+    """
+    middleware chain
+
+    中间件只实例化一次, 按 SEND_MIDDLEWARES 里的优先级从小到大依次调用,
+    优先级为 None 的中间件不启用
+    """
+
+    def __init__(self, middlewares=None):
+        if middlewares is None:
+            middlewares = SEND_MIDDLEWARES
+        self.middlewares = []
+        self.stats = {}  # 每个中间件的发送条数/失败次数/耗时
+        enabled = [(k, v) for k, v in middlewares.items() if v is not None]
+        for path, _ in sorted(enabled, key=lambda kv: kv[1]):
+            cls = locate(path)
+            if cls is None:
+                LOG.error('send middleware %s not found', path)
+                continue
+            self.add(cls())
+
+    def add(self, obj):
+        """在最后追加一个已经创建的中间件"""
+        name = type(obj).__name__
+        self.middlewares.append(obj)
+        self.stats[id(obj)] = (
+            REGISTRY.counter("octopus_sink_lines_total", "lines handed to the middleware",
+                             middleware=name),
+            REGISTRY.counter("octopus_sink_errors_total", "failed middleware calls",
+                             middleware=name),
+            REGISTRY.histogram("octopus_sink_seconds", "time spent in the middleware per batch",
+                               middleware=name),
+        )
+
+    def send_batch(self, batch, middlewares=None):
+        """
+        把一批数据交给每一个中间件, 中间件没有 send_batch 时逐条调用 send
+        :param batch: list of (collector name, DataPoint or line[, read time])
+        :param middlewares: 只交给这些中间件(重试时使用), None 表示全部
+        :return: 发送失败的中间件, 全部成功时为空列表
+        """
+        collectors = [item[0] for item in batch]
+        lines = [str(item[1]) for item in batch]
+        return [obj for obj in (self.middlewares if middlewares is None else middlewares)
+                if not self._send_sync(obj, lines, collectors)]
+
+    def deliver(self, batch):
+        """
+        发送一批数据直到所有中间件都成功: 失败的中间件按指数退避重试, 成功的不会重复发送.
+        返回之后队列才能 ack, 磁盘里的分段在此之前不会删除
+        :param batch: list of (collector name, DataPoint or line[, read time])
+        :return:
+        """
+        failed = self.send_batch(batch)
+        backoff = SENDER_RETRY_BACKOFF
+        while failed:
+            self._retrying(batch, failed, backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, SENDER_RETRY_BACKOFF_MAX)
+            failed = self.send_batch(batch, failed)
+
+    def _retrying(self, batch, failed, backoff):
+        REGISTRY.counter("octopus_sender_retries_total", "batches retried because a middleware failed").inc()
+        LOG.warning('retrying %d lines for %s in %.1fs', len(batch),
+                    ", ".join(type(obj).__name__ for obj in failed), backoff)
+
+    def _send_sync(self, obj, lines, collectors):
+        sent, errors, seconds = self.stats[id(obj)]
+        start = time.monotonic()
+        ok = True
+        try:
+            send_batch = getattr(obj, "send_batch", None)
+            if send_batch is not None:
+                send_batch(lines, collectors=collectors)
+            else:
+                for name, line in zip(collectors, lines):
+                    obj.send(line, collector=name)
+            sent.inc(len(lines))
+        except Exception as e:
+            ok = False
+            errors.inc()
+            LOG.error('%s failed to send %d lines: %s', type(obj).__name__, len(lines), e)
+        seconds.record(time.monotonic() - start)
+        return ok
+
+    def flush(self, timeout=0):
+        """
+        发送端空闲时调用: 中间件有 flush 时调用一次, timeout=0 表示不等待投递结果,
+        例如文件中间件按时间换分段、网络中间件收取在途的响应
+        :return: 中间件里还没有确认投递的数据条数, flush 失败的中间件算一条
+        """
+        remaining = 0
+        for obj in self.middlewares:
+            flush = getattr(obj, "flush", None)
+            if flush is None:
+                continue
+            try:
+                remaining += flush(timeout=timeout) or 0
+            except Exception as e:
+                LOG.error('%s failed to flush: %s', type(obj).__name__, e)
+                remaining += 1
+        return remaining
+
+    async def send_batch_async(self, batch, middlewares=None):
+        """
+        asyncio 模式使用: 中间件实现了 send_batch_async 协程时在事件循环里等待发送完成,
+        否则和 send_batch 一样同步调用
+        :param batch: list of (collector name, DataPoint or line[, read time])
+        :param middlewares: 只交给这些中间件(重试时使用), None 表示全部
+        :return: 发送失败的中间件, 全部成功时为空列表
+        """
+        collectors = [item[0] for item in batch]
+        lines = [str(item[1]) for item in batch]
+        failed = []
+        for obj in self.middlewares if middlewares is None else middlewares:
+            send_batch_async = getattr(obj, "send_batch_async", None)
+            if send_batch_async is None:
+                if not self._send_sync(obj, lines, collectors):
+                    failed.append(obj)
+                continue
+            sent, errors, seconds = self.stats[id(obj)]
+            start = time.monotonic()
+            try:
+                await send_batch_async(lines, collectors=collectors)
+                sent.inc(len(lines))
+            except Exception as e:
+                failed.append(obj)
+                errors.inc()
+                LOG.error('%s failed to send %d lines: %s', type(obj).__name__, len(lines), e)
+            seconds.record(time.monotonic() - start)
+        return failed
+
+    async def deliver_async(self, batch):
+        """asyncio 模式的 deliver, 退避时不阻塞事件循环"""
+        failed = await self.send_batch_async(batch)
+        backoff = SENDER_RETRY_BACKOFF
+        while failed:
+            self._retrying(batch, failed, backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, SENDER_RETRY_BACKOFF_MAX)
+            failed = await self.send_batch_async(batch, failed)
+
+
+def batch_lag(batch):
+    """
+    一批数据里最早读到的一条从读取到现在的秒数, 给 octopus_send_lag_seconds 使用;
+    没有读取时间(升级前写入磁盘队列)或者读取时间来自重启之前时为 None
+    """
+    stamps = [item[2] for item in batch if len(item) > 2]
+    if not stamps:
+        return None
+    lag = time.monotonic() - min(stamps)
+    return lag if lag >= 0 else None
+
+
+def drain_batch(process_queue, max_batch_size, max_linger_ms, timeout=None):
+    """
+    从队列里取一批数据, 第一条阻塞等待, 之后最多再等 max_linger_ms 毫秒
+    或者攒够 max_batch_size 条就返回
+    :param process_queue: ThreadQueue or ProcessQueue
+    :param max_batch_size:
+    :param max_linger_ms:
+    :param timeout: 等待第一条数据的秒数, None 表示一直等待, 超时返回空列表
+    :return: list of (collector name, DataPoint or line, read time)
+    """
+    try:
+        batch = [process_queue.get_queue(timeout=timeout)]
+    except queue.Empty:
+        return []
+    deadline = time.monotonic() + max_linger_ms / 1000.0
+    while len(batch) < max_batch_size:
+        try:
+            # 队列里已有的数据直接取走, 不需要等待
+            batch.append(process_queue.get_queue(block=False))
+            continue
+        except queue.Empty:
+            pass
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(process_queue.get_queue(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
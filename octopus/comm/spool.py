@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+磁盘溢出队列: 内存队列超过高水位后数据追加写入分段文件, 发送端追上后按顺序回放
+
+每个分段是一个固定大小的 mmap 文件, 头部记录写入/读取/确认的位置,
+记录格式为 4 字节长度 + pickle 数据; 写入端和读取端可以在不同的进程里
+"""
+import logging
+import mmap
+import multiprocessing
+import os
+import pickle
+import struct
+
+LOG = logging.getLogger('octopus')
+
+# write_off, write_count, read_count, acked_off, acked_count, sealed
+HEADER = struct.Struct('<QQQQQQ')
+RECORD = struct.Struct('<I')
+
+
+class Segment:
+    """
+    spool segment
+    """
+
+    def __init__(self, path, size=0):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT if size else os.O_RDWR)
+        try:
+            if size and os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+    def header(self):
+        return list(HEADER.unpack_from(self.map, 0))
+
+    def set_header(self, values):
+        HEADER.pack_into(self.map, 0, *values)
+
+    def close(self):
+        self.map.close()
+
+
+class Spool:
+    """
+    spool
+
+    只允许一个写入端和一个读取端, 共享的计数保存在 multiprocessing.Array 里:
+    [0] 还没有被读取的记录数, [1] 最旧的分段序号, [2] 正在写入的分段序号
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.meta = multiprocessing.Array('q', 3)
+        self.dropped = multiprocessing.Value('q', 0, lock=False)  # 超出磁盘上限丢弃的记录数
+        self._writer: Segment = None
+        self._writer_seq = -1
+        self._reader: Segment = None
+        self._reader_seq = -1
+        self._reader_off = 0
+        self._recover()
+
+    def _path(self, seq):
+        return os.path.join(self.directory, "%016d.seg" % seq)
+
+    def _recover(self):
+        """启动时载入上次没有确认的分段"""
+        seqs = sorted(int(f[:-4]) for f in os.listdir(self.directory) if f.endswith(".seg"))
+        pending = 0
+        for seq in seqs:
+            seg = Segment(self._path(seq))
+            header = seg.header()
+            # 没有确认的记录都需要重新发送
+            header[2] = header[4]
+            header[5] = 1
+            seg.set_header(header)
+            pending += header[1] - header[4]
+            seg.close()
+        if seqs:
+            LOG.info('recovered %d spooled lines in %d segments', pending, len(seqs))
+        self.meta[0] = pending
+        self.meta[1] = seqs[0] if seqs else 0
+        self.meta[2] = seqs[-1] + 1 if seqs else 0
+
+    def pending(self):
+        return self.meta[0]
+
+    def append(self, item):
+        """写入一条记录, 由写入端调用"""
+        data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        need = RECORD.size + len(data)
+        with self.meta.get_lock():
+            if self._writer is None or self._writer_seq != self.meta[2]:
+                self._open_writer(need)
+            header = self._writer.header()
+            offset = HEADER.size + header[0]
+            if offset + need > self._writer.size:
+                # 当前分段已满, 封存后切换到下一个分段
+                header[5] = 1
+                self._writer.set_header(header)
+                self._writer.close()
+                self.meta[2] += 1
+                self._open_writer(need)
+                header = self._writer.header()
+                offset = HEADER.size
+            RECORD.pack_into(self._writer.map, offset, len(data))
+            self._writer.map[offset + RECORD.size:offset + need] = data
+            header[0] += need
+            header[1] += 1
+            self._writer.set_header(header)
+            self.meta[0] += 1
+
+    def _open_writer(self, need):
+        self._writer_seq = self.meta[2]
+        self._writer = Segment(self._path(self._writer_seq),
+                               max(self.segment_size, HEADER.size + need))
+        self._enforce_budget()
+
+    def _enforce_budget(self):
+        """超过磁盘上限时丢弃最旧的分段"""
+        while (self.meta[2] - self.meta[1] + 1) * self.segment_size > self.max_bytes \
+                and self.meta[1] < self.meta[2]:
+            seq = self.meta[1]
+            try:
+                fd = os.open(self._path(seq), os.O_RDONLY)
+                try:
+                    header = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+                finally:
+                    os.close(fd)
+                os.unlink(self._path(seq))
+                lost = header[1] - header[2]
+            except FileNotFoundError:
+                lost = 0
+            self.meta[0] -= lost
+            self.meta[1] = seq + 1
+            self.dropped.value += lost
+            LOG.warning('spool is over %d bytes, dropped segment %d with %d lines',
+                        self.max_bytes, seq, lost)
+
+    def read(self):
+        """按顺序读取一条记录, 没有数据时返回 None, 由读取端调用"""
+        with self.meta.get_lock():
+            if self.meta[0] <= 0:
+                return None
+            while True:
+                if self._reader_seq < self.meta[1]:
+                    # 还没有打开过分段, 或者当前分段已经被丢弃
+                    self._open_reader(self.meta[1])
+                header = self._reader.header()
+                if self._reader_off < header[0]:
+                    break
+                if self._reader_seq >= self.meta[2]:
+                    return None
+                self._open_reader(max(self._reader_seq + 1, self.meta[1]))
+
+            offset = HEADER.size + self._reader_off
+            size, = RECORD.unpack_from(self._reader.map, offset)
+            data = self._reader.map[offset + RECORD.size:offset + RECORD.size + size]
+            self._reader_off += RECORD.size + size
+            header[2] += 1
+            self._reader.set_header(header)
+            self.meta[0] -= 1
+        return pickle.loads(data)
+
+    def _open_reader(self, seq):
+        if self._reader is not None:
+            self._reader.close()
+        self._reader_seq = seq
+        self._reader = Segment(self._path(seq))
+        header = self._reader.header()
+        self._reader_off = header[3]
+
+    def ack(self):
+        """读到的数据已经发送成功, 删除已经读完的分段"""
+        if self._reader is None:
+            return
+        with self.meta.get_lock():
+            for seq in range(self.meta[1], self._reader_seq):
+                try:
+                    os.unlink(self._path(seq))
+                except FileNotFoundError:
+                    pass
+            self.meta[1] = max(self.meta[1], self._reader_seq)
+            header = self._reader.header()
+            header[3] = self._reader_off
+            header[4] = header[2]
+            self._reader.set_header(header)
+            if header[5] and self._reader_off >= header[0]:
+                self._reader.close()
+                self._reader = None
+                os.unlink(self._path(self._reader_seq))
+                self.meta[1] = self._reader_seq + 1
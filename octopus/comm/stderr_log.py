@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+采集器的 stderr 单独处理: 每个采集器保留最近 STDERR_RING_LINES 行, 通过 telemetry 的
+/stderr.json 查看; 日志由 QueueHandler 放进队列, QueueListener 的线程负责格式化之外的输出,
+阅读端不会因为写日志变慢. 每个采集器一个令牌桶, 超出的行不写日志, 之后补一条
+"suppressed N lines" 的汇总
+"""
+import atexit
+import logging
+import os
+import queue
+import time
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+
+from octopus.comm.rate_limit import TokenBucket
+from octopus.comm.telemetry import REGISTRY
+from octopus.settings import STDERR_LOG_BURST, STDERR_LOG_LINES_PER_SEC, STDERR_RING_LINES
+
+LOG = logging.getLogger('octopus')
+
+
+class _Forward(logging.Handler):
+    """在 QueueListener 的线程里交给 octopus 日志已经配置的 handler"""
+
+    def emit(self, record):
+        LOG.handle(record)
+
+
+class StderrLog:
+    """
+    stderr log
+
+    每个进程一个(STDERR), 按采集器名称保存, 采集器重新执行之后最近的 stderr 仍然保留;
+    队列、日志线程和指标在第一次写入的进程里创建
+    """
+
+    def __init__(self, ring_lines=None, rate=None, burst=None):
+        self.ring_lines = ring_lines or STDERR_RING_LINES
+        self.rate = STDERR_LOG_LINES_PER_SEC if rate is None else rate
+        self.burst = burst or STDERR_LOG_BURST
+        self.rings: dict = {}  # 采集器名称 -> deque of (时间, 行)
+        self.buckets: dict = {}  # 采集器名称 -> [令牌桶, 被抑制的行数]
+        self.logger = logging.getLogger('octopus.stderr')
+        self.logger.propagate = False
+        self._handler: QueueHandler = None
+        self._listener: QueueListener = None
+        self._pid = None
+
+    def _start(self):
+        """fork 出来的进程里重新创建, 日志线程不会被继承"""
+        self._pid = os.getpid()
+        if self._handler is not None:
+            self.logger.removeHandler(self._handler)
+        log_queue = queue.SimpleQueue()
+        self._handler = QueueHandler(log_queue)
+        self.logger.addHandler(self._handler)
+        self._listener = QueueListener(log_queue, _Forward())
+        self._listener.start()
+        atexit.register(self._listener.stop)  # 退出前输出队列里剩余的日志
+        self.lines = REGISTRY.counter("octopus_stderr_lines_total", "lines read from collector stderr")
+        self.suppressed = REGISTRY.counter("octopus_stderr_suppressed_total",
+                                           "stderr lines not logged because of the rate limit")
+        REGISTRY.add_status("stderr", self.snapshot)
+
+    def write(self, name, data):
+        """
+        :param name: 采集器名称
+        :param data: bytes, 从 stderr 读到的一段数据
+        """
+        if self._pid != os.getpid():
+            self._start()
+        lines = data.decode('utf-8', 'replace').splitlines()
+        if not lines:
+            return
+        self.lines.inc(len(lines))
+        ring = self.rings.get(name)
+        if ring is None:
+            ring = self.rings[name] = deque(maxlen=self.ring_lines)
+        now = int(time.time())
+        ring.extend((now, line) for line in lines)
+
+        if not self.logger.isEnabledFor(logging.WARNING):
+            return
+        allowed = self._admit(name, len(lines))
+        if allowed:
+            # 一段数据一条日志, 不是每行一条
+            self.logger.warning('%s: %s', name, '\n'.join(lines[:allowed]))
+
+    def _admit(self, name, count):
+        """令牌桶允许写日志的行数, 之前有被抑制的行时先输出汇总"""
+        if not self.rate:
+            return count
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            bucket = self.buckets[name] = [TokenBucket(self.rate, self.burst), 0]
+        tokens = bucket[0]
+        tokens.refill(time.monotonic())
+        allowed = min(count, int(tokens.tokens))
+        tokens.tokens -= allowed
+        if allowed:
+            self._summary(name, bucket)
+        if allowed < count:
+            bucket[1] += count - allowed
+            self.suppressed.inc(count - allowed)
+        return allowed
+
+    def flush(self, name):
+        """stderr 已经关闭(采集器退出), 输出还没有汇总的被抑制的行数"""
+        bucket = self.buckets.get(name)
+        if bucket is not None:
+            self._summary(name, bucket)
+
+    def _summary(self, name, bucket):
+        if bucket[1]:
+            self.logger.warning('%s: suppressed %d stderr lines', name, bucket[1])
+            bucket[1] = 0
+
+    def forget(self, name):
+        self.rings.pop(name, None)
+        self.buckets.pop(name, None)
+
+    def snapshot(self):
+        """
+        :return: {采集器名称: [[时间, 行], ...]}
+        """
+        return {name: [list(item) for item in list(ring)] for name, ring in list(self.rings.items())}
+
+
+STDERR = StderrLog()
@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+"""
+octopus 自身的运行指标: 计数器、瞬时值和 HDR 风格的直方图
+
+每个进程有一个 REGISTRY; 进程模式下子进程定期把快照写到 TELEMETRY_DIR,
+监控进程里的 TelemetryServer 合并后通过 HTTP 或 UNIX socket 提供
+JSON(/metrics.json) 和 Prometheus 文本(/metrics) 两种格式; 采集器最近的 stderr
+这类不是数值的状态通过 add_status 登记, 见 /stderr.json
+"""
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from octopus.comm.datapoint import DataPoint
+
+LOG = logging.getLogger('octopus')
+
+SUB_BITS = 4  # 每个 2 的幂区间分成 16 个桶, 相对误差不超过 1/16
+SUB = 1 << SUB_BITS
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Counter:
+    """
+    counter
+
+    只增不减; 更新不加锁, 每个指标基本只在一个线程里更新
+    """
+    __slots__ = ("name", "help", "labels", "value")
+    kind = "counter"
+
+    def __init__(self, name, help_text="", labels=None):
+        self.name = name
+        self.help = help_text
+        self.labels = labels or {}
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return {"value": self.value}
+
+
+class Gauge:
+    """
+    gauge
+
+    fn 不为 None 时每次取快照调用 fn() 得到当前值, 例如队列长度
+    """
+    __slots__ = ("name", "help", "labels", "value", "fn")
+    kind = "gauge"
+
+    def __init__(self, name, help_text="", labels=None, fn=None):
+        self.name = name
+        self.help = help_text
+        self.labels = labels or {}
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        if self.fn is not None:
+            try:
+                self.value = self.fn()
+            except Exception as e:
+                LOG.debug('gauge %s failed: %s', self.name, e)
+        return {"value": self.value}
+
+
+class Histogram:
+    """
+    histogram
+
+    对数-线性分桶(与 HdrHistogram 相同的思路): 记录的值先乘以 scale 取整,
+    小于 2 * SUB 的值每个整数一个桶, 之后每个 2 的幂区间 SUB 个桶;
+    桶是稀疏的 dict, 记录一次 O(1), 内存只与出现过的数量级有关
+    """
+    __slots__ = ("name", "help", "labels", "scale", "buckets", "count", "sum", "max")
+    kind = "summary"
+
+    def __init__(self, name, help_text="", labels=None, scale=1e6):
+        self.name = name
+        self.help = help_text
+        self.labels = labels or {}
+        self.scale = scale  # 默认记录秒, 按微秒分桶
+        self.buckets: dict = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _index(v):
+        if v < 2 * SUB:
+            return v
+        shift = v.bit_length() - SUB_BITS - 1
+        return (shift + 1) * SUB + (v >> shift) - SUB
+
+    @staticmethod
+    def _upper(index):
+        """桶内的最大值"""
+        if index < 2 * SUB:
+            return index
+        shift = index // SUB - 1
+        return ((index % SUB + SUB + 1) << shift) - 1
+
+    def record(self, value):
+        v = int(value * self.scale)
+        if v < 0:
+            v = 0
+        index = self._index(v)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self._upper(index) / self.scale, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "quantiles": {str(q): self.quantile(q) for q in QUANTILES},
+        }
+
+
+class Registry:
+    """
+    registry
+
+    同名同标签的指标只创建一次; collectors 是返回一组指标的回调,
+    用于每个采集器的统计这类数量会变化的序列
+    """
+
+    def __init__(self):
+        self.metrics: dict = {}  # (name, labels) -> metric
+        self.collectors = []
+        self.statuses: dict = {}  # 状态名称 -> 回调
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, labels, **kwargs):
+        key = (name, _labels_key(labels))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = cls(name, help_text, labels, **kwargs)
+                    self.metrics[key] = metric
+        return metric
+
+    def counter(self, name, help_text="", **labels) -> Counter:
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text="", fn=None, **labels) -> Gauge:
+        gauge = self._get(Gauge, name, help_text, labels)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help_text="", scale=1e6, **labels) -> Histogram:
+        return self._get(Histogram, name, help_text, labels, scale=scale)
+
+    def add_collector(self, fn):
+        """fn() 返回 list of (name, kind, help, labels, value)"""
+        self.collectors.append(fn)
+
+    def add_status(self, name, fn):
+        """fn() 返回可以序列化为 JSON 的 dict, 按采集器名称等分组, 多个进程的结果合并"""
+        self.statuses[name] = fn
+
+    def status(self, name):
+        fn = self.statuses.get(name)
+        if fn is None:
+            return {}
+        try:
+            return fn()
+        except Exception as e:
+            LOG.debug('telemetry status %s failed: %s', name, e)
+            return {}
+
+    def snapshot(self, worker=None):
+        """
+        :param worker: 进程名称, 作为 worker 标签加到每个序列上
+        :return: list of dict
+        """
+        entries = []
+        for metric in list(self.metrics.values()):
+            entry = {"name": metric.name, "kind": metric.kind, "help": metric.help,
+                     "labels": dict(metric.labels)}
+            entry.update(metric.snapshot())
+            entries.append(entry)
+        for fn in self.collectors:
+            try:
+                for name, kind, help_text, labels, value in fn():
+                    entries.append({"name": name, "kind": kind, "help": help_text,
+                                    "labels": dict(labels), "value": value})
+            except Exception as e:
+                LOG.debug('telemetry collector %r failed: %s', fn, e)
+        if worker is not None:
+            for entry in entries:
+                entry["labels"]["worker"] = worker
+        return entries
+
+
+REGISTRY = Registry()
+
+
+def collector_stats(collection_dict):
+    """每个采集器的统计, 给 Registry.add_collector 使用"""
+
+    def collect():
+        for col in list(collection_dict.values()):
+            labels = {"collector": col.name}
+            yield ("octopus_collector_lines_received_total", "counter",
+                   "lines read from the collector", labels, col.lines_received)
+            yield ("octopus_collector_lines_sent_total", "counter",
+                   "lines enqueued after dedup", labels, col.lines_sent)
+            yield ("octopus_collector_lines_invalid_total", "counter",
+                   "lines that could not be parsed", labels, col.lines_invalid)
+            yield ("octopus_collector_dedup_keys", "gauge",
+                   "series in the dedup cache", labels, col.dedup_keys())
+            dedup = col.dedup_stats()
+            if dedup is not None:
+                yield ("octopus_collector_dedup_hits_total", "counter",
+                       "datapoints suppressed by the dedup cache", labels, dedup["hits"])
+                yield ("octopus_collector_dedup_misses_total", "counter",
+                       "datapoints that passed the dedup cache", labels, dedup["misses"])
+                yield ("octopus_collector_dedup_evictions_total", "counter",
+                       "series evicted from the dedup cache", labels, dedup["evictions"])
+
+    return collect
+
+
+class Publisher:
+    """
+    publisher
+
+    进程模式下子进程定期把快照原子地写到 directory/<worker>.json
+    """
+
+    def __init__(self, directory, worker, interval, registry=REGISTRY):
+        self.directory = directory
+        self.worker = worker
+        self.interval = interval
+        self.registry = registry
+        self.last_publish = 0
+
+    def next_timeout(self, now=None):
+        """距离下一次发布的秒数, 用来限制 select 的等待时间"""
+        if now is None:
+            now = time.time()
+        return max(0.0, self.last_publish + self.interval - now)
+
+    def maybe_publish(self):
+        now = time.time()
+        if now - self.last_publish < self.interval:
+            return
+        self.last_publish = now
+        path = os.path.join(self.directory, "%s.json" % self.worker)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump({"time": now, "metrics": self.registry.snapshot(self.worker),
+                           "status": {name: self.registry.status(name) for name in self.registry.statuses}}, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            LOG.warning('can not publish telemetry to %s: %s', path, e)
+
+
+def gather(registry=REGISTRY, worker=None, directory=None, max_age=None):
+    """
+    本进程的快照加上 directory 里其他进程发布的快照
+    :param max_age: 超过这个秒数没有更新的快照(进程已经退出)忽略
+    """
+    entries = registry.snapshot(worker)
+    for published in _published(directory, worker, max_age):
+        entries.extend(published.get("metrics", ()))
+    return entries
+
+
+def gather_status(name, registry=REGISTRY, worker=None, directory=None, max_age=None):
+    """本进程与 directory 里其他进程发布的状态 name, 合并成一个 dict"""
+    status = dict(registry.status(name))
+    for published in _published(directory, worker, max_age):
+        status.update(published.get("status", {}).get(name, {}))
+    return status
+
+
+def _published(directory, worker, max_age):
+    if not directory or not os.path.isdir(directory):
+        return
+    now = time.time()
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith(".json") or file_name == "%s.json" % worker:
+            continue
+        try:
+            with open(os.path.join(directory, file_name)) as f:
+                published = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if max_age is not None and now - published.get("time", 0) > max_age:
+            continue
+        yield published
+
+
+def _prom_labels(labels, extra=None):
+    items = sorted(labels.items())
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                             for k, v in items)
+
+
+def to_prometheus(entries):
+    """Prometheus 文本格式, 直方图按 summary 输出分位数"""
+    lines = []
+    seen = set()
+    for entry in sorted(entries, key=lambda e: e["name"]):
+        name = entry["name"]
+        if name not in seen:
+            seen.add(name)
+            if entry.get("help"):
+                lines.append("# HELP %s %s" % (name, entry["help"]))
+            lines.append("# TYPE %s %s" % (name, entry["kind"]))
+        labels = entry["labels"]
+        if entry["kind"] == "summary":
+            for q, value in entry["quantiles"].items():
+                lines.append("%s%s %r" % (name, _prom_labels(labels, ("quantile", q)), value))
+            lines.append("%s_sum%s %r" % (name, _prom_labels(labels), entry["sum"]))
+            lines.append("%s_count%s %d" % (name, _prom_labels(labels), entry["count"]))
+        else:
+            lines.append("%s%s %s" % (name, _prom_labels(labels), entry["value"]))
+    return "\n".join(lines) + "\n"
+
+
+def to_datapoints(entries, prefix="octopus.", timestamp=None):
+    """
+    转换成 octopus 自己的数据, 和采集器的数据一起发送
+    octopus_lines_read_total{collector=x} -> octopus.lines_read_total collector=x
+    """
+    if timestamp is None:
+        timestamp = int(time.time())
+    points = []
+    for entry in entries:
+        name = entry["name"]
+        if name.startswith("octopus_"):
+            name = name[len("octopus_"):]
+        metric = prefix + name
+        tags = tuple(sorted("%s=%s" % (k, str(v).replace(" ", "_"))
+                            for k, v in entry["labels"].items() if v != ""))
+        if entry["kind"] == "summary":
+            points.append(DataPoint(metric + ".count", timestamp, str(entry["count"]), tags))
+            points.append(DataPoint(metric + ".max", timestamp, repr(entry["max"]), tags))
+            for q, value in entry["quantiles"].items():
+                points.append(DataPoint("%s.p%s" % (metric, q[2:].ljust(2, "0")), timestamp,
+                                        repr(value), tags))
+        else:
+            points.append(DataPoint(metric, timestamp, str(entry["value"]), tags))
+    return points
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "octopus"
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path in ("/", "/metrics"):
+            body = to_prometheus(self.server.gather()).encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/metrics.json":
+            body = json.dumps(self.server.gather()).encode("utf-8")
+            content_type = "application/json"
+        elif path == "/stderr.json":
+            # 每个采集器最近的 stderr, ?collector=名称 只看一个
+            status = self.server.gather_status("stderr")
+            names = parse_qs(query).get("collector")
+            if names:
+                status = {name: lines for name, lines in status.items() if name in names}
+            body = json.dumps(status).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # UNIX socket 没有客户端地址
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        LOG.debug('telemetry %s %s', self.address_string(), format % args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TelemetryServer:
+    """
+    telemetry server
+
+    address 为 "host:port", unix_path 为 UNIX socket 路径, 都可以为 None;
+    每个监听一个守护线程
+    """
+
+    def __init__(self, address=None, unix_path=None, directory=None, max_age=None,
+                 registry=REGISTRY, worker=None):
+        self.address = address
+        self.unix_path = unix_path
+        self.directory = directory
+        self.max_age = max_age
+        self.registry = registry
+        self.worker = worker
+        self.servers = []
+
+    def gather(self):
+        return gather(self.registry, self.worker, self.directory, self.max_age)
+
+    def gather_status(self, name):
+        return gather_status(name, self.registry, self.worker, self.directory, self.max_age)
+
+    def start(self):
+        if self.address:
+            host, _, port = self.address.rpartition(":")
+            self._serve(ThreadingHTTPServer((host or "127.0.0.1", int(port)), _Handler))
+        if self.unix_path:
+            if os.path.exists(self.unix_path):
+                os.unlink(self.unix_path)
+            self._serve(_UnixHTTPServer(self.unix_path, _Handler))
+        return self
+
+    def _serve(self, server):
+        server.gather = self.gather
+        server.gather_status = self.gather_status
+        self.servers.append(server)
+        threading.Thread(target=server.serve_forever, name="telemetry", daemon=True).start()
+        LOG.info('telemetry listening on %s', server.server_address)
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+不重启采集器的升级: 收到 SIGHUP 时启动新的 octopus, 把运行中的采集器交给它
+
+旧进程监听 UPGRADE_SOCKET 并启动新进程, 新进程从环境变量 OCTOPUS_UPGRADE_SOCKET
+知道需要接管. 连上之后旧进程停止读取采集器的管道, 每个采集器一条消息: 调度、计数与
+未完成的半行用 JSON, 子进程的 stdout/stderr 与 pidfd 通过 SCM_RIGHTS 传递, 去重缓存
+分成多条消息. 新进程回复 adopted 之后旧进程发送完队列里剩余的数据并退出, 新进程等到
+socket 关闭才开始读取和发送, 两个进程不会同时写同一个 spool, 这段时间的数据留在管道里.
+任何一步失败时旧进程恢复读取继续运行, 新进程退出
+
+进程内的插件不交接, 由新进程重新载入; 只支持线程模式, 进程模式的管道在阅读进程里
+"""
+import base64
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+
+from octopus.comm.collector_selector import CollectorSelector
+from octopus.comm.datapoint import parse_lines
+from octopus.comm.line_framer import LineFramer
+from octopus.comm.plugin import PluginCollector
+from octopus.settings import MAX_LINE_LENGTH, UPGRADE_SOCKET, UPGRADE_TIMEOUT
+
+LOG = logging.getLogger('octopus')
+
+UPGRADE_ENV = "OCTOPUS_UPGRADE_SOCKET"
+MAX_MESSAGE = 1 << 20
+DEDUP_CHUNK = 500  # 每条消息的去重条目数, 不超过 socket 的发送缓冲区
+# 原样交接的采集器属性
+STATE_FIELDS = ("interval", "file_name", "m_time", "last_spawn", "dead", "generation", "lines_sent",
+                "lines_received", "lines_invalid", "lines_dropped", "last_datapoint")
+
+
+class AdoptedProcess:
+    """
+    adopted process
+
+    升级前的进程启动的采集器, 提供采集器用到的 Popen 接口. 不是本进程的子进程,
+    通过 pidfd 知道进程退出, 还没有被回收时从 /proc/<pid>/stat 读退出码(退出码 13 和失败
+    与普通的子进程一样处理); 已经被旧进程或者 init 回收时拿不到, 记录日志后按 0 处理,
+    重新启动之后的进程是本进程的子进程, 下一次退出时有真正的退出码
+    """
+
+    def __init__(self, pid, pidfd, stdout, stderr):
+        self.pid = pid
+        self.pidfd = pidfd  # 交接时已经退出的为 None, 只需要读完管道
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None if pidfd is not None else 0
+        self.status_known = False  # returncode 是不是真正的退出码
+
+    def poll(self):
+        if self.returncode is None and select.select([self.pidfd], [], [], 0)[0]:
+            self._exited()
+        return self.returncode
+
+    def _exited(self):
+        status = zombie_status(self.pid)
+        self.status_known = status is not None
+        if status is None:
+            LOG.warning('adopted collector (pid=%d) exited and was reaped by another process, '
+                        'exit status unknown, treating it as 0', self.pid)
+            status = 0
+        self.returncode = status
+        os.close(self.pidfd)
+        self.pidfd = None
+
+    def wait(self, timeout=None):
+        if self.returncode is None:
+            select.select([self.pidfd], [], [], timeout)
+            if self.poll() is None:
+                raise TimeoutError("pid %d still running" % self.pid)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.poll() is not None:
+            return
+        try:
+            signal.pidfd_send_signal(self.pidfd, sig)
+        except ProcessLookupError:
+            pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+def zombie_status(pid):
+    """
+    :return: 已经退出还没有被回收的进程的退出码(同 Popen.returncode), 否则为 None
+    """
+    try:
+        with open("/proc/%d/stat" % pid, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    fields = data[data.rfind(b")") + 2:].split()
+    if fields[0] != b"Z" or len(fields) < 50:
+        return None
+    return os.waitstatus_to_exitcode(int(fields[49]))  # 第 52 个字段 exit_code, waitpid 的格式
+
+
+class Upgrade:
+    """
+    upgrade
+
+    旧进程这一端: SIGHUP 只登记请求, 监控进程的循环里调用 hand_off 完成交接
+    """
+
+    def __init__(self, cc, selector, path=None, timeout=None):
+        self.cc = cc
+        self.selector: CollectorSelector = selector
+        self.path = path or UPGRADE_SOCKET
+        self.timeout = timeout or UPGRADE_TIMEOUT
+        self.requested = False
+        signal.signal(signal.SIGHUP, self.request)
+
+    def request(self, signum=None, frame=None):
+        self.requested = True
+
+    def hand_off(self):
+        """
+        :return: 与新进程的连接, 发送完剩余的数据后关闭; 失败时为 None, 继续运行
+        """
+        self.requested = False
+        LOG.info('upgrade requested, starting a new octopus')
+        self.cc.reap_children()  # 已经退出的采集器不需要交接
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        proc = None
+        try:
+            listener.bind(self.path)
+            listener.listen(1)
+            listener.settimeout(self.timeout)
+            env = dict(os.environ)
+            env[UPGRADE_ENV] = self.path
+            proc = subprocess.Popen([sys.executable] + sys.argv, env=env, stdin=subprocess.DEVNULL,
+                                    close_fds=True, start_new_session=True)
+            conn, _ = listener.accept()
+        except OSError as e:
+            LOG.error('upgrade failed, keep running: %s', e)
+            _stop(proc)
+            return None
+        finally:
+            listener.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+        conn.settimeout(self.timeout)
+        detached = {}
+        try:
+            detached = self.selector.detach()
+            count = self._send(conn, detached)
+            reply = json.loads(conn.recv(MAX_MESSAGE) or b"{}")
+            if reply.get("op") != "adopted":
+                raise OSError("pid %d did not adopt the collectors" % proc.pid)
+        except (OSError, ValueError) as e:
+            LOG.error('upgrade failed, keep running: %s', e)
+            self.selector.attach(detached)
+            _stop(proc)
+            conn.close()
+            return None
+
+        for col, stdout, stderr in detached.values():
+            for stream in (stdout, stderr):
+                if stream is not None:
+                    stream.close()
+        LOG.info('%d collectors handed over to pid %d', count, proc.pid)
+        return conn
+
+    def _send(self, conn, detached):
+        count = 0
+        for col in list(self.cc.collection_dict.values()):
+            if isinstance(col, PluginCollector):
+                continue
+            state = dump_state(col)
+            names, fds = [], []
+            pidfd = None
+            proc = col.proc
+            if proc is not None:
+                _, stdout, stderr = detached.get(proc.pid, (None, None, None))
+                for name, stream in (("stdout", stdout), ("stderr", stderr)):
+                    if stream is not None:
+                        names.append(name)
+                        fds.append(stream.fileno())
+                if proc.poll() is None:
+                    try:
+                        pidfd = os.pidfd_open(proc.pid)
+                    except ProcessLookupError:
+                        pass
+                    else:
+                        names.append("pidfd")
+                        fds.append(pidfd)
+                if fds:
+                    state["pid"] = proc.pid
+                    state["fds"] = names
+            try:
+                socket.send_fds(conn, [_encode("collector", state=state)], fds)
+            finally:
+                if pidfd is not None:
+                    os.close(pidfd)
+            entries = dump_dedup(col)
+            for i in range(0, len(entries), DEDUP_CHUNK):
+                conn.send(_encode("dedup", name=col.name, entries=entries[i:i + DEDUP_CHUNK]))
+            count += 1
+        conn.send(_encode("done", count=count))
+        return count
+
+
+def adopt(cc, path, timeout=None):
+    """
+    新进程这一端: 接管旧进程的采集器, 一直等到旧进程发送完剩余的数据关闭连接
+    :return: 接管的采集器数量
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    sock.settimeout(timeout or UPGRADE_TIMEOUT)
+    sock.connect(path)
+    cols = {}
+    while True:
+        data, fds, _, _ = socket.recv_fds(sock, MAX_MESSAGE, 3)
+        if not data:
+            raise OSError("upgrade connection closed before all collectors were handed over")
+        msg = json.loads(data)
+        if msg["op"] == "collector":
+            col = load_state(cc, msg["state"], fds)
+            cols[col.name] = col
+        elif msg["op"] == "dedup":
+            load_dedup(cols[msg["name"]], msg["entries"])
+        elif msg["op"] == "done":
+            break
+
+    for col in cols.values():
+        cc.adopt(col)
+    sock.send(_encode("adopted", count=len(cols)))
+    running = sum(1 for col in cols.values() if col.proc is not None)
+    LOG.info('adopted %d collectors (%d running), waiting for the old process to drain', len(cols), running)
+    # 旧进程发送完队列里的数据后关闭连接
+    try:
+        sock.recv(MAX_MESSAGE)
+    except socket.timeout:
+        LOG.warning('old process did not close the upgrade connection, starting anyway')
+    sock.close()
+    return len(cols)
+
+
+def dump_state(col):
+    state = {field: getattr(col, field) for field in STATE_FIELDS}
+    state["name"] = col.name
+    if col.buffer is not None and (col.buffer.partial or col.buffer.discarding):
+        # 还没有换行的半行, 新进程接着读
+        state["partial"] = base64.b64encode(bytes(col.buffer.partial)).decode("ascii")
+        state["discarding"] = col.buffer.discarding
+    return state
+
+
+def load_state(cc, state, fds):
+    col = cc.new_collector(state["name"], state["interval"], state["file_name"], state["m_time"],
+                           state["last_spawn"])
+    for field in STATE_FIELDS[4:]:
+        setattr(col, field, state[field])
+    if "partial" in state:
+        col.buffer = LineFramer(MAX_LINE_LENGTH)
+        col.buffer.partial = bytearray(base64.b64decode(state["partial"]))
+        col.buffer.discarding = state["discarding"]
+    if "pid" in state:
+        received = dict(zip(state["fds"], fds))
+        stdout, stderr = (os.fdopen(received[name], "rb", buffering=0) if name in received else None
+                          for name in ("stdout", "stderr"))
+        col.proc = AdoptedProcess(state["pid"], received.get("pidfd"), stdout, stderr)
+    return col
+
+
+def dump_dedup(col):
+    """去重缓存按时间顺序导出, 数据点用行协议的格式"""
+    if not col.dedup_keys():
+        return []
+    return [[str(dp), repeated, timestamp, last_seen]
+            for _, repeated, dp, timestamp, last_seen in col.values.entries.values()]
+
+
+def load_dedup(col, entries):
+    cache = col.values
+    for line, repeated, timestamp, last_seen in entries:
+        points, _ = parse_lines([line])
+        for dp in points:
+            cache.entries[dp.key] = [dp.value, repeated, dp, timestamp, last_seen]
+
+
+def _encode(op, **kwargs):
+    kwargs["op"] = op
+    return json.dumps(kwargs).encode()
+
+
+def _stop(proc):
+    if proc is not None and proc.poll() is None:
+        proc.kill()
+        proc.wait()
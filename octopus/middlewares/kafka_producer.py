@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+"""
+Kafka 生产者的统一接口, 优先使用 confluent-kafka, 其次 kafka-python,
+都没有安装时退回到打印输出; MemoryProducer 是进程内的假 broker, 用于本地调试
+"""
+import gzip
+import logging
+import threading
+import zlib
+from collections import defaultdict, deque
+
+LOG = logging.getLogger('octopus')
+
+try:
+    import confluent_kafka
+except ImportError:
+    confluent_kafka = None
+
+try:
+    import kafka
+except ImportError:
+    kafka = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def available_compression(compression):
+    """
+    检查压缩算法是否可用, 不可用时退回 gzip
+    :param compression: None, gzip, lz4, zstd
+    :return:
+    """
+    if compression in (None, "none", "gzip"):
+        return compression
+    if compression == "lz4" and (lz4_frame is not None or confluent_kafka is not None):
+        return compression
+    if compression == "zstd" and (zstandard is not None or confluent_kafka is not None):
+        return compression
+    LOG.warning('kafka compression %s is not available, using gzip', compression)
+    return "gzip"
+
+
+def compress(compression, value):
+    """按 compression 压缩 value, MemoryProducer 用它模拟 broker 收到的数据量"""
+    if compression == "gzip":
+        return gzip.compress(value)
+    if compression == "lz4" and lz4_frame is not None:
+        return lz4_frame.compress(value)
+    if compression == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor().compress(value)
+    return value
+
+
+class BaseProducer:
+    """
+    producer interface
+
+    produce 是异步的, 投递结果通过 on_delivery(err, size) 回调,
+    err 为 None 表示成功
+    """
+
+    def produce(self, topic, value, key=None, on_delivery=None):
+        raise NotImplementedError
+
+    def poll(self, timeout=0):
+        """处理已完成的投递回调"""
+        return 0
+
+    def flush(self, timeout=None):
+        """等待所有消息投递完成"""
+        return 0
+
+
+class ConfluentProducer(BaseProducer):
+
+    def __init__(self, bootstrap_servers, compression=None, linger_ms=5, batch_size=1024 * 1024):
+        config = {
+            "bootstrap.servers": bootstrap_servers,
+            "linger.ms": linger_ms,
+            "batch.size": batch_size,
+        }
+        if compression:
+            config["compression.type"] = compression
+        self.producer = confluent_kafka.Producer(config)
+
+    def produce(self, topic, value, key=None, on_delivery=None):
+        size = len(value)
+
+        def callback(err, msg):
+            if on_delivery is not None:
+                on_delivery(err, size)
+
+        while True:
+            try:
+                self.producer.produce(topic, value, key=key, on_delivery=callback)
+                return
+            except BufferError:
+                # 本地缓冲已满, 先处理回调腾出空间
+                self.producer.poll(0.1)
+
+    def poll(self, timeout=0):
+        return self.producer.poll(timeout)
+
+    def flush(self, timeout=None):
+        if timeout is None:
+            return self.producer.flush()
+        return self.producer.flush(timeout)
+
+
+class KafkaPythonProducer(BaseProducer):
+
+    def __init__(self, bootstrap_servers, compression=None, linger_ms=5, batch_size=1024 * 1024):
+        self.producer = kafka.KafkaProducer(
+            bootstrap_servers=bootstrap_servers.split(","),
+            compression_type=compression,
+            linger_ms=linger_ms,
+            batch_size=batch_size,
+        )
+
+    def produce(self, topic, value, key=None, on_delivery=None):
+        size = len(value)
+        future = self.producer.send(topic, value=value, key=key)
+        if on_delivery is not None:
+            future.add_callback(lambda _: on_delivery(None, size))
+            future.add_errback(lambda e: on_delivery(e, size))
+
+    def flush(self, timeout=None):
+        if timeout == 0:
+            return 0  # 投递回调在 kafka-python 自己的 IO 线程里执行, 不需要 poll
+        self.producer.flush(timeout)
+        return 0
+
+
+class ConsoleProducer(BaseProducer):
+    """没有安装 kafka 客户端时直接打印"""
+
+    def produce(self, topic, value, key=None, on_delivery=None):
+        print(value.decode("utf-8", "replace"))
+        if on_delivery is not None:
+            on_delivery(None, len(value))
+
+
+class MemoryProducer(BaseProducer):
+    """
+    进程内的假 broker: 按 key 分区保存消息, 按配置的算法压缩后统计字节数,
+    回调在 poll/flush 时触发, 行为与 confluent-kafka 一致
+    """
+
+    def __init__(self, num_partitions=8, compression=None, fail=None):
+        self.num_partitions = num_partitions
+        self.compression = compression
+        self.fail = fail  # 可选的 callable(topic, value), 返回异常时模拟投递失败
+        self.partitions = defaultdict(list)  # (topic, partition) -> [(key, value)]
+        self.bytes_in = 0
+        self.bytes_compressed = 0
+        self._callbacks = deque()
+        self._lock = threading.Lock()
+
+    def partition_for(self, key):
+        if key is None:
+            return 0
+        return zlib.crc32(key) % self.num_partitions
+
+    def produce(self, topic, value, key=None, on_delivery=None):
+        err = self.fail(topic, value) if self.fail is not None else None
+        with self._lock:
+            if err is None:
+                self.partitions[(topic, self.partition_for(key))].append((key, value))
+                self.bytes_in += len(value)
+                self.bytes_compressed += len(compress(self.compression, value))
+            self._callbacks.append((on_delivery, err, len(value)))
+
+    def poll(self, timeout=0):
+        count = 0
+        while True:
+            with self._lock:
+                if not self._callbacks:
+                    return count
+                on_delivery, err, size = self._callbacks.popleft()
+            if on_delivery is not None:
+                on_delivery(err, size)
+            count += 1
+
+    def flush(self, timeout=None):
+        self.poll()
+        return 0
+
+
+def create_producer(name, bootstrap_servers, compression=None, linger_ms=5, batch_size=1024 * 1024):
+    """
+    :param name: None 表示自动选择, 或者 confluent, kafka-python, memory, console
+    """
+    compression = available_compression(compression)
+    if name is None:
+        if confluent_kafka is not None:
+            name = "confluent"
+        elif kafka is not None:
+            name = "kafka-python"
+        else:
+            LOG.warning('no kafka client installed, printing lines instead')
+            name = "console"
+
+    if name == "confluent":
+        return ConfluentProducer(bootstrap_servers, compression, linger_ms, batch_size)
+    if name == "kafka-python":
+        return KafkaPythonProducer(bootstrap_servers, compression, linger_ms, batch_size)
+    if name == "memory":
+        return MemoryProducer(compression=compression)
+    if name == "console":
+        return ConsoleProducer()
+    raise ValueError("unknown kafka producer {}".format(name))
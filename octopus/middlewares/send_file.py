@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+"""
+把数据写到本地文件, 用于边缘节点落盘与回放
+
+每个发送进程写自己的分段文件 octopus-<pid>-<毫秒>.log, 一批数据一次 write;
+超过 FILE_SINK_SEGMENT_BYTES 字节或者 FILE_SINK_SEGMENT_SECONDS 秒后换新的分段,
+关闭的分段由后台线程按块压缩(gzip, 安装了 zstandard 时可以用 zstd),
+每一块是独立的 gzip member / zstd frame. 分段旁边的 .idx 文件记录每一块的
+写入时间范围与原始/压缩后的偏移, 回放某个时间段时只解压相关的块
+"""
+import atexit
+import fcntl
+import gzip
+import logging
+import os
+import queue
+import re
+import struct
+import threading
+import time
+
+from octopus.settings import (FILE_SINK_COMPRESSION, FILE_SINK_DIR, FILE_SINK_INDEX_BYTES,
+                              FILE_SINK_SEGMENT_BYTES, FILE_SINK_SEGMENT_SECONDS)
+
+LOG = logging.getLogger('octopus')
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 索引记录: 块内最早/最晚的写入时间, 原始偏移与长度, 压缩后的偏移与长度
+INDEX = struct.Struct("<ddQQQQ")
+SEGMENT = re.compile(r"^octopus-(\d+)-(\d+)\.log$")
+SUFFIXES = {"gzip": ".gz", "zstd": ".zst", None: ""}
+
+
+def available_compression(compression):
+    """zstd 不可用时退回 gzip"""
+    if compression in (None, "none"):
+        return None
+    if compression == "zstd" and zstandard is None:
+        LOG.warning('file sink compression zstd is not available, using gzip')
+        return "gzip"
+    if compression not in ("gzip", "zstd"):
+        LOG.warning('unknown file sink compression %s, using gzip', compression)
+        return "gzip"
+    return compression
+
+
+def compress_block(compression, data):
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decompress_block(compression, data):
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def read_index(path):
+    """
+    :return: list of (start, end, raw_offset, raw_length, offset, length)
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    count = len(data) // INDEX.size  # 崩溃时最后一条可能只写了一半
+    return [INDEX.unpack_from(data, i * INDEX.size) for i in range(count)]
+
+
+def write_index(path, entries):
+    """先写临时文件再改名, 读取端不会看到写了一半的索引"""
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(b"".join(INDEX.pack(*entry) for entry in entries))
+    os.replace(tmp, path)
+
+
+def compress_segment(path, compression):
+    """
+    按索引里的块压缩分段, 写完压缩文件和新的索引之后删除原始文件;
+    索引缺少的尾部(进程崩溃时还没有记录的块)补成一块, 时间取文件的 mtime.
+    多个发送进程会同时恢复同一个分段, 压缩期间对原始文件加 flock,
+    拿不到锁或者分段已经被其他进程压缩完时返回 None
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        try:
+            if os.stat(path).st_ino != os.fstat(fd).st_ino:
+                return None  # 打开之后被其他进程压缩并删除
+        except FileNotFoundError:
+            return None
+        return _compress_segment(path, compression)
+    finally:
+        os.close(fd)  # 同时释放锁
+
+
+def _compress_segment(path, compression):
+    index_path = path + ".idx"
+    entries = read_index(index_path)
+    size = os.path.getsize(path)
+    covered = entries[-1][2] + entries[-1][3] if entries else 0
+    if covered < size:
+        mtime = os.path.getmtime(path)
+        start = entries[-1][1] if entries else mtime
+        entries.append((start, mtime, covered, size - covered, covered, size - covered))
+
+    suffix = SUFFIXES[compression]
+    out_path = path + suffix
+    tmp = "%s.%d.tmp" % (out_path, os.getpid())
+    compressed = []
+    offset = 0
+    with open(path, "rb") as src, open(tmp, "wb") as dst:
+        for start, end, raw_offset, raw_length, _, _ in entries:
+            src.seek(raw_offset)
+            block = compress_block(compression, src.read(raw_length))
+            dst.write(block)
+            compressed.append((start, end, raw_offset, raw_length, offset, len(block)))
+            offset += len(block)
+    os.replace(tmp, out_path)
+    write_index(out_path + ".idx", compressed)
+    os.unlink(path)
+    try:
+        os.unlink(index_path)
+    except FileNotFoundError:
+        pass
+    return out_path
+
+
+def replay(directory, start=0, end=None):
+    """
+    按时间顺序读出写入时间和 [start, end] 有交集的块里的数据行;
+    按块读取, 块内的行不再按时间过滤
+    """
+    end = time.time() if end is None else end
+    segments = []
+    for name in os.listdir(directory):
+        base, compression = name, None
+        for algorithm in ("gzip", "zstd"):
+            if name.endswith(SUFFIXES[algorithm]):
+                base, compression = name[:-len(SUFFIXES[algorithm])], algorithm
+        if not SEGMENT.match(base):
+            continue
+        # 正在写的分段只能读到已经记录索引的块
+        entries = read_index(os.path.join(directory, name + ".idx"))
+        if entries:
+            segments.append((entries[0][0], os.path.join(directory, name), compression, entries))
+
+    done = set()
+    for _, path, compression, entries in sorted(segments):
+        if path in done:
+            continue
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            # 列目录之后被压缩了, 改读压缩后的分段和它的索引
+            f = None
+            for algorithm in ("gzip", "zstd") if compression is None else ():
+                try:
+                    f = open(path + SUFFIXES[algorithm], "rb")
+                except FileNotFoundError:
+                    continue
+                path, compression = path + SUFFIXES[algorithm], algorithm
+                entries = read_index(path + ".idx")
+                break
+            if f is None:
+                continue
+        done.add(path)
+        with f:
+            for block_start, block_end, _, _, offset, length in entries:
+                if block_end < start or block_start > end:
+                    continue
+                f.seek(offset)
+                data = decompress_block(compression, f.read(length))
+                yield from data.decode("utf-8", "replace").splitlines()
+
+
+class Compressor(threading.Thread):
+    """后台压缩关闭的分段, 不阻塞发送"""
+
+    def __init__(self, compression):
+        super().__init__(name="file-sink-compressor", daemon=True)
+        self.compression = compression
+        self.segments = queue.Queue()
+
+    def run(self):
+        while True:
+            path = self.segments.get()
+            if path is None:
+                return
+            start = time.monotonic()
+            try:
+                out_path = compress_segment(path, self.compression)
+                if out_path is not None:
+                    LOG.debug('compressed %s in %.3fs', out_path, time.monotonic() - start)
+            except OSError as e:
+                LOG.error('failed to compress %s: %s', path, e)
+
+
+class SendFileMiddleware:
+    """
+    一批数据拼成一个字节串写入当前分段, 每写满 FILE_SINK_INDEX_BYTES 字节
+    追加一条索引记录(一次小的 write), 平均每行没有单独的系统调用
+    """
+
+    def __init__(self, directory=None, segment_bytes=None, segment_seconds=None,
+                 index_bytes=None, compression=FILE_SINK_COMPRESSION):
+        self.directory = str(directory or FILE_SINK_DIR)
+        self.segment_bytes = segment_bytes or FILE_SINK_SEGMENT_BYTES
+        self.segment_seconds = segment_seconds or FILE_SINK_SEGMENT_SECONDS
+        self.index_bytes = index_bytes or FILE_SINK_INDEX_BYTES
+        self.compression = available_compression(compression)
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.compressor = None
+        if self.compression is not None:
+            self.compressor = Compressor(self.compression)
+            self.compressor.start()
+        self.lock = threading.Lock()
+        self.fd = None
+        self.index_fd = None
+        self.path = None
+        self.opened = 0
+        self.size = 0
+        self.block_offset = 0  # 当前块在分段里的起始偏移
+        self.block_start = 0  # 当前块最早的写入时间
+        self.block_end = 0
+        self.recover()
+        atexit.register(self.close)
+
+    def recover(self):
+        """上次异常退出留下的没有压缩的分段, 写入进程已经不在时交给后台线程压缩"""
+        if self.compressor is None:
+            return
+        for name in sorted(os.listdir(self.directory)):
+            match = SEGMENT.match(name)
+            if match is None:
+                continue
+            pid = int(match.group(1))
+            if pid != os.getpid() and _alive(pid):
+                continue
+            self.compressor.segments.put(os.path.join(self.directory, name))
+
+    def send(self, value, *args, collector=None, **kwargs):
+        self.send_batch([value], collectors=[collector])
+
+    def send_batch(self, lines, *args, collectors=None, **kwargs):
+        if not lines:
+            return
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        now = time.time()
+        with self.lock:
+            if self.fd is None:
+                self._open(now)
+            elif self.size >= self.segment_bytes or now - self.opened >= self.segment_seconds:
+                self._rotate(now)
+            if self.size == self.block_offset:
+                self.block_start = now
+            self.block_end = now
+            view = memoryview(data)
+            while view:
+                written = os.write(self.fd, view)
+                view = view[written:]
+            self.size += len(data)
+            if self.size - self.block_offset >= self.index_bytes:
+                self._close_block()
+
+    def flush(self, timeout=None):
+        """写入已经是无缓冲的 os.write; 这里只做空闲时的按时间换分段"""
+        with self.lock:
+            if self.fd is not None and time.time() - self.opened >= self.segment_seconds:
+                self._rotate(None)
+        return 0
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                self._rotate(None)
+        if self.compressor is not None and self.compressor.is_alive():
+            self.compressor.segments.put(None)
+            self.compressor.join()
+
+    def _open(self, now):
+        name = "octopus-%d-%d.log" % (os.getpid(), int(now * 1000))
+        self.path = os.path.join(self.directory, name)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(self.path + ".idx", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.opened = now
+        self.size = self.block_offset = 0
+
+    def _close_block(self):
+        length = self.size - self.block_offset
+        if length:
+            os.write(self.index_fd, INDEX.pack(self.block_start, self.block_end, self.block_offset,
+                                               length, self.block_offset, length))
+        self.block_offset = self.size
+
+    def _rotate(self, now):
+        self._close_block()
+        os.close(self.fd)
+        os.close(self.index_fd)
+        path, self.fd, self.index_fd = self.path, None, None
+        if self.compressor is not None:
+            self.compressor.segments.put(path)
+        if now is not None:
+            self._open(now)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -3,10 +3,133 @@
 """
 这个脚本的作用是把数据发送到 Kafaka
 """
+import atexit
+import logging
+import threading
+from collections import defaultdict, deque
+
+from octopus.comm.telemetry import REGISTRY
+from octopus.middlewares.kafka_producer import create_producer
+from octopus.settings import (KAFKA_BATCH_SIZE, KAFKA_BOOTSTRAP_SERVERS, KAFKA_CLOSE_TIMEOUT,
+                              KAFKA_COMPRESSION, KAFKA_LINGER_MS, KAFKA_MAX_IN_FLIGHT, KAFKA_PRODUCER,
+                              KAFKA_TOPIC)
+
+LOG = logging.getLogger('octopus')
+
+
+class KafkaDeliveryError(Exception):
+    """之前的消息投递失败, 已经重新发送; 这一批由调用方退避后重试"""
 
 
 class SendKafkaMiddleware:
+    """
+    同一批数据按采集器名称分组, 每组合并成一条以换行分隔的消息,
+    以采集器名称作为 key, 同一个采集器的数据总是落在同一个分区
+
+    投递结果是异步的, 回调到达时这一批已经 ack; 失败的消息保留下来, 下一次 send_batch
+    或者 flush 时重新发送, send_batch 还会抛出 KafkaDeliveryError 让发送端退避,
+    新的一批在之前的消息重新发送之前不会 ack
+    """
+
+    def __init__(self, producer=None, topic=None, max_in_flight=None):
+        self.topic = topic or KAFKA_TOPIC
+        self.producer = producer or create_producer(
+            KAFKA_PRODUCER, KAFKA_BOOTSTRAP_SERVERS, KAFKA_COMPRESSION,
+            KAFKA_LINGER_MS, KAFKA_BATCH_SIZE)
+        # 限制还没有收到投递结果的消息数量
+        self.in_flight = threading.BoundedSemaphore(max_in_flight or KAFKA_MAX_IN_FLIGHT)
+        self.messages_delivered = 0
+        self.messages_failed = 0
+        self.bytes_delivered = 0
+        self.failed = deque()  # 投递失败等待重新发送的 (key, payload), 回调所在的线程追加
+        REGISTRY.add_collector(self.stats)
+        atexit.register(self.close)
+
+    def send(self, value, *args, collector=None, **kwargs):
+        self.send_batch([value], collectors=[collector])
+
+    def send_batch(self, lines, *args, collectors=None, **kwargs):
+        if self.failed:
+            resent = self._resend()
+            raise KafkaDeliveryError("{} messages to {} failed and were resent".format(resent, self.topic))
+        groups = defaultdict(list)
+        if collectors is None:
+            groups[None] = lines
+        else:
+            for name, line in zip(collectors, lines):
+                groups[name].append(line)
+
+        for name, values in groups.items():
+            payload = "\n".join(values).encode("utf-8")
+            key = name.encode("utf-8") if name else None
+            self._produce(key, payload)
+        self.producer.poll(0)
+
+    def flush(self, timeout=None):
+        """
+        :return: 还没有确认投递的消息数量, 包括失败之后等待重新发送的
+        """
+        self._resend()
+        remaining = self.producer.flush(timeout) or 0
+        return remaining + len(self.failed)
+
+    def _produce(self, key, payload):
+        self._acquire()
+        try:
+            self.producer.produce(self.topic, payload, key=key,
+                                  on_delivery=lambda err, size: self._on_delivery(err, size, (key, payload)))
+        except Exception:
+            self.in_flight.release()
+            raise
+
+    def _resend(self):
+        """重新发送一遍当前失败的消息, 发送过程中又失败的留到下一次"""
+        count = 0
+        for _ in range(len(self.failed)):
+            key, payload = self.failed.popleft()
+            try:
+                self._produce(key, payload)
+            except Exception:
+                self.failed.appendleft((key, payload))
+                raise
+            count += 1
+        return count
+
+    def close(self):
+        """退出前等待在途消息的投递结果, 最多 KAFKA_CLOSE_TIMEOUT 秒"""
+        try:
+            remaining = self.flush(KAFKA_CLOSE_TIMEOUT)
+        except Exception as e:
+            LOG.error('kafka flush to %s failed: %s', self.topic, e)
+            return
+        if remaining:
+            LOG.error('%d kafka messages to %s were not delivered before exit', remaining, self.topic)
+
+    def _acquire(self):
+        # 在途消息已满时处理投递回调, 直到有空位
+        while not self.in_flight.acquire(timeout=0.01):
+            self.producer.poll(0.1)
+
+    def _on_delivery(self, err, size, message=None):
+        self.in_flight.release()
+        if err is not None:
+            self.messages_failed += 1
+            LOG.error('kafka delivery to %s failed, will resend: %s', self.topic, err)
+            if message is not None:
+                self.failed.append(message)
+            return
+        self.messages_delivered += 1
+        self.bytes_delivered += size
 
-    def send(self, value, *args, **kwargs):
-        print(value)
-        pass
+    def stats(self):
+        labels = {"topic": self.topic}
+        return [
+            ("octopus_kafka_messages_delivered_total", "counter", "kafka messages delivered", labels,
+             self.messages_delivered),
+            ("octopus_kafka_messages_failed_total", "counter", "kafka delivery failures, the message is resent",
+             labels, self.messages_failed),
+            ("octopus_kafka_bytes_delivered_total", "counter", "kafka payload bytes delivered", labels,
+             self.bytes_delivered),
+            ("octopus_kafka_messages_resend_pending", "gauge", "failed kafka messages waiting to be resent",
+             labels, len(self.failed)),
+        ]
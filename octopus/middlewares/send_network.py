@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+
+"""
+把数据发送到网络: OpenTSDB 风格的 TCP put 与 HTTP JSON POST
+
+节点按配置的顺序使用, 前面的节点失败后按指数退避(带随机抖动)暂停, 数据转到下一个节点;
+所有节点都在退避中时不等待, 直接失败, 由发送端按 SENDER_RETRY_BACKOFF 重试这一批.
+每个节点保持若干个长连接, 批次之间复用, HTTP 在一个连接上连续发送多个请求,
+在途请求达到 NETWORK_SINK_PIPELINE 个时才等待最早的响应
+"""
+import asyncio
+import atexit
+import json
+import logging
+import math
+import random
+import select
+import socket
+import threading
+import time
+from collections import deque
+from http.client import HTTPException, HTTPResponse
+from urllib.parse import urlsplit
+
+from octopus.comm.datapoint import parse_lines
+from octopus.settings import (HTTP_SINK_ENDPOINTS, NETWORK_SINK_BACKOFF_BASE, NETWORK_SINK_BACKOFF_MAX,
+                              NETWORK_SINK_MAX_RETRIES, NETWORK_SINK_PIPELINE, NETWORK_SINK_POOL_SIZE,
+                              NETWORK_SINK_TIMEOUT, TSDB_SINK_ENDPOINTS)
+
+LOG = logging.getLogger('octopus')
+
+
+class SinkError(Exception):
+    """所有节点都在退避中, 或者重试 max_retries 次之后仍然没有发送成功"""
+
+
+class Endpoint:
+    """
+    endpoint
+
+    一个节点的地址、退避状态和连接池
+    """
+
+    def __init__(self, address, pool_size=2, backoff_base=0.1, backoff_max=30.0):
+        if "://" in address:
+            url = urlsplit(address)
+            self.host = url.hostname
+            self.port = url.port or 80
+            self.path = (url.path or "/") + ("?" + url.query if url.query else "")
+        else:
+            host, _, port = address.rpartition(":")
+            self.host, self.port, self.path = host, int(port), None
+        self.address = address
+        self.pool_size = pool_size
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failures = 0
+        self.retry_at = 0.0  # 退避结束的时间, time.monotonic()
+        self.connections = []
+        self.next_connection = 0
+
+    def fail(self):
+        """连续失败的次数越多退避越久, 实际时间在 [delay/2, delay] 之间随机"""
+        self.failures += 1
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (self.failures - 1))
+        self.retry_at = time.monotonic() + random.uniform(delay / 2, delay)
+
+    def succeed(self):
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+class Connection:
+    """
+    connection
+
+    长连接与在途的批次; makefile 总是返回同一个缓冲, 流水线上的多个 HTTPResponse
+    依次从里面读取, 不会丢掉已经读进缓冲的下一个响应
+    """
+
+    def __init__(self, endpoint: Endpoint, timeout):
+        self.endpoint = endpoint
+        self.sock = socket.create_connection((endpoint.host, endpoint.port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.fp = self.sock.makefile("rb")
+        self.inflight = deque()  # 已经发送还没有收到响应的批次
+
+    def makefile(self, *args, **kwargs):
+        return _SharedReader(self.fp)
+
+    def readable(self):
+        """
+        只看 socket; 已经读进缓冲的响应要等下一次阻塞读取时处理
+        """
+        return bool(select.select([self.sock], [], [], 0)[0])
+
+    def close(self):
+        try:
+            self.fp.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class NetworkSink:
+    """
+    network sink
+
+    子类实现 encode(把一批行编码成一次发送的字节)与 reap(读取响应);
+    一次 send_batch 里失败的批次会换节点重试, 没有可用的节点或者超过 max_retries 次后
+    抛出 SinkError. 这一次的批次由调用方重试, 之前流水线上的批次留到下一次调用时先发送
+    """
+
+    def __init__(self, endpoints, pool_size=None, pipeline=None, timeout=None,
+                 backoff_base=None, backoff_max=None, max_retries=None):
+        backoff_base = backoff_base or NETWORK_SINK_BACKOFF_BASE
+        backoff_max = backoff_max or NETWORK_SINK_BACKOFF_MAX
+        self.endpoints = [Endpoint(address, pool_size or NETWORK_SINK_POOL_SIZE, backoff_base, backoff_max)
+                          for address in endpoints]
+        if not self.endpoints:
+            raise ValueError("{} needs at least one endpoint".format(type(self).__name__))
+        self.pipeline = max(1, pipeline or NETWORK_SINK_PIPELINE)
+        self.timeout = timeout or NETWORK_SINK_TIMEOUT
+        self.max_retries = NETWORK_SINK_MAX_RETRIES if max_retries is None else max_retries
+        self.lock = threading.Lock()
+        self.batches_sent = 0
+        self.batches_retried = 0
+        self.batches_failed = 0
+        self.deferred = deque()  # 之前的调用里失败的流水线批次
+        atexit.register(self.close)
+
+    def encode(self, endpoint, lines):
+        raise NotImplementedError
+
+    def reap(self, conn: Connection, block):
+        """
+        读取已经到达的响应, block 为 True 时至少等待一个
+        :return: (连接关闭后需要重新发送的批次, 节点返回错误需要重试的批次)
+        """
+        return [], []
+
+    def send(self, value, *args, collector=None, **kwargs):
+        self.send_batch([value], collectors=[collector])
+
+    def send_batch(self, lines, *args, collectors=None, **kwargs):
+        if not lines:
+            return
+        with self.lock:
+            pending, self.deferred = self.deferred, deque()
+            pending.append(lines)
+            self._deliver(pending, lines)
+
+    async def send_batch_async(self, lines, *args, collectors=None, **kwargs):
+        """asyncio 模式下在线程池里发送, 退避等待不阻塞事件循环"""
+        await asyncio.get_running_loop().run_in_executor(None, self.send_batch, lines)
+
+    def flush(self, timeout=None):
+        """等待所有在途批次的响应"""
+        with self.lock:
+            pending, self.deferred = self.deferred, deque()
+            for endpoint in self.endpoints:
+                for conn in list(endpoint.connections):
+                    try:
+                        while conn.inflight:
+                            resend, failed = self.reap(conn, True)
+                            pending.extend(resend)
+                            pending.extend(failed)
+                    except (OSError, HTTPException) as e:
+                        pending.extend(self._discard(conn, e))
+            if pending:
+                self._deliver(pending)
+            return sum(len(lines) for lines in self.deferred)
+
+    def close(self):
+        try:
+            self.flush()
+        except SinkError as e:
+            LOG.error('%s: %d batches not sent: %s', type(self).__name__, len(self.deferred), e)
+        with self.lock:
+            for endpoint in self.endpoints:
+                for conn in endpoint.connections:
+                    conn.close()
+                endpoint.connections = []
+
+    def _deliver(self, pending, current=None):
+        """
+        :param pending: 需要发送的批次
+        :param current: 调用方这一次的批次, 失败时由调用方重试
+        """
+        try:
+            self._send_pending(pending)
+        except SinkError as e:
+            deferred = [lines for lines in pending if lines is not current]
+            self.deferred.extend(deferred)
+            if current is not None and len(deferred) == len(pending):
+                # 这一次的批次已经发出, 只有之前的批次失败, 留到下一次
+                LOG.warning('%s: %d earlier batches deferred: %s', type(self).__name__, len(deferred), e)
+                return
+            self.batches_failed += 1 if current is not None else len(deferred)
+            raise
+
+    def _send_pending(self, pending):
+        attempts = 0
+        while pending:
+            lines = pending.popleft()
+            conn = None
+            failed = []
+            try:
+                conn = self._acquire()
+                payload = self.encode(conn.endpoint, lines)
+                if payload is None:
+                    continue
+                conn.inflight.append(lines)
+                conn.sock.sendall(payload)
+                self.batches_sent += 1
+                resend, failed = self.reap(conn, len(conn.inflight) >= self.pipeline)
+                pending.extend(resend)
+            except SinkError:
+                pending.appendleft(lines)  # 没有可用的节点, 还没有发出
+                raise
+            except (OSError, HTTPException) as e:
+                if conn is None and self._available():
+                    # 连不上时直接转到下一个节点, 不算重试
+                    pending.appendleft(lines)
+                    continue
+                failed = [lines] if conn is None else self._discard(conn, e)
+                error = e
+            else:
+                error = "server error"
+            if failed:
+                attempts = self._retry(attempts, failed, pending, error)
+
+    def _retry(self, attempts, retry, pending, error):
+        attempts += 1
+        pending.extend(retry)
+        if attempts > self.max_retries:
+            raise SinkError("giving up after {} attempts: {}".format(attempts, error))
+        self.batches_retried += len(retry)
+        return attempts
+
+    def _available(self):
+        now = time.monotonic()
+        return any(e.retry_at <= now for e in self.endpoints)
+
+    def _acquire(self):
+        """
+        按配置顺序取第一个不在退避中的节点, 都在退避时不等待, 抛出 SinkError;
+        节点的连接轮流使用, 不足 pool_size 个时新建
+        """
+        now = time.monotonic()
+        endpoint = next((e for e in self.endpoints if e.retry_at <= now), None)
+        if endpoint is None:
+            wait = min(e.retry_at for e in self.endpoints) - now
+            raise SinkError("all endpoints are backing off for another {:.1f}s".format(wait))
+        if len(endpoint.connections) < endpoint.pool_size:
+            try:
+                conn = Connection(endpoint, self.timeout)
+            except OSError as e:
+                endpoint.fail()
+                LOG.warning('%s: connect to %s failed: %s', type(self).__name__, endpoint.address, e)
+                raise
+            endpoint.connections.append(conn)
+            return conn
+        endpoint.next_connection = (endpoint.next_connection + 1) % len(endpoint.connections)
+        return endpoint.connections[endpoint.next_connection]
+
+    def _discard(self, conn: Connection, error):
+        """关闭连接, 节点进入退避, 返回连接上所有在途的批次"""
+        endpoint = conn.endpoint
+        conn.close()
+        if conn in endpoint.connections:
+            endpoint.connections.remove(conn)
+        if error is not None:
+            endpoint.fail()
+            LOG.warning('%s: %s failed (%d in flight): %s', type(self).__name__, endpoint.address,
+                        len(conn.inflight), error)
+        retry = list(conn.inflight)
+        conn.inflight.clear()
+        return retry
+
+
+class SendTsdbMiddleware(NetworkSink):
+    """
+    OpenTSDB telnet 协议: 每行 "put metric timestamp value tags", 成功时没有响应,
+    连接上读到的内容都是错误信息
+    """
+
+    def __init__(self, endpoints=None, **kwargs):
+        super().__init__(endpoints or TSDB_SINK_ENDPOINTS, **kwargs)
+
+    def encode(self, endpoint, lines):
+        return ("".join("put %s\n" % line for line in lines)).encode("utf-8")
+
+    def reap(self, conn, block):
+        # 没有响应可以确认, 写入成功就算发送成功
+        conn.inflight.clear()
+        conn.endpoint.succeed()
+        if conn.readable():
+            data = conn.sock.recv(65536)
+            if not data:
+                raise ConnectionError("connection closed by peer")
+            LOG.error('%s: %s', conn.endpoint.address, data.decode("utf-8", "replace").strip())
+        return [], []
+
+
+class SendHttpMiddleware(NetworkSink):
+    """
+    HTTP JSON POST, 格式与 OpenTSDB /api/put 相同; 不符合行协议的行不发送.
+    5xx/429 换节点重试, 其他 4xx 记录日志后丢弃这一批
+    """
+
+    def __init__(self, endpoints=None, **kwargs):
+        super().__init__(endpoints or HTTP_SINK_ENDPOINTS, **kwargs)
+
+    def encode(self, endpoint, lines):
+        points, _ = parse_lines(lines)
+        points = [{
+            "metric": dp.metric,
+            "timestamp": dp.timestamp,
+            "value": _number(dp.value),
+            "tags": dict(tag.split("=", 1) for tag in dp.tags),
+        } for dp in points if math.isfinite(float(dp.value))]
+        if not points:
+            return None
+        body = json.dumps(points, separators=(",", ":")).encode("utf-8")
+        head = ("POST %s HTTP/1.1\r\nHost: %s:%d\r\nContent-Type: application/json\r\n"
+                "Content-Length: %d\r\n\r\n" % (endpoint.path, endpoint.host, endpoint.port, len(body)))
+        return head.encode("ascii") + body
+
+    def reap(self, conn, block):
+        failed = []
+        while conn.inflight and (block or conn.readable()):
+            block = False
+            response = HTTPResponse(conn)
+            response.begin()
+            body = response.read()
+            lines = conn.inflight.popleft()
+            if response.status >= 500 or response.status == 429:
+                # 只重试这一批, 同一个连接上后面的请求可能已经成功
+                conn.endpoint.fail()
+                failed.append(lines)
+                LOG.warning('%s: %s returned HTTP %d %s', type(self).__name__, conn.endpoint.address,
+                            response.status, body[:200])
+            elif response.status >= 400:
+                conn.endpoint.succeed()
+                self.batches_failed += 1
+                LOG.error('%s rejected %d lines: HTTP %d %s', conn.endpoint.address, len(lines),
+                          response.status, body[:200])
+            else:
+                conn.endpoint.succeed()
+            if response.will_close:
+                # 服务端关闭了长连接, 后面的请求换一个连接重新发送, 不算失败
+                return self._discard(conn, None), failed
+        return [], failed
+
+
+class _SharedReader:
+    """HTTPResponse 读完之后会关闭 fp, 共用的缓冲只能由 Connection 关闭"""
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def close(self):
+        pass
+
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
@@ -1,54 +1,156 @@
 import logging
-import multiprocessing
+import os
+import queue
+import time
 from multiprocessing import Queue
 
+from octopus.comm.fair_queue import DrrBuffer
+from octopus.comm.spool import Spool
+from octopus.process.shm_ring import ShmRing
+from octopus.settings import (FAIR_QUEUE_ENABLED, FAIR_QUEUE_MAX_PER_COLLECTOR, FAIR_QUEUE_QUANTUM,
+                              PROCESS_RING_SIZE, PROCESS_TRANSPORT, SPOOL_DIR, SPOOL_ENABLED,
+                              SPOOL_HIGH_WATER, SPOOL_MAX_BYTES, SPOOL_POLL_INTERVAL,
+                              SPOOL_SEGMENT_SIZE)
+
 LOG = logging.getLogger('octopus')
 
 
 class ProcessQueue:
-    __instance = None
+    __instances: dict = {}  # 分片序号 -> 实例, 不分片时为 None
+
+    def __new__(cls, shard=None):
+        if shard not in cls.__instances:
+            cls.__instances[shard] = super().__new__(cls)
+        return cls.__instances[shard]
 
-    def __new__(cls, *args, **kwargs):
-        if cls.__instance:
-            return cls.__instance
+    def __init__(self, shard=None):
+        if hasattr(self, "queue"):
+            return  # 已经初始化过的实例
+        self.shard = shard
+        # shm: 共享内存字节环, 按批传输; queue: multiprocessing.Queue, 逐条 pickle
+        if PROCESS_TRANSPORT == "shm":
+            self.queue = ShmRing(PROCESS_RING_SIZE)
         else:
-            obj = super().__new__(cls, *args, **kwargs)
-            cls.__instance = obj
-            return cls.__instance
+            self.queue = Queue(maxsize=10000)
+        # 内存队列超过高水位后溢出到磁盘
+        self.spool = None
+        self.high_water = SPOOL_HIGH_WATER
+        if SPOOL_ENABLED:
+            spool_dir = SPOOL_DIR if shard is None else os.path.join(SPOOL_DIR, "shard-%d" % shard)
+            self.spool = Spool(spool_dir, SPOOL_SEGMENT_SIZE, SPOOL_MAX_BYTES)
+        # 发送进程本地的公平缓冲: 跨进程的队列只能先进先出, 取出来之后再按采集器轮流发送;
+        # 每次最多取 10000 条, 不按采集器限制, 取不下的留在跨进程的队列里
+        self.fair = None
+        if FAIR_QUEUE_ENABLED:
+            self.fair = DrrBuffer(FAIR_QUEUE_QUANTUM, FAIR_QUEUE_MAX_PER_COLLECTOR)
 
-    def __init__(self, do_filter=True, *args, **kwargs):
-        self.do_filter = do_filter
-        self.queue = Queue(maxsize=10000)
-        self.data_duplication_dict: dict = multiprocessing.Manager().dict()
-        self.data_duplication_dict: dict = {}
+    def _put(self, item, block, timeout):
+        if self.spool is not None and (self.spool.pending() or self.queue.qsize() >= self.high_water):
+            # 磁盘里还有数据没有回放时继续写磁盘, 保证顺序
+            self.spool.append(item)
+            return
+        self.queue.put(item, block=block, timeout=timeout)
 
-    def put_queue(self, obj_name, value, block=True, timeout=None):
+    def put_queue(self, obj_name, value, block=True, timeout=None, read_time=None):
         """
         input value to queue
         :param obj_name:
         :param value:
         :param block:
         :param timeout:
+        :param read_time: 从采集器读到数据的 time.monotonic(), 默认为现在
         :return:
         """
-        if self.do_filter:
-            self.queue.put(value, block=block, timeout=timeout)
+        self._put((obj_name, value, time.monotonic() if read_time is None else read_time), block, timeout)
+        return True
+
+    def put_batch(self, items, block=True, timeout=None):
+        """
+        input a batch of (obj_name, value, read_time) to queue
+        :param items:
+        :param block:
+        :param timeout:
+        :return:
+        """
+        if self.spool is not None and (self.spool.pending() or self.queue.qsize() >= self.high_water):
+            for item in items:
+                self.spool.append(item)
+        elif isinstance(self.queue, ShmRing):
+            self.queue.put_batch(items, block=block, timeout=timeout)
         else:
-            """
-            取到上一次的数据
-            """
-            last_value = self.data_duplication_dict.get(obj_name)
-            if last_value == value:
-                return False
-            else:
-                self.data_duplication_dict[obj_name] = value
-                self.queue.put(value, block=block, timeout=timeout)
+            for item in items:
+                self.queue.put(item, block=block, timeout=timeout)
+        return True
 
     def get_queue(self, block=True, timeout=None):
         """
         get value to queue
         :param block:
         :param timeout:
+        :return: (obj_name, value, read_time)
+        """
+        if self.fair is None:
+            return self._get(block, timeout)
+
+        # 本地缓冲取空之后, 把跨进程队列里已经有的数据一次都取过来再轮流取;
+        # 磁盘里的数据要等发送成功才 ack, 只在跨进程队列为空时逐条读取
+        fair = self.fair
+        if not fair.size:
+            fair.push(self._get(block, timeout))
+            get = self.queue.get
+            while fair.size < 10000:
+                try:
+                    fair.push(get(block=False))
+                except queue.Empty:
+                    break
+        return fair.pop()
+
+    def _get(self, block, timeout):
+        if self.spool is None:
+            return self.queue.get(block=block, timeout=timeout)
+
+        # 内存队列里的数据早于磁盘里的数据, 先取内存队列
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # 先看磁盘再看内存: 磁盘有数据之后写入端不会再写内存队列,
+            # 此时内存队列为空就说明磁盘里的数据是最早的
+            pending = self.spool.pending()
+            try:
+                return self.queue.get(block=False)
+            except queue.Empty:
+                pass
+            if pending:
+                item = self.spool.read()
+                if item is not None:
+                    return item
+            if not block:
+                raise queue.Empty
+            wait = SPOOL_POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    raise queue.Empty
+            try:
+                return self.queue.get(timeout=wait)
+            except queue.Empty:
+                pass
+
+    def qsize(self):
+        """
+        内存队列加上磁盘里还没有发送的数据条数
+        :return:
+        """
+        size = self.queue.qsize()
+        if self.fair is not None:
+            size += len(self.fair)
+        if self.spool is not None:
+            size += self.spool.pending()
+        return size
+
+    def ack(self):
+        """
+        已经取出的数据发送成功, 磁盘里对应的分段可以删除
         :return:
         """
-        return self.queue.get(block=block, timeout=timeout)
+        if self.spool is not None:
+            self.spool.ack()
@@ -3,8 +3,17 @@ import time
 from multiprocessing import Process
 
 from octopus.comm.collector import Collector
+from octopus.comm.collector_selector import CollectorSelector
+from octopus.comm.datapoint import DataPoint, parse_lines
+from octopus.comm.rate_limit import default_rate_limits
+from octopus.comm.rollup import Rollup
+from octopus.comm.stderr_log import STDERR
+from octopus.comm.telemetry import REGISTRY, Publisher, collector_stats
 from octopus.process.process_queue import ProcessQueue
-from octopus.settings import ALIVE
+from octopus.process.shm_registry import NAME_SIZE, ShmRegistry
+from octopus.settings import (ALIVE, DEDUP_INTERVAL, DEDUP_ONLY_ZERO, EVICT_INTERVAL,
+                              KEEP_INVALID_LINES, NS_PREFIX, READER_PRUNE_INTERVAL, TELEMETRY_DIR,
+                              TELEMETRY_PUBLISH_INTERVAL)
 
 LOG = logging.getLogger('octopus')
 
@@ -14,24 +23,23 @@ class ReadProcess(Process):
     Read process
     """
 
-    def __init__(self, process_queue, collection_dict, *args, **kwargs):
+    def __init__(self, process_queue, channel, *args, registry=None, **kwargs):
         Process.__init__(self, *args, **kwargs)
 
         self.process_queue: ProcessQueue = process_queue
-        self.collection_dict = collection_dict
+        self.channel = channel  # 监控进程通过这个 UNIX socket 传递采集器的管道
+        self.registry: ShmRegistry = registry  # 监控进程发布的采集器状态, 只读
+        self.selector: CollectorSelector = None
+        self.collection_dict: dict = {}
         self.lines_collected = 0
         self.lines_dropped = 0
-        self.dedupinterval = 300
-        self.evictinterval = 600
-        self.deduponlyzero = False
-        self.ns_prefix = ""
-
-    def all_living_collectors(self):
-        """Generator to return all defined collectors that have
-           an active process."""
-        for col in self.collection_dict.values():
-            if col.proc is not None:
-                yield col
+        self.dedupinterval = DEDUP_INTERVAL
+        self.evictinterval = EVICT_INTERVAL
+        self.deduponlyzero = DEDUP_ONLY_ZERO
+        self.ns_prefix = NS_PREFIX
+        self.keep_invalid = KEEP_INVALID_LINES
+        self.rate_limits = default_rate_limits()  # 按采集器名称保存的令牌桶
+        self.rollup: Rollup = None
 
     def run(self):
         """Main loop for this thread.  Just reads from collectors,
@@ -40,32 +48,124 @@ class ReadProcess(Process):
 
         LOG.debug("ReaderThread up and running")
 
+        # selector 必须在阅读进程内创建, 采集器也只在本进程内维护
+        self.selector = CollectorSelector(channel=self.channel)
+        self.collection_dict = self.selector.collectors
+        self.init_metrics()
+        self.rollup = Rollup()
+        publisher = Publisher(TELEMETRY_DIR, self.name, TELEMETRY_PUBLISH_INTERVAL)
+
         last_evict_time = 0
-        # we loop every second for now.  ideally we'll setup some
-        # select or other thing to wait for input on our children,
-        # while breaking out every once in a while to setup selects
-        # on new children.
+        last_prune_time = time.time()
+        # select 只在采集器的管道可读或者需要清理去重缓存时才返回
         while ALIVE:
-            for col in self.all_living_collectors():
-                for line in col.collect():
-                    self.process_line(col, line)
-
+            timeout = None
+            if self.registry is not None:
+                now = time.time()
+                if now - last_prune_time > READER_PRUNE_INTERVAL:
+                    last_prune_time = now
+                    self.prune()
+                timeout = last_prune_time + READER_PRUNE_INTERVAL - now
             if self.dedupinterval != 0:  # if 0 we do not use dedup
                 now = int(time.time())
                 if now - last_evict_time > self.evictinterval:
                     last_evict_time = now
-                    now -= self.evictinterval
-                    for col in self.collection_dict.values():
-                        col.evict_old_keys(now)
+                    for col in list(self.collection_dict.values()):
+                        col.evict_old_keys(now - self.evictinterval)
+                evict_timeout = last_evict_time + self.evictinterval + 1 - now
+                timeout = evict_timeout if timeout is None else min(timeout, evict_timeout)
+            # 定期把指标快照写到磁盘, 由监控进程汇总
+            timeout = publisher.next_timeout() if timeout is None else min(timeout, publisher.next_timeout())
+            rollup_timeout = self.rollup.next_timeout(time.time())
+            if rollup_timeout is not None:
+                timeout = min(timeout, rollup_timeout)
 
-            # and here is the loop that we really should get rid of, this
-            # just prevents us from spinning right now
-            time.sleep(1)
+            for col in self.selector.select(timeout):
+                try:
+                    self.process_lines(col, list(col.collect()))
+                except Exception:
+                    # 一个采集器的数据出错不能停止读取其他采集器
+                    LOG.exception('%s: failed to process collector output', col.name)
+            try:
+                self.emit_rollups()
+            except Exception:
+                LOG.exception('failed to emit rollups')
+            publisher.maybe_publish()
 
-    def process_line(self, col: Collector, line):
-        """Parses the given line and appends the result to the reader queue.
-        处理数据并添加到阅读队列
+    def prune(self):
+        """
+        监控进程里已经不存在的采集器, 在这里的去重缓存和令牌桶一起释放;
+        还有管道没有读完的不释放
         """
-        col.lines_sent += 1
-        if not self.process_queue.put_queue(col.name, line):
-            self.lines_dropped += 1
+        published, states = self.registry.snapshot()
+        if not published:
+            return
+        active = self.selector.active_collectors()
+        pruned = 0
+        for name, col in list(self.collection_dict.items()):
+            if name in states or col in active or col.data_lines:
+                continue
+            if len(name.encode("utf-8")) >= NAME_SIZE:
+                continue  # 名称在共享内存里被截断, 无法比较
+            del self.collection_dict[name]
+            self.rate_limits.forget(name)
+            STDERR.forget(name)
+            pruned += 1
+        if pruned:
+            LOG.info('%s: released %d removed collectors', self.name, pruned)
+
+    def init_metrics(self):
+        """在运行的线程/进程里创建指标"""
+        self.lines_read = REGISTRY.counter("octopus_lines_read_total", "lines read from collectors")
+        self.lines_invalid = REGISTRY.counter("octopus_lines_invalid_total", "lines that could not be parsed")
+        self.lines_deduped = REGISTRY.counter("octopus_lines_deduped_total", "datapoints suppressed by dedup")
+        self.lines_enqueued = REGISTRY.counter("octopus_lines_enqueued_total", "items put into the send queue")
+        self.read_seconds = REGISTRY.histogram("octopus_read_seconds",
+                                               "parse, dedup and enqueue time per collector batch")
+        REGISTRY.add_collector(collector_stats(self.collection_dict))
+
+    def process_lines(self, col: Collector, lines):
+        """Parses the given lines and appends the result to the reader queue.
+        解析数据, 去重后添加到阅读队列
+        """
+        start = time.monotonic()
+        self.lines_read.inc(len(lines))
+        if self.rate_limits.enabled():
+            lines, dropped = self.rate_limits.admit(col.name, lines)
+            col.lines_dropped += dropped
+        # keep_invalid 时不符合行协议的行留在原来的位置, 原样发送
+        points, invalid = parse_lines(lines, self.ns_prefix, self.keep_invalid)
+        if invalid:
+            self.lines_invalid.inc(len(invalid))
+            col.lines_invalid += len(invalid)
+            LOG.debug('%s: %d invalid lines', col.name, len(invalid))
+        if self.rollup.enabled():
+            # 聚合的序列看到的是去重之前的全部数据
+            points = self.rollup.add(col.name, points)
+
+        if self.dedupinterval:
+            deduped = []
+            for dp in points:
+                if isinstance(dp, DataPoint):
+                    deduped.extend(col.values.filter(dp))
+                else:
+                    deduped.append(dp)
+            self.lines_deduped.inc(max(0, len(points) - len(deduped)))
+            points = deduped
+
+        if points:
+            # 同一个采集器的一批数据一次写入, 进程间按批传输
+            col.lines_sent += len(points)
+            self.lines_collected += len(points)
+            if not self.process_queue.put_batch([(col.name, dp, start) for dp in points]):
+                self.lines_dropped += len(points)
+            self.lines_enqueued.inc(len(points))
+        self.read_seconds.record(time.monotonic() - start)
+
+    def emit_rollups(self):
+        """结束的窗口的聚合值不再去重, 一次写入队列"""
+        items = self.rollup.flush(time.time())
+        if items:
+            now = time.monotonic()
+            self.process_queue.put_batch([(name, dp, now) for name, dp in items])
+            self.lines_enqueued.inc(len(items))
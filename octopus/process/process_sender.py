@@ -1,10 +1,15 @@
 import logging
+import time
+from collections import Counter
 from multiprocessing import Process
-from pydoc import locate
-from time import sleep
 
-# from octopus.comm.queue import ProcessQueue
-from octopus.settings import SEND_MIDDLEWARES
+from octopus.comm.sender import MiddlewareChain, batch_lag, drain_batch
+from octopus.comm.telemetry import REGISTRY, Publisher, gather, to_datapoints
+from octopus.process.process_queue import ProcessQueue
+from octopus.process.shm_registry import NAME_SIZE, ShmRegistry
+from octopus.settings import (READER_PRUNE_INTERVAL, SENDER_FLUSH_INTERVAL, SENDER_MAX_BATCH_SIZE,
+                              SENDER_MAX_LINGER_MS, TELEMETRY_DIR, TELEMETRY_EMIT_INTERVAL,
+                              TELEMETRY_METRIC_PREFIX, TELEMETRY_PUBLISH_INTERVAL)
 
 LOG = logging.getLogger('octopus')
 
@@ -14,17 +19,70 @@ class SenderProcess(Process):
     sender process
     """
 
-    def __init__(self, process_queue, *args, **kwargs):
+    def __init__(self, process_queue, *args, registry=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.process_queue: ProcessQueue = process_queue
+        self.registry: ShmRegistry = registry  # 监控进程发布的采集器状态, 只读
+        self.delivered = Counter()  # 采集器名称 -> 投递成功的条数
+        self.max_batch_size = SENDER_MAX_BATCH_SIZE
+        self.max_linger_ms = SENDER_MAX_LINGER_MS
+        # 多个分片时只由第一个发送进程汇总并发送自身的运行指标
+        self.emit_interval = TELEMETRY_EMIT_INTERVAL if process_queue.shard in (None, 0) else 0
 
     def run(self):
+        chain = MiddlewareChain()  # 中间件在子进程里创建一次
+        publisher = Publisher(TELEMETRY_DIR, self.name, TELEMETRY_PUBLISH_INTERVAL)
+        REGISTRY.gauge("octopus_queue_depth", "items waiting to be sent", fn=self.process_queue.qsize)
+        spool = self.process_queue.spool
+        if spool is not None:
+            REGISTRY.gauge("octopus_spool_dropped", "items dropped because the spool was full",
+                           fn=lambda: spool.dropped.value)
+        batch_size = REGISTRY.histogram("octopus_sender_batch_size", "items per sender batch", scale=1)
+        send_lag = REGISTRY.histogram("octopus_send_lag_seconds",
+                                      "read from the collector to hand-off to the middlewares, "
+                                      "oldest item per batch")
+        REGISTRY.add_collector(self.delivered_stats)
+        last_emit = time.time()
+        last_prune_time = time.time()
         while True:
             try:
-                line = self.process_queue.get_queue()
-                for k, v in SEND_MIDDLEWARES.items():
-                    obj = locate(k)()
-                    obj.send(line)
+                if self.registry is not None and time.time() - last_prune_time > READER_PRUNE_INTERVAL:
+                    last_prune_time = time.time()
+                    self.prune()
+                timeout = min(publisher.next_timeout(), SENDER_FLUSH_INTERVAL)
+                if self.emit_interval > 0:
+                    timeout = min(timeout, max(0.0, last_emit + self.emit_interval - time.time()))
+                lines = drain_batch(self.process_queue, self.max_batch_size, self.max_linger_ms, timeout)
+                if lines:
+                    batch_size.record(len(lines))
+                    lag = batch_lag(lines)
+                    if lag is not None:
+                        send_lag.record(lag)
+                    chain.deliver(lines)  # 失败时重试, 成功之后才 ack
+                    self.process_queue.ack()
+                    self.delivered.update(item[0] for item in lines)
+                else:
+                    chain.flush()  # 空闲时中间件按时间换分段、收取在途的响应
+                publisher.maybe_publish()
+                if self.emit_interval > 0 and time.time() - last_emit >= self.emit_interval:
+                    # 自身的运行指标(包括其他进程发布的快照)作为 octopus 采集器的数据发送
+                    last_emit = time.time()
+                    entries = gather(worker=self.name, directory=TELEMETRY_DIR,
+                                     max_age=3 * TELEMETRY_PUBLISH_INTERVAL)
+                    points = to_datapoints(entries, TELEMETRY_METRIC_PREFIX)
+                    chain.send_batch([("octopus", dp) for dp in points])
             except Exception as e:
                 LOG.error(e)
-            sleep(0.01)
+
+    def delivered_stats(self):
+        return [("octopus_collector_lines_delivered_total", "counter", "items accepted by every middleware",
+                 {"collector": name}, count) for name, count in list(self.delivered.items())]
+
+    def prune(self):
+        """监控进程里已经不存在的采集器, 释放按名称保存的计数"""
+        published, states = self.registry.snapshot()
+        if not published:
+            return
+        for name in list(self.delivered):
+            if name not in states and len(name.encode("utf-8")) < NAME_SIZE:
+                del self.delivered[name]
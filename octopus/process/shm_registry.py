@@ -0,0 +1,113 @@
+"""
+监控进程维护的采集器状态, 定期整表发布到共享内存, 阅读进程只读
+
+布局: 头部是 seq(写入时为奇数)、记录数与发布时间, 之后是定长记录, 每个采集器一条;
+只有监控进程写入, 读取方按 seqlock 检查 seq 前后一致, 不需要锁也没有 IPC 往返
+"""
+import atexit
+import logging
+import os
+import struct
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+from octopus.settings import REGISTRY_SHM_CAPACITY, REGISTRY_SHM_PUBLISH_INTERVAL
+
+LOG = logging.getLogger('octopus')
+
+SEQ = struct.Struct('<Q')
+HEADER = struct.Struct('<QId')  # seq, 记录数, 发布时间
+DATA_OFFSET = 64
+NAME_SIZE = 128  # 名称的最大字节数, 超长的被截断
+# 名称, interval, pid, m_time, last_spawn, next_spawn, kill_state, dead
+RECORD = struct.Struct('<%dsiidddB?' % NAME_SIZE)
+
+CollectorState = namedtuple("CollectorState", ["name", "interval", "pid", "m_time", "last_spawn",
+                                               "next_spawn", "kill_state", "dead"])
+
+
+class ShmRegistry:
+    """
+    shm registry
+
+    在监控进程里创建, fork 出来的工作进程继承同一块共享内存;
+    publish 由监控进程调用, snapshot 在任何进程里调用
+    """
+
+    def __init__(self, capacity=None, interval=None):
+        self.capacity = capacity or REGISTRY_SHM_CAPACITY
+        self.interval = REGISTRY_SHM_PUBLISH_INTERVAL if interval is None else interval
+        self.shm = shared_memory.SharedMemory(create=True, size=DATA_OFFSET + self.capacity * RECORD.size)
+        self.buf = self.shm.buf
+        # 先打包到这里, 写入时只有一次拷贝; 第一次发布时才分配, fork 出来的工作进程里没有这块内存
+        self._staging = bytearray()
+        self.last_publish = 0
+        self._truncated = False
+        self._owner = os.getpid()
+        atexit.register(self._cleanup)
+
+    def _cleanup(self):
+        if os.getpid() == self._owner and self.buf is not None:
+            self.close(unlink=True)
+
+    def next_timeout(self, now=None):
+        if now is None:
+            now = time.time()
+        return max(0.0, self.last_publish + self.interval - now)
+
+    def maybe_publish(self, collection_dict):
+        now = time.time()
+        if now - self.last_publish >= self.interval:
+            self.publish(collection_dict, now)
+
+    def publish(self, collection_dict, now=None):
+        now = time.time() if now is None else now
+        self.last_publish = now
+        count = 0
+        cols = list(collection_dict.values())
+        needed = min(len(cols), self.capacity) * RECORD.size
+        if len(self._staging) < needed:
+            self._staging = bytearray(needed)
+        staging = self._staging
+        for col in cols:
+            if count >= self.capacity:
+                if not self._truncated:
+                    LOG.warning('more than %d collectors, REGISTRY_SHM_CAPACITY is too small', self.capacity)
+                    self._truncated = True
+                break
+            RECORD.pack_into(staging, count * RECORD.size, col.name.encode("utf-8"), col.interval,
+                             col.proc.pid if col.proc is not None else 0, col.m_time, col.last_spawn,
+                             col.next_spawn, col.kill_state, col.dead)
+            count += 1
+
+        size = count * RECORD.size
+        seq = SEQ.unpack_from(self.buf, 0)[0]
+        SEQ.pack_into(self.buf, 0, seq + 1)  # 奇数: 正在写入
+        self.buf[DATA_OFFSET:DATA_OFFSET + size] = staging[:size]
+        HEADER.pack_into(self.buf, 0, seq + 2, count, now)
+
+    def snapshot(self, retries=100):
+        """
+        :return: (发布时间, {采集器名称: CollectorState}), 还没有发布过时发布时间为 0
+        """
+        for _ in range(retries):
+            seq, count, published = HEADER.unpack_from(self.buf, 0)
+            if seq & 1:
+                time.sleep(0)
+                continue
+            data = bytes(self.buf[DATA_OFFSET:DATA_OFFSET + count * RECORD.size])
+            if SEQ.unpack_from(self.buf, 0)[0] != seq:
+                continue  # 读的时候被改写了
+            states = {}
+            for record in RECORD.iter_unpack(data):
+                state = CollectorState(record[0].rstrip(b"\0").decode("utf-8", "replace"), *record[1:])
+                states[state.name] = state
+            return published, states
+        raise TimeoutError("registry snapshot kept changing")
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
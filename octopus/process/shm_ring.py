@@ -0,0 +1,162 @@
+import atexit
+import logging
+import os
+import queue
+import select
+import struct
+import time
+from collections import deque
+from multiprocessing import shared_memory
+
+LOG = logging.getLogger('octopus')
+
+LENGTH = struct.Struct('<I')
+STAMP = struct.Struct('<d')  # 一批数据的读取时间, time.monotonic()
+COUNTER = struct.Struct('<Q')
+HEAD, ITEMS_IN, TAIL, ITEMS_OUT = 0, 8, 64, 72
+DATA_OFFSET = 128
+
+
+class ShmRing:
+    """
+    基于共享内存的单生产者/单消费者字节环, 阅读进程写入, 发送进程读取
+
+    共享内存布局: head(写位置), items_in 在第一个 cache line, tail(读位置), items_out
+    在第二个 cache line, 之后是数据区; 每条记录是 4 字节长度 + 8 字节读取时间 + 一批以换行
+    分隔的 "采集器名称\\0数据" 文本. 只在消费者可能在等待时通过 eventfd(或管道) 唤醒
+    """
+
+    def __init__(self, capacity=64 * 1024 * 1024):
+        if capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of two")
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.shm = shared_memory.SharedMemory(create=True, size=DATA_OFFSET + capacity)
+        self.buf = self.shm.buf
+        if hasattr(os, "eventfd"):
+            self._wakeup_r = self._wakeup_w = os.eventfd(0, os.EFD_NONBLOCK)
+        else:
+            self._wakeup_r, self._wakeup_w = os.pipe()
+            os.set_blocking(self._wakeup_r, False)
+            os.set_blocking(self._wakeup_w, False)
+        self._pending = deque()  # 消费者已经解码还没有取走的数据
+        self._owner = os.getpid()
+        atexit.register(self._cleanup)
+
+    def _cleanup(self):
+        # 只由创建共享内存的进程删除, fork 出来的进程退出时不会执行 atexit
+        if os.getpid() == self._owner and self.buf is not None:
+            self.close(unlink=True)
+
+    def _load(self, offset):
+        # 不长期持有共享内存的子视图, 否则进程退出时 SharedMemory 无法关闭
+        return COUNTER.unpack_from(self.buf, offset)[0]
+
+    def _store(self, offset, value):
+        COUNTER.pack_into(self.buf, offset, value)
+
+    def qsize(self):
+        return self._load(ITEMS_IN) - self._load(ITEMS_OUT)
+
+    def empty(self):
+        return not self._pending and self._load(HEAD) == self._load(TAIL)
+
+    def put(self, item, block=True, timeout=None):
+        self.put_batch([item], block, timeout)
+
+    def put_batch(self, items, block=True, timeout=None):
+        """
+        写入一批 (采集器名称, 数据, 读取时间), 空间不够时等待消费者;
+        一批数据来自同一次读取, 只保存第一条的读取时间
+        """
+        if not items:
+            return
+        payload = "\n".join(["%s\0%s" % (item[0], item[1]) for item in items]).encode("utf-8")
+        size = LENGTH.size + STAMP.size + len(payload)
+        if size > self.capacity:
+            raise ValueError("batch of %d bytes is larger than the ring" % size)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0001
+        while True:
+            head = self._load(HEAD)
+            if self.capacity - (head - self._load(TAIL)) >= size:
+                break
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                raise queue.Full
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+
+        self._write(head, LENGTH.pack(len(payload)) + STAMP.pack(items[0][2]))
+        self._write(head + LENGTH.size + STAMP.size, payload)
+        self._store(ITEMS_IN, self._load(ITEMS_IN) + len(items))
+        self._store(HEAD, head + size)
+        if self._load(TAIL) == head:
+            # 写入之前环是空的, 消费者可能在等待
+            try:
+                os.write(self._wakeup_w, (1).to_bytes(8, "little"))
+            except BlockingIOError:
+                pass
+
+    def _write(self, pos, data):
+        offset = pos & self.mask
+        first = min(len(data), self.capacity - offset)
+        start = DATA_OFFSET + offset
+        self.buf[start:start + first] = data[:first]
+        if first < len(data):
+            self.buf[DATA_OFFSET:DATA_OFFSET + len(data) - first] = data[first:]
+
+    def _read(self, pos, size):
+        """读取 size 字节, 不跨越环尾时直接从 memoryview 解码, 不产生中间拷贝"""
+        offset = pos & self.mask
+        start = DATA_OFFSET + offset
+        if offset + size <= self.capacity:
+            return self.buf[start:start + size]
+        first = self.capacity - offset
+        return memoryview(bytes(self.buf[start:start + first])
+                          + bytes(self.buf[DATA_OFFSET:DATA_OFFSET + size - first]))
+
+    def get(self, block=True, timeout=None):
+        """
+        :return: (采集器名称, 数据, 读取时间)
+        """
+        if self._pending:
+            return self._pending.popleft()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            tail = self._load(TAIL)
+            if self._load(HEAD) != tail:
+                header = self._read(tail, LENGTH.size + STAMP.size)
+                size, = LENGTH.unpack_from(header)
+                stamp, = STAMP.unpack_from(header, LENGTH.size)
+                header.release()
+                view = self._read(tail + LENGTH.size + STAMP.size, size)
+                text = str(view, "utf-8")
+                view.release()
+                self._store(TAIL, tail + LENGTH.size + STAMP.size + size)
+                for part in text.split("\n"):
+                    name, _, value = part.partition("\0")
+                    self._pending.append((name, value, stamp))
+                self._store(ITEMS_OUT, self._load(ITEMS_OUT) + len(self._pending))
+                return self._pending.popleft()
+
+            if not block:
+                raise queue.Empty
+            wait = 0.05  # 兜底的轮询间隔
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    raise queue.Empty
+            try:
+                os.read(self._wakeup_r, 8)
+            except BlockingIOError:
+                pass
+            if self._load(HEAD) == tail:
+                select.select([self._wakeup_r], [], [], wait)
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
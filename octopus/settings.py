@@ -7,13 +7,165 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # 默认日志位置
 DEFAULT_LOG = "{}/logs/octopus.log".format(BASE_DIR)
 
-# 发送数据的中间件
+# 发送数据的中间件, 按数值从小到大依次调用, None 表示不启用
 SEND_MIDDLEWARES = {
     "octopus.middlewares.send_kafka.SendKafkaMiddleware": 200,
 }
 
+# 发送端攒批: 最多攒 SENDER_MAX_BATCH_SIZE 条, 或者最多等待 SENDER_MAX_LINGER_MS 毫秒
+SENDER_MAX_BATCH_SIZE = 1000
+SENDER_MAX_LINGER_MS = 100
+# 中间件发送失败时这一批按指数退避重试到成功为止, 成功之前不确认磁盘队列里的数据
+SENDER_RETRY_BACKOFF = 0.5  # 第一次重试前等待的秒数, 之后每次翻倍
+SENDER_RETRY_BACKOFF_MAX = 30
+SENDER_FLUSH_INTERVAL = 1  # 没有数据时每隔多少秒调用一次中间件的 flush, 例如按时间换文件分段
+
+# 采集器发现: Linux 下使用 inotify 监听 collectors 目录, 否则检查目录的 mtime,
+# mtime 模式下每 DISCOVERY_FULL_RESCAN_INTERVAL 秒做一次全量扫描
+DISCOVERY_USE_INOTIFY = True
+DISCOVERY_FULL_RESCAN_INTERVAL = 60
+
+# 采集器第一次执行时的最大随机延迟(秒), 不超过采集器自身的时间间隔
+SPAWN_JITTER = 1.0
+
+# Python 采集器通过预先导入模块的 fork-server 执行, 省掉解释器启动的开销
+FORK_SERVER_ENABLED = False
+FORK_SERVER_PRELOAD = ["os", "sys", "time", "json", "re", "socket", "subprocess"]
+# 只有 shebang 指向 octopus 自己的解释器(sys.executable)且没有参数的脚本使用 fork-server,
+# 其他脚本需要显式列在这里(路径或者文件名的通配符)
+FORK_SERVER_ALLOWLIST = []
+
 # 需要移除监控的采集程序
 REMOVE_INACTIVE_COLLECTORS = []
 ALLOWED_INACTIVITY_TIME = 60 * 3  # 3分钟
 
+# 磁盘溢出队列: 内存队列超过 SPOOL_HIGH_WATER 条后写入 SPOOL_DIR 下的分段文件
+SPOOL_ENABLED = False
+SPOOL_DIR = "{}/spool".format(BASE_DIR)
+SPOOL_HIGH_WATER = 8000
+SPOOL_SEGMENT_SIZE = 64 * 1024 * 1024  # 单个分段文件的大小
+SPOOL_MAX_BYTES = 1024 * 1024 * 1024  # 超过后丢弃最旧的分段
+SPOOL_POLL_INTERVAL = 0.05  # 发送端等待磁盘数据的间隔, 秒
+
+# 进程模式下阅读进程与发送进程之间的传输方式: shm 共享内存字节环, queue 为 multiprocessing.Queue
+PROCESS_TRANSPORT = "shm"
+PROCESS_RING_SIZE = 64 * 1024 * 1024  # 字节, 必须是 2 的幂
+# 进程模式下阅读进程的数量, 采集器按名称的一致性哈希分配; 每个阅读进程有自己的队列和发送进程
+PROCESS_READER_WORKERS = os.cpu_count() or 1
+
+# 采集器限流: 每秒行数/字节数, 0 表示不限制; COLLECTOR_RATE_LIMITS 按采集器名称覆盖, 如 {"noisy.py": (1000, 0)}
+COLLECTOR_MAX_LINES_PER_SEC = 0
+COLLECTOR_MAX_BYTES_PER_SEC = 0
+COLLECTOR_RATE_LIMITS = {}
+RATE_LIMIT_BURST = 1.0  # 令牌桶最多攒多少秒的令牌
+RATE_LIMIT_ACTION = "drop"  # drop 丢弃超出的行, sample 超出的行每 RATE_LIMIT_SAMPLE 行保留 1 行
+RATE_LIMIT_SAMPLE = 10
+
+# 发送队列按采集器分成子队列, 按 deficit round-robin 轮流发送
+FAIR_QUEUE_ENABLED = True
+FAIR_QUEUE_QUANTUM = 100  # 每一轮每个采集器最多取的条数
+# 单个采集器排队的上限, 超过后暂停读取这个采集器(开启 spool 时写磁盘), 其他采集器照常读取, 不丢弃
+FAIR_QUEUE_MAX_PER_COLLECTOR = 5000
+FAIR_QUEUE_RETRY_INTERVAL = 0.05  # 暂停读取的采集器每隔这么多秒重试写入队列, 秒
+
+# 自身运行指标: HTTP 监听地址 "host:port" 与 UNIX socket 路径, 为 None 时不监听
+TELEMETRY_HTTP_ADDRESS = "127.0.0.1:9465"
+TELEMETRY_UNIX_SOCKET = None
+TELEMETRY_DIR = "{}/run/telemetry".format(BASE_DIR)  # 进程模式下子进程的指标快照
+TELEMETRY_PUBLISH_INTERVAL = 5  # 子进程写快照的间隔, 秒
+TELEMETRY_EMIT_INTERVAL = 0  # 大于 0 时每隔这么多秒把自身指标作为数据发送, 秒
+TELEMETRY_METRIC_PREFIX = "octopus."
+
+# 采集器的 stderr: 每个采集器保留最近的行数(telemetry 的 /stderr.json), 写日志时每个采集器
+# 每秒最多的行数(0 表示不限制)与令牌桶最多攒的秒数, 超出的行只计数, 之后输出一条汇总
+STDERR_RING_LINES = 100
+STDERR_LOG_LINES_PER_SEC = 10
+STDERR_LOG_BURST = 10
+
+# Kafka 发送配置
+KAFKA_BOOTSTRAP_SERVERS = "localhost:9092"
+KAFKA_TOPIC = "octopus"
+# None 表示自动选择: confluent, kafka-python, 都没有安装时打印; 也可以指定 memory
+KAFKA_PRODUCER = None
+KAFKA_COMPRESSION = "gzip"  # None, gzip, lz4, zstd
+KAFKA_LINGER_MS = 5
+KAFKA_BATCH_SIZE = 1024 * 1024  # 字节
+KAFKA_MAX_IN_FLIGHT = 1000  # 还没有收到投递结果的消息数量上限
+KAFKA_CLOSE_TIMEOUT = 10  # 退出时等待在途消息投递的秒数
+
+# 文件发送: octopus.middlewares.send_file.SendFileMiddleware 写入的目录与分段配置
+FILE_SINK_DIR = "{}/data/sink".format(BASE_DIR)
+FILE_SINK_SEGMENT_BYTES = 64 * 1024 * 1024  # 分段超过这个大小后换新的分段
+FILE_SINK_SEGMENT_SECONDS = 300  # 分段打开超过这么多秒后换新的分段
+FILE_SINK_INDEX_BYTES = 1024 * 1024  # 每写这么多字节记录一条索引, 也是压缩和回放的块大小
+FILE_SINK_COMPRESSION = "gzip"  # None, gzip, zstd
+
+# 网络发送: send_network.SendTsdbMiddleware(TCP put) 与 SendHttpMiddleware(HTTP JSON POST)
+# 的节点, 按顺序使用, 前面的节点失败时转到后面的节点
+TSDB_SINK_ENDPOINTS = ["localhost:4242"]
+HTTP_SINK_ENDPOINTS = ["http://localhost:4242/api/put"]
+NETWORK_SINK_POOL_SIZE = 2  # 每个节点的长连接数
+NETWORK_SINK_PIPELINE = 8  # 每个连接上不等响应连续发送的批次数
+NETWORK_SINK_TIMEOUT = 5  # 连接与读写超时, 秒
+NETWORK_SINK_BACKOFF_BASE = 0.1  # 节点第一次失败后的退避时间, 之后每次翻倍, 秒
+NETWORK_SINK_BACKOFF_MAX = 30
+NETWORK_SINK_MAX_RETRIES = 5  # 一次发送里换节点重试的次数, 超过后失败, 由发送端退避后重试
+
+# 采集器输出按 "metric timestamp value tag=v ..." 或 JSON 行解析
+NS_PREFIX = ""  # 给所有 metric 加上的前缀
+KEEP_INVALID_LINES = True  # 不符合行协议的数据是否原样发送, 无论是否发送都会计入 lines_invalid
+
+# 去重: 同一个序列在 DEDUP_INTERVAL 秒内值不变时不重复发送, 0 表示不去重
+DEDUP_INTERVAL = 300
+EVICT_INTERVAL = 600  # 超过这个时间没有出现的序列会从去重缓存中清理
+DEDUP_ONLY_ZERO = False  # 只对值为 0 的数据去重
+DEDUP_MAX_KEYS = 10000  # 每个采集器去重缓存的最大序列数
+
+# 预聚合: 匹配规则的序列按 window 秒聚合, 窗口结束后只发送聚合值, metric 加上 ".count" 等后缀;
+# 规则按顺序匹配, collector 与 metric 为通配符, 如
+# {"collector": "*", "metric": "sys.cpu.*", "window": 10, "aggregates": ["count", "sum", "min", "max", "last", "p99"]}
+ROLLUP_RULES = []
+ROLLUP_MAX_SERIES = 100000  # 聚合的序列数上限, 超过后新的序列原样发送
+ROLLUP_GRACE = 2  # 窗口结束后再等这么多秒接收迟到的数据, 秒
+ROLLUP_SKETCH_ACCURACY = 0.01  # 分位数的相对误差
+ROLLUP_SKETCH_MAX_BINS = 512  # 每个窗口分位数草图的桶数上限, 覆盖最大值以下约 4 个数量级
+
+# 采集器输出单行的最大字节数, 超长的行会被丢弃, 0 表示不限制
+MAX_LINE_LENGTH = 64 * 1024
+
+# 进程模式下监控进程把采集器状态发布到共享内存: 最多的采集器数量(每个 162 字节)与发布间隔(秒)
+REGISTRY_SHM_CAPACITY = 32768
+REGISTRY_SHM_PUBLISH_INTERVAL = 5
+# 阅读进程和发送进程每隔这么多秒按共享内存里的状态释放已经移除的采集器
+READER_PRUNE_INTERVAL = 60
+
+# 采集器 SIGTERM 之后等待退出的秒数, 超时后给整个进程组发送 SIGKILL
+TERMINATE_GRACE = 5
+
+# 进程内插件(plugins/<interval>/*.py)的线程池大小, 常驻插件(interval 为 0)单独一个线程
+PLUGIN_WORKERS = 4
+# 插件一次执行的超时秒数, 插件类的 timeout 属性优先; None 时使用采集间隔
+PLUGIN_TIMEOUT = None
+
+# 收到 SIGHUP 时启动新的 octopus, 通过这个 UNIX socket 把运行中的采集器交给它, 采集器不重启(只支持线程模式)
+UPGRADE_SOCKET = "{}/octopus-upgrade.sock".format(BASE_DIR)
+UPGRADE_TIMEOUT = 30  # 等待新进程连接和接管的秒数, 超时后放弃升级继续运行
+UPGRADE_DRAIN_TIMEOUT = 5  # 交接之后旧进程发送队列里剩余数据的最长秒数, 新进程在这之后开始发送
+
+# 采集器资源统计: 每个采集器保留最近多少次执行的 CPU/最大 RSS/耗时, 常驻采集器每隔多少秒读一次 /proc/<pid>/stat
+RESOURCE_HISTORY = 20
+RESOURCE_SAMPLE_INTERVAL = 10
+
+# 按负载拉长采集间隔(默认关闭): 每 CPU 的 1 分钟负载超过 THROTTLE_LOAD_PER_CPU, 或者 octopus 与采集器
+# 用掉的 CPU 超过 THROTTLE_CPU_BUDGET 个核时, 每 THROTTLE_CHECK_INTERVAL 秒把一个最耗 CPU 的周期采集器
+# 的间隔加倍, 最多 THROTTLE_MAX_FACTOR 倍; 降到上限的 THROTTLE_RESTORE_RATIO 以下时逐个恢复.
+# THROTTLE_PROTECTED 里的采集器名称(通配符)不调整
+THROTTLE_ENABLED = False
+THROTTLE_LOAD_PER_CPU = 1.5
+THROTTLE_CPU_BUDGET = 0.5
+THROTTLE_RESTORE_RATIO = 0.7
+THROTTLE_MAX_FACTOR = 8
+THROTTLE_CHECK_INTERVAL = 30
+THROTTLE_PROTECTED = []
+
 ALIVE = True
@@ -1,9 +1,17 @@
 import logging
 import multiprocessing
 import queue
+import time
+from collections import deque
 # from multiprocessing import Queue
 from queue import Queue
 
+from octopus.comm.fair_queue import FairQueue
+from octopus.comm.spool import Spool
+from octopus.settings import (FAIR_QUEUE_ENABLED, FAIR_QUEUE_MAX_PER_COLLECTOR, FAIR_QUEUE_QUANTUM,
+                              SPOOL_DIR, SPOOL_ENABLED, SPOOL_HIGH_WATER, SPOOL_MAX_BYTES,
+                              SPOOL_POLL_INTERVAL, SPOOL_SEGMENT_SIZE)
+
 LOG = logging.getLogger('octopus')
 
 
@@ -53,38 +61,132 @@ class ThreadQueue:
             cls.__instance = obj
             return cls.__instance
 
-    def __init__(self, do_filter=True, *args, **kwargs):
-        self.do_filter = do_filter
-        self.queue = Queue(maxsize=10000)
-        self.data_duplication_dict: dict = {}
+    def __init__(self, *args, **kwargs):
+        if FAIR_QUEUE_ENABLED:
+            # 按采集器轮流取数据, 输出多的采集器不会让其他采集器的数据排队
+            self.queue = FairQueue(10000, FAIR_QUEUE_QUANTUM, FAIR_QUEUE_MAX_PER_COLLECTOR)
+        else:
+            self.queue = Queue(maxsize=10000)
+        # 内存队列超过高水位后溢出到磁盘
+        self.spool = None
+        self.high_water = SPOOL_HIGH_WATER
+        if SPOOL_ENABLED:
+            self.spool = Spool(SPOOL_DIR, SPOOL_SEGMENT_SIZE, SPOOL_MAX_BYTES)
+        # 没有 spool 时子队列满了的采集器的数据先放在这里, 阅读端暂停读取这个采集器并用 retry 放回队列;
+        # 只在阅读端的线程里修改
+        self.overflow: dict = {}  # 采集器名称 -> deque of item
+        self.overflow_size = 0
+
+    def _put(self, item, block, timeout):
+        """
+        :return: False 表示数据暂时放在 overflow, 这个采集器需要暂停读取
+        """
+        if self.spool is not None and (self.spool.pending() or self.queue.qsize() >= self.high_water):
+            # 磁盘里还有数据没有回放时继续写磁盘, 保证顺序
+            self.spool.append(item)
+            return
+        if self.spool is not None:
+            try:
+                self.queue.put(item, block=False)
+            except queue.Full:
+                # 单个采集器的子队列满了, 写磁盘而不是阻塞读取其他采集器
+                self.spool.append(item)
+            return True
+        if isinstance(self.queue, FairQueue):
+            # 不阻塞唯一的阅读线程, 一个采集器的子队列满了只影响这个采集器
+            held = self.overflow.get(item[0])
+            if held is None:
+                try:
+                    self.queue.put(item, block=False)
+                    return True
+                except queue.Full:
+                    held = self.overflow[item[0]] = deque()
+            held.append(item)
+            self.overflow_size += 1
+            return False
+        self.queue.put(item, block=block, timeout=timeout)
+        return True
 
-    def put_queue(self, obj_name, value, block=True, timeout=None):
+    def retry(self):
+        """
+        把 overflow 里的数据按顺序放回队列
+        :return: 已经全部放回的采集器名称
+        """
+        drained = []
+        for name, held in list(self.overflow.items()):
+            try:
+                while held:
+                    self.queue.put(held[0], block=False)
+                    held.popleft()
+                    self.overflow_size -= 1
+            except queue.Full:
+                continue
+            del self.overflow[name]
+            drained.append(name)
+        return drained
+
+    def put_queue(self, obj_name, value, block=True, timeout=None, read_time=None):
         """
         input value to queue
         :param obj_name:
         :param value:
         :param block:
         :param timeout:
-        :return:
+        :param read_time: 从采集器读到数据的 time.monotonic(), 默认为现在
+        :return: False 表示子队列已满, 数据暂时留在 overflow, 需要暂停读取这个采集器直到 retry 放回
         """
-        if self.do_filter:
-            self.queue.put(value, block=block, timeout=timeout)
-        else:
-            """
-            取到上一次的数据
-            """
-            last_value = self.data_duplication_dict.get(obj_name)
-            if last_value == value:
-                return False
-            else:
-                self.data_duplication_dict[obj_name] = value
-                self.queue.put(value, block=block, timeout=timeout)
+        return self._put((obj_name, value, time.monotonic() if read_time is None else read_time), block, timeout)
 
     def get_queue(self, block=True, timeout=None):
         """
         get value to queue
         :param block:
         :param timeout:
+        :return: (obj_name, value, read_time)
+        """
+        if self.spool is None:
+            return self.queue.get(block=block, timeout=timeout)
+
+        # 内存队列里的数据早于磁盘里的数据, 先取内存队列
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # 先看磁盘再看内存: 磁盘有数据之后写入端不会再写内存队列,
+            # 此时内存队列为空就说明磁盘里的数据是最早的
+            pending = self.spool.pending()
+            try:
+                return self.queue.get(block=False)
+            except queue.Empty:
+                pass
+            if pending:
+                item = self.spool.read()
+                if item is not None:
+                    return item
+            if not block:
+                raise queue.Empty
+            wait = SPOOL_POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    raise queue.Empty
+            try:
+                return self.queue.get(timeout=wait)
+            except queue.Empty:
+                pass
+
+    def qsize(self):
+        """
+        内存队列、overflow 加上磁盘里还没有发送的数据条数
+        :return:
+        """
+        size = self.queue.qsize() + self.overflow_size
+        if self.spool is not None:
+            size += self.spool.pending()
+        return size
+
+    def ack(self):
+        """
+        已经取出的数据发送成功, 磁盘里对应的分段可以删除
         :return:
         """
-        return self.queue.get(block=block, timeout=timeout)
+        if self.spool is not None:
+            self.spool.ack()
@@ -3,7 +3,13 @@ import threading
 import time
 
 from octopus.comm.collector import Collector
-from octopus.settings import ALIVE
+from octopus.comm.collector_selector import CollectorSelector
+from octopus.comm.datapoint import DataPoint, parse_lines
+from octopus.comm.rate_limit import default_rate_limits
+from octopus.comm.rollup import Rollup
+from octopus.comm.telemetry import REGISTRY, collector_stats
+from octopus.settings import (ALIVE, DEDUP_INTERVAL, DEDUP_ONLY_ZERO, EVICT_INTERVAL,
+                              FAIR_QUEUE_RETRY_INTERVAL, KEEP_INVALID_LINES, NS_PREFIX)
 
 LOG = logging.getLogger('octopus')
 
@@ -13,24 +19,21 @@ class ReadThread(threading.Thread):
     Read process
     """
 
-    def __init__(self, process_queue, collection_dict, *args, **kwargs):
+    def __init__(self, process_queue, collection_dict, selector, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.process_queue = process_queue
         self.collection_dict: dict = collection_dict
+        self.selector: CollectorSelector = selector
         self.lines_collected = 0
         self.lines_dropped = 0
-        self.dedupinterval = 300
-        self.evictinterval = 600
-        self.deduponlyzero = False
-        self.ns_prefix = ""
-
-    def all_living_collectors(self):
-        """Generator to return all defined collectors that have
-           an active process."""
-
-        for col in self.collection_dict.values():
-            if col.proc is not None:
-                yield col
+        self.dedupinterval = DEDUP_INTERVAL
+        self.evictinterval = EVICT_INTERVAL
+        self.deduponlyzero = DEDUP_ONLY_ZERO
+        self.ns_prefix = NS_PREFIX
+        self.keep_invalid = KEEP_INVALID_LINES
+        self.rate_limits = default_rate_limits()  # 按采集器名称保存的令牌桶
+        self.rollup: Rollup = None
+        self.paused: dict = {}  # 子队列满了暂停读取的采集器, 采集器名称 -> set of Collector
 
     def run(self):
         """Main loop for this thread.  Just reads from collectors,
@@ -38,35 +41,102 @@ class ReadThread(threading.Thread):
            into the queue."""
 
         LOG.debug("ReaderThread up and running")
+        self.init_metrics()
+        self.rollup = Rollup()
 
         last_evict_time = 0
-        # we loop every second for now.  ideally we'll setup some
-        # select or other thing to wait for input on our children,
-        # while breaking out every once in a while to setup selects
-        # on new children.
+        # select 只在采集器的管道可读或者需要清理去重缓存时才返回
         while ALIVE:
-            for col in self.all_living_collectors():
-                for line in col.collect():
-                    if line:
-                        self.process_line(col, line)
-
+            timeout = None
             if self.dedupinterval != 0:  # if 0 we do not use dedup
                 now = int(time.time())
                 if now - last_evict_time > self.evictinterval:
                     last_evict_time = now
-                    now -= self.evictinterval
-                    for col in self.collection_dict.values():
-                        col.evict_old_keys(now)
+                    for col in list(self.collection_dict.values()):
+                        col.evict_old_keys(now - self.evictinterval)
+                timeout = last_evict_time + self.evictinterval + 1 - now
+            rollup_timeout = self.rollup.next_timeout(time.time())
+            if rollup_timeout is not None:
+                timeout = rollup_timeout if timeout is None else min(timeout, rollup_timeout)
+            if self.process_queue.overflow:
+                self.resume_drained()
+                if self.process_queue.overflow:
+                    timeout = FAIR_QUEUE_RETRY_INTERVAL if timeout is None else \
+                        min(timeout, FAIR_QUEUE_RETRY_INTERVAL)
+
+            for col in self.selector.select(timeout):
+                try:
+                    self.process_lines(col, list(col.collect()))
+                except Exception:
+                    # 一个采集器的数据出错不能停止读取其他采集器
+                    LOG.exception('%s: failed to process collector output', col.name)
+            try:
+                self.emit_rollups()
+            except Exception:
+                LOG.exception('failed to emit rollups')
 
-            # and here is the loop that we really should get rid of, this
-            # just prevents us from spinning right now
-            time.sleep(0.1)
+    def init_metrics(self):
+        """在运行的线程/进程里创建指标"""
+        self.lines_read = REGISTRY.counter("octopus_lines_read_total", "lines read from collectors")
+        self.lines_invalid = REGISTRY.counter("octopus_lines_invalid_total", "lines that could not be parsed")
+        self.lines_deduped = REGISTRY.counter("octopus_lines_deduped_total", "datapoints suppressed by dedup")
+        self.lines_enqueued = REGISTRY.counter("octopus_lines_enqueued_total", "items put into the send queue")
+        self.read_seconds = REGISTRY.histogram("octopus_read_seconds",
+                                               "parse, dedup and enqueue time per collector batch")
+        REGISTRY.add_collector(collector_stats(self.collection_dict))
 
-    def process_line(self, col: Collector, line):
-        """Parses the given line and appends the result to the reader queue.
-        处理数据并添加到阅读队列
+    def process_lines(self, col: Collector, lines):
+        """Parses the given lines and appends the result to the reader queue.
+        解析数据, 去重后添加到阅读队列
         """
-        col.lines_sent += 1
-        self.process_queue.put_queue(col.name, line)
-        if not self.process_queue.put_queue(col.name, line):
-            self.lines_dropped += 1
+        start = time.monotonic()
+        self.lines_read.inc(len(lines))
+        if self.rate_limits.enabled():
+            lines, dropped = self.rate_limits.admit(col.name, lines)
+            col.lines_dropped += dropped
+        # keep_invalid 时不符合行协议的行留在原来的位置, 原样发送
+        points, invalid = parse_lines(lines, self.ns_prefix, self.keep_invalid)
+        if invalid:
+            self.lines_invalid.inc(len(invalid))
+            col.lines_invalid += len(invalid)
+            LOG.debug('%s: %d invalid lines', col.name, len(invalid))
+        if self.rollup.enabled():
+            # 聚合的序列看到的是去重之前的全部数据
+            points = self.rollup.add(col.name, points)
+
+        if self.dedupinterval:
+            deduped = []
+            for dp in points:
+                if isinstance(dp, DataPoint):
+                    deduped.extend(col.values.filter(dp))
+                else:
+                    deduped.append(dp)
+            self.lines_deduped.inc(max(0, len(points) - len(deduped)))
+            points = deduped
+
+        held = False
+        for dp in points:
+            col.lines_sent += 1
+            self.lines_collected += 1
+            if not self.process_queue.put_queue(col.name, dp, read_time=start):
+                held = True
+        if held:
+            # 这个采集器的子队列满了, 只暂停读取它, 管道满了之后采集器自己等待
+            self.paused.setdefault(col.name, set()).add(col)
+            self.selector.pause(col)
+        self.lines_enqueued.inc(len(points))
+        self.read_seconds.record(time.monotonic() - start)
+
+    def resume_drained(self):
+        """overflow 里的数据放回队列之后恢复读取这些采集器"""
+        for name in self.process_queue.retry():
+            for col in self.paused.pop(name, ()):
+                self.selector.resume(col)
+
+    def emit_rollups(self):
+        """结束的窗口的聚合值不再去重, 直接写入队列"""
+        items = self.rollup.flush(time.time())
+        if items:
+            for name, dp in items:
+                self.process_queue.put_queue(name, dp)
+            self.lines_enqueued.inc(len(items))
@@ -1,9 +1,11 @@
 import logging
 import threading
-from pydoc import locate
-from time import sleep
+import time
 
-from octopus.settings import SEND_MIDDLEWARES
+from octopus.comm.sender import MiddlewareChain, batch_lag, drain_batch
+from octopus.comm.telemetry import REGISTRY, gather, to_datapoints
+from octopus.settings import (SENDER_FLUSH_INTERVAL, SENDER_MAX_BATCH_SIZE, SENDER_MAX_LINGER_MS,
+                              TELEMETRY_EMIT_INTERVAL, TELEMETRY_METRIC_PREFIX)
 
 LOG = logging.getLogger('octopus')
 
@@ -16,14 +18,57 @@ class SenderThread(threading.Thread):
     def __init__(self, process_queue, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.process_queue = process_queue
+        self.max_batch_size = SENDER_MAX_BATCH_SIZE
+        self.max_linger_ms = SENDER_MAX_LINGER_MS
+        self.emit_interval = TELEMETRY_EMIT_INTERVAL
+        self.sent = 0  # 已经交给中间件的数据条数
+        self.drain_deadline = None  # 升级交接时设置, 见 drain
+        self.drained = threading.Event()
+
+    def drain(self, timeout):
+        """
+        升级交接之后调用: 等到队列(包括 spool)为空并且中间件确认投递完在途的数据
+        :return: 是否在 timeout 秒内完成
+        """
+        self.drain_deadline = time.time() + timeout
+        return self.drained.wait(timeout)
 
     def run(self):
+        chain = MiddlewareChain()  # 中间件只创建一次
+        REGISTRY.gauge("octopus_queue_depth", "items waiting to be sent", fn=self.process_queue.qsize)
+        spool = self.process_queue.spool
+        if spool is not None:
+            REGISTRY.gauge("octopus_spool_dropped", "items dropped because the spool was full",
+                           fn=lambda: spool.dropped.value)
+        batch_size = REGISTRY.histogram("octopus_sender_batch_size", "items per sender batch", scale=1)
+        send_lag = REGISTRY.histogram("octopus_send_lag_seconds",
+                                      "read from the collector to hand-off to the middlewares, "
+                                      "oldest item per batch")
+        last_emit = time.time()
         while True:
             try:
-                line = self.process_queue.get_queue()
-                for k, v in SEND_MIDDLEWARES.items():
-                    obj = locate(k)()
-                    obj.send(line)
+                timeout = SENDER_FLUSH_INTERVAL
+                if self.emit_interval > 0:
+                    timeout = min(timeout, max(0.0, last_emit + self.emit_interval - time.time()))
+                lines = drain_batch(self.process_queue, self.max_batch_size, self.max_linger_ms, timeout)
+                if lines:
+                    batch_size.record(len(lines))
+                    lag = batch_lag(lines)
+                    if lag is not None:
+                        send_lag.record(lag)
+                    chain.deliver(lines)  # 失败时重试, 成功之后才 ack
+                    self.process_queue.ack()
+                    self.sent += len(lines)
+                elif self.drain_deadline is not None and not self.process_queue.qsize():
+                    # 队列已经空了, 等待中间件确认在途的数据都已经投递
+                    if not chain.flush(max(0.0, self.drain_deadline - time.time())):
+                        self.drained.set()
+                else:
+                    chain.flush()  # 空闲时中间件按时间换分段、收取在途的响应
+                if self.emit_interval > 0 and time.time() - last_emit >= self.emit_interval:
+                    # 自身的运行指标作为 octopus 采集器的数据发送
+                    last_emit = time.time()
+                    points = to_datapoints(gather(), TELEMETRY_METRIC_PREFIX)
+                    chain.send_batch([("octopus", dp) for dp in points])
             except Exception as e:
                 LOG.error(e)
-            sleep(0.01)
@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+
+import time
+
+
+class LoadAvg:
+    """在 octopus 进程内执行, 每 3 秒读取一次系统负载"""
+
+    def collect(self):
+        with open("/proc/loadavg") as f:
+            fields = f.read().split()
+        now = int(time.time())
+        yield ["proc.loadavg.%s %d %s" % (name, now, value)
+               for name, value in zip(("1min", "5min", "15min"), fields)]
@@ -0,0 +1,12 @@
+from octopus.comm.children_collector import ChildrenCollector
+from octopus.comm.collector import Collector
+from octopus.comm.rate_limit import RateLimits
+
+
+def test_removed_collector_releases_its_rate_limit(tmp_path):
+    cc = ChildrenCollector({})
+    cc.rate_limits = RateLimits(max_lines=10)
+    cc.rate_limits.admit("gone.py", ["m 1 1"])
+    cc.register_collector(Collector("gone.py", 15, str(tmp_path / "gone.py"), 0))
+    cc.remove_collector("gone.py")
+    assert "gone.py" not in cc.rate_limits.buckets
@@ -0,0 +1,47 @@
+from octopus.comm.collector import Collector
+from octopus.comm.datapoint import DataPoint, parse_lines
+from octopus.comm.telemetry import collector_stats
+
+
+def test_parse_lines_splits_invalid():
+    points, invalid = parse_lines(["m 1 1 host=a", "garbage", "m 2 2"])
+    assert [dp.value for dp in points] == ["1", "2"]
+    assert invalid == ["garbage"]
+
+
+def test_parse_lines_keeps_invalid_in_order():
+    points, invalid = parse_lines(["bad one", "m 1 1", "m 1 x", "m 2 2"], keep_invalid=True)
+    assert [dp if isinstance(dp, str) else dp.value for dp in points] == ["bad one", "1", "m 1 x", "2"]
+    assert invalid == ["bad one", "m 1 x"]
+
+
+def test_dedup_cache_survives_the_next_run():
+    first = Collector("c", 10, "/bin/true", 0)
+    dp = DataPoint("m", 100, "1", ())
+    assert first.values.filter(dp) == [dp]
+    second = Collector("c", 10, "/bin/true", 0)
+    second.inherit(first)
+    assert second.values.filter(DataPoint("m", 110, "1", ())) == []
+
+
+def test_non_finite_timestamps_and_values_are_invalid():
+    lines = ["m inf 1", "m nan 1", "m 1e400 1", "m 1 inf", "m 1 nan", "m 1 -1e400",
+             '{"metric": "m", "timestamp": 1e400, "value": 1}',
+             '{"metric": "m", "timestamp": 1, "value": NaN}',
+             "m 1.5 2"]
+    points, invalid = parse_lines(lines)
+    assert [str(dp) for dp in points] == ["m 1 2"]
+    assert invalid == lines[:-1]
+
+
+def test_dedup_counters_are_published_per_collector():
+    col = Collector("c", 10, "/bin/true", 0)
+    col.values.max_keys = 1
+    col.values.filter(DataPoint("m", 100, "1", ()))
+    col.values.filter(DataPoint("m", 110, "1", ()))  # hit
+    col.values.filter(DataPoint("n", 110, "1", ()))  # miss, 淘汰 m
+    metrics = {name: value for name, _, _, labels, value in collector_stats({"c": col})()
+               if labels == {"collector": "c"}}
+    assert metrics["octopus_collector_dedup_hits_total"] == 1
+    assert metrics["octopus_collector_dedup_misses_total"] == 2
+    assert metrics["octopus_collector_dedup_evictions_total"] == 1
@@ -0,0 +1,56 @@
+import threading
+from queue import Empty, Full
+
+import pytest
+
+from octopus.comm.fair_queue import DrrBuffer, FairQueue
+
+
+def test_drr_buffer_keeps_everything_beyond_per_collector():
+    buffer = DrrBuffer(quantum=10, per_collector=5)
+    for i in range(8):
+        buffer.push(("a", i))
+    assert buffer.full("a")
+    assert not buffer.full("b")
+    assert [buffer.pop()[1] for _ in range(8)] == list(range(8))
+
+
+def test_drr_buffer_round_robin():
+    buffer = DrrBuffer(quantum=2, per_collector=100)
+    for i in range(4):
+        buffer.push(("a", i))
+    buffer.push(("b", 0))
+    assert [buffer.pop() for _ in range(5)] == [("a", 0), ("a", 1), ("b", 0), ("a", 2), ("a", 3)]
+
+
+def test_fair_queue_refuses_instead_of_dropping():
+    q = FairQueue(maxsize=100, quantum=10, per_collector=3)
+    for i in range(3):
+        q.put(("a", i))
+    with pytest.raises(Full):
+        q.put(("a", 3), block=False)
+    with pytest.raises(Full):
+        q.put(("a", 3), timeout=0.01)
+    # 其他采集器不受影响
+    q.put(("b", 0), block=False)
+    assert q.qsize() == 4
+    got = [q.get(block=False) for _ in range(4)]
+    assert [v for name, v in got if name == "a"] == [0, 1, 2]
+    with pytest.raises(Empty):
+        q.get(block=False)
+
+
+def test_fair_queue_blocked_put_loses_nothing():
+    q = FairQueue(maxsize=10000, quantum=100, per_collector=50)
+    total = 8000
+
+    def produce():
+        for i in range(total):
+            q.put(("a", i))
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    got = [q.get(timeout=5)[1] for _ in range(total)]
+    producer.join(5)
+    assert got == list(range(total))
+    assert q.empty()
@@ -0,0 +1,45 @@
+import os
+import sys
+
+from octopus.comm.fork_server import is_python_collector
+
+
+def script(tmp_path, name, first_line):
+    path = tmp_path / name
+    path.write_text(first_line + "\nprint('m 1 1')\n")
+    return str(path)
+
+
+def test_own_interpreter_runs_in_the_fork_server(tmp_path):
+    assert is_python_collector(script(tmp_path, "a.py", "#!" + sys.executable))
+    assert is_python_collector(script(tmp_path, "a", "#! " + sys.executable))
+
+
+def test_env_resolves_through_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", os.path.dirname(sys.executable))
+    name = os.path.basename(sys.executable)
+    assert is_python_collector(script(tmp_path, "a.py", "#!/usr/bin/env " + name))
+    assert not is_python_collector(script(tmp_path, "b.py", "#!/usr/bin/env -S %s -u" % name))
+
+
+def test_other_interpreters_use_popen(tmp_path):
+    assert not is_python_collector(script(tmp_path, "flags.py", "#!%s -u" % sys.executable))
+    assert not is_python_collector(script(tmp_path, "py2.py", "#!/usr/bin/python2"))
+    assert not is_python_collector(script(tmp_path, "sh.py", "#!/bin/sh"))
+    assert not is_python_collector(script(tmp_path, "none.py", "import os"))
+    assert not is_python_collector(str(tmp_path / "missing.py"))
+
+
+def test_symlink_in_another_directory_is_another_interpreter(tmp_path):
+    # virtualenv 的 python 是符号链接, sys.path 不同
+    venv = tmp_path / "venv" / "bin"
+    venv.mkdir(parents=True)
+    os.symlink(sys.executable, str(venv / "python"))
+    assert not is_python_collector(script(tmp_path, "a.py", "#!%s" % (venv / "python")))
+
+
+def test_allowlist(tmp_path):
+    path = script(tmp_path, "legacy.py", "#!/usr/bin/python2")
+    assert is_python_collector(path, ["legacy.py"])
+    assert is_python_collector(path, [str(tmp_path / "*")])
+    assert not is_python_collector(path, ["other*"])
@@ -0,0 +1,25 @@
+from octopus.comm.line_framer import LineFramer
+
+
+def test_lines_are_split_across_feeds():
+    framer = LineFramer()
+    assert framer.feed(b"a 1 1\nb 2") == ["a 1 1"]
+    assert framer.feed(b" 2\n\n") == ["b 2 2"]
+    assert framer.feed(b"c 3 3") == []
+    assert framer.flush() == ["c 3 3"]
+
+
+def test_max_line_length_counts_bytes():
+    framer = LineFramer(max_line_length=6)
+    # "温度" 是 2 个字符但有 6 个字节
+    assert framer.feed("温度 1\nok 1\n".encode()) == ["ok 1"]
+    assert framer.lines_oversized == 1
+    assert framer.feed("温度".encode()) == []
+    assert framer.feed(b"\n") == ["温度"]
+
+
+def test_oversized_partial_is_discarded_until_newline():
+    framer = LineFramer(max_line_length=4)
+    assert framer.feed(b"abcdef") == []
+    assert framer.feed(b"gh\nok\n") == ["ok"]
+    assert framer.lines_oversized == 1
@@ -0,0 +1,54 @@
+import logging
+import os
+import time
+
+import pytest
+
+from octopus.comm.children_collector import ChildrenCollector
+from octopus.comm.plugin import PluginCollector, PluginRunner
+
+BLOCKING = '''
+import os
+import time
+
+
+class Blocking:
+    def collect(self):
+        while not os.path.exists(%r):
+            time.sleep(0.01)
+        yield "m 1 1"
+'''
+
+
+def test_plugin_stuck_in_a_worker_is_not_resubmitted(tmp_path):
+    gate = tmp_path / "gate"
+    path = tmp_path / "blocking.py"
+    path.write_text(BLOCKING % str(gate))
+    col = PluginCollector("blocking.py", 15, str(path), os.path.getmtime(str(path)))
+    runner = PluginRunner(workers=2)
+
+    first = runner.start(col)
+    first.kill()  # 超时被放弃, 线程还卡在 collect() 里
+    assert first.poll() is not None
+    with pytest.raises(OSError):
+        runner.start(col)
+
+    gate.write_text("")
+    deadline = time.monotonic() + 5
+    while not first.finished and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert first.finished
+    second = runner.start(col)
+    assert second.wait(5) == 0
+    assert second.stdout.read() == b"m 1 1\n"
+    runner.executor.shutdown(wait=True)
+
+
+def test_bytecode_directory_is_skipped_quietly(tmp_path, caplog):
+    plugin_dir = tmp_path / "plugins"
+    (plugin_dir / "15" / "__pycache__").mkdir(parents=True)
+    cc = ChildrenCollector({})
+    cc.plugin_dir = str(plugin_dir)
+    with caplog.at_level(logging.WARNING, logger="octopus"):
+        assert not cc.update_collector(str(plugin_dir), 15, "__pycache__")
+    assert not caplog.records
@@ -0,0 +1,20 @@
+from types import SimpleNamespace
+
+from octopus.comm.collector import Collector
+from octopus.process.process_sender import SenderProcess
+from octopus.process.shm_registry import ShmRegistry
+
+
+def test_removed_collectors_are_pruned_from_delivered_counts():
+    registry = ShmRegistry(capacity=4)
+    try:
+        sender = SenderProcess(SimpleNamespace(shard=None), registry=registry)
+        sender.delivered.update(["kept", "kept", "gone"])
+        sender.prune()  # 还没有发布过, 不释放
+        assert set(sender.delivered) == {"kept", "gone"}
+        registry.publish({"kept": Collector("kept", 10, "/bin/true", 0)})
+        sender.prune()
+        assert sender.delivered_stats() == [("octopus_collector_lines_delivered_total", "counter",
+                                             "items accepted by every middleware", {"collector": "kept"}, 2)]
+    finally:
+        registry.close(unlink=True)
@@ -0,0 +1,71 @@
+import time
+
+from octopus.comm.fair_queue import FairQueue
+from octopus.comm.sender import batch_lag
+from octopus.process.shm_ring import ShmRing
+from octopus.thread.thread_queue import ThreadQueue
+
+
+def test_shm_ring_carries_the_read_time():
+    ring = ShmRing(1 << 16)
+    try:
+        ring.put_batch([("a", "m 1 1", 12.5), ("a", "m 1 2", 12.5)])
+        ring.put_batch([("b", "m 2 1", 13.0)])
+        assert [ring.get(block=False) for _ in range(3)] == \
+            [("a", "m 1 1", 12.5), ("a", "m 1 2", 12.5), ("b", "m 2 1", 13.0)]
+        assert ring.qsize() == 0
+    finally:
+        ring.close(unlink=True)
+
+
+def test_shm_ring_record_wraps_around():
+    ring = ShmRing(256)
+    try:
+        for i in range(50):
+            ring.put_batch([("c", "x" * 40, float(i))])
+            assert ring.get(block=False) == ("c", "x" * 40, float(i))
+    finally:
+        ring.close(unlink=True)
+
+
+def test_thread_queue_stamps_items():
+    q = ThreadQueue()
+    before = time.monotonic()
+    q.put_queue("a", "m 1 1")
+    q.put_queue("a", "m 1 2", read_time=1.0)
+    name, value, stamp = q.get_queue(block=False)
+    assert (name, value) == ("a", "m 1 1") and stamp >= before
+    assert q.get_queue(block=False) == ("a", "m 1 2", 1.0)
+
+
+def test_batch_lag_uses_the_oldest_item():
+    now = time.monotonic()
+    lag = batch_lag([("a", "x", now - 0.5), ("b", "y", now - 2), ("octopus", "z")])
+    assert 2 <= lag < 3
+    assert batch_lag([("octopus", "z")]) is None
+    assert batch_lag([("a", "x", now + 100)]) is None
+
+
+def small_fair_queue(per_collector):
+    q = ThreadQueue()
+    q.queue = FairQueue(10000, 100, per_collector)
+    q.spool = None
+    q.overflow.clear()
+    q.overflow_size = 0
+    return q
+
+
+def test_full_sub_queue_holds_items_without_blocking():
+    q = small_fair_queue(3)
+    assert all(q.put_queue("flood", i) for i in range(3))
+    assert not q.put_queue("flood", 3)
+    assert not q.put_queue("flood", 4)  # 之后的数据排在 overflow 后面
+    assert q.put_queue("quiet", 0)
+    assert q.qsize() == 6
+    assert q.retry() == []
+    got = [q.get_queue(block=False)[:2] for _ in range(4)]
+    assert ("quiet", 0) in got
+    assert q.retry() == ["flood"]
+    while q.qsize():
+        got.append(q.get_queue(block=False)[:2])
+    assert [v for name, v in got if name == "flood"] == [0, 1, 2, 3, 4]
@@ -0,0 +1,103 @@
+import os
+import queue
+import threading
+import time
+from types import SimpleNamespace
+
+from octopus.comm.collector import Collector
+from octopus.comm.collector_selector import CollectorSelector
+from octopus.comm.fair_queue import FairQueue
+from octopus.thread.thread_queue import ThreadQueue
+from octopus.thread.thread_read import ReadThread
+
+
+class Lines(Collector):
+    __slots__ = ("lines",)
+
+    def collect(self):
+        return iter(self.lines)
+
+
+class ListSelector:
+    """每次 select 返回一批采集器, 用完之后一直阻塞"""
+
+    def __init__(self, *batches):
+        self.batches = list(batches)
+
+    def select(self, timeout=None):
+        if self.batches:
+            return self.batches.pop(0)
+        threading.Event().wait()
+
+
+class Items:
+    overflow = {}
+
+    def __init__(self):
+        self.items = queue.Queue()
+
+    def put_queue(self, name, value, read_time=None):
+        self.items.put((name, value))
+        return True
+
+
+def test_one_broken_collector_does_not_stop_the_reader():
+    broken = Lines("broken", 10, "/bin/false", 0)
+    broken.lines = ["m 1 1"]
+    good = Lines("good", 10, "/bin/true", 0)
+    good.lines = ["m 1 2"]
+    items = Items()
+    reader = ReadThread(items, {}, ListSelector([broken], [good]), daemon=True)
+    process_lines = reader.process_lines
+
+    def fail_for_broken(col, lines):
+        if col is broken:
+            raise RuntimeError("bug")
+        process_lines(col, lines)
+
+    reader.process_lines = fail_for_broken
+    reader.start()
+    name, dp = items.items.get(timeout=5)
+    assert name == "good" and str(dp) == "m 1 2"
+
+
+def pipe_collector(selector, name):
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    for fd in (out_r, err_r):
+        os.set_blocking(fd, False)
+    col = Collector(name, 0, "/bin/true", 0)
+    col.proc = SimpleNamespace(pid=len(selector._pending) + 100, stdout=os.fdopen(out_r, "rb", buffering=0),
+                               stderr=os.fdopen(err_r, "rb", buffering=0))
+    selector.add(col)
+    return col, out_w
+
+
+def test_flooding_collector_does_not_delay_others():
+    q = ThreadQueue()
+    q.queue = FairQueue(10000, 100, per_collector=10)
+    q.spool = None
+    selector = CollectorSelector()
+    flood, flood_w = pipe_collector(selector, "flood")
+    quiet, quiet_w = pipe_collector(selector, "quiet")
+    reader = ReadThread(q, {}, selector, daemon=True)
+    reader.start()
+
+    os.write(flood_w, "".join("flood.m %d %d\n" % (i, i) for i in range(100)).encode())
+    deadline = time.monotonic() + 5
+    while not selector._paused and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert selector._paused  # 子队列满了, 只暂停了 flood
+    os.write(quiet_w, b"quiet.m 1 1\n")
+    while "quiet" not in q.queue.buffer.queues and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert "quiet" in q.queue.buffer.queues
+
+    got = []
+    while len(got) < 101 and time.monotonic() < deadline:
+        try:
+            got.append(q.get_queue(timeout=0.1)[:2])
+        except queue.Empty:
+            pass
+    assert [int(dp.value) for name, dp in got if name == "flood"] == list(range(100))
+    assert not selector._paused
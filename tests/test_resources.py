@@ -0,0 +1,30 @@
+import subprocess
+import sys
+import time
+
+from octopus.comm.resources import ResourceUsage, Throttle, read_stat
+
+SPIN = "import time\nend = time.process_time() + 0.5\nwhile time.process_time() < end:\n    pass\n"
+
+
+def test_worker_cpu_counts_as_octopus_cpu():
+    worker = subprocess.Popen([sys.executable, "-c", SPIN + "time.sleep(30)"])
+    try:
+        throttle = Throttle(ResourceUsage(), load_per_cpu=1000, cpu_budget=1, workers=lambda: [worker.pid])
+        start = time.time()
+        throttle.measure(start)
+        while read_stat(worker.pid, children=False)[0] < 0.5:
+            time.sleep(0.05)
+        now = time.time()
+        pressure = throttle.measure(now)
+        assert pressure >= 0.4 / (now - start)
+    finally:
+        worker.kill()
+        worker.wait()
+
+
+def test_restarted_worker_starts_from_zero():
+    throttle = Throttle(ResourceUsage(), workers=lambda: [])
+    throttle.worker_cpu = {1: 1000.0}  # 已经退出的进程
+    assert throttle._workers_cpu() == 0.0
+    assert throttle.worker_cpu == {}
@@ -0,0 +1,68 @@
+from octopus.comm.datapoint import DataPoint
+from octopus.comm.rollup import DDSketch, Rollup, Rule
+
+
+def points(*values, metric="m", start=100):
+    return [DataPoint(metric, start + i, str(value), ("host=a",)) for i, value in enumerate(values)]
+
+
+def emitted(out):
+    return {dp.metric: dp.value for _, dp in out}
+
+
+def test_window_is_emitted_after_grace():
+    rollup = Rollup([Rule(window=60, aggregates=("count", "sum", "min", "max", "last"))], grace=2)
+    assert rollup.add("c", points(1, 5, 3)) == []
+    assert rollup.flush(121) == []  # 窗口 [60, 120) 结束后还在 grace 内
+    out = rollup.flush(122)
+    assert emitted(out) == {"m.count": "3", "m.sum": "9", "m.min": "1", "m.max": "5", "m.last": "3"}
+    assert {dp.timestamp for _, dp in out} == {60}
+    assert {dp.tags for _, dp in out} == {("host=a",)}
+    assert rollup.flush(200) == []
+
+
+def test_new_window_emits_the_previous_one_and_drops_late_points():
+    rollup = Rollup([Rule(window=10, aggregates=("count",))], grace=0)
+    rollup.add("c", points(1, 1, start=100))
+    rollup.add("c", points(1, start=110))
+    assert emitted(rollup.flush(0)) == {"m.count": "2"}
+    late = rollup.late.value
+    rollup.add("c", points(1, start=105))
+    assert rollup.late.value == late + 1
+    assert emitted(rollup.flush(120)) == {"m.count": "1"}
+
+
+def test_quantiles_stay_within_accuracy():
+    rollup = Rollup([Rule(window=1000, aggregates=("p50", "p99"))], grace=0)
+    rollup.add("c", [DataPoint("m", 0, str(v)) for v in range(1, 1001)])
+    out = emitted(rollup.flush(1000))
+    assert abs(float(out["m.p50"]) - 500) <= 500 * 0.02
+    assert abs(float(out["m.p99"]) - 990) <= 990 * 0.02
+
+
+def test_unmatched_points_pass_through():
+    rollup = Rollup([Rule(metric="cpu.*", window=10)])
+    other = points(1, metric="mem")
+    assert rollup.add("c", other) == other
+
+
+def test_non_finite_values_are_dropped():
+    rollup = Rollup([Rule(window=10, aggregates=("count", "sum", "p50"))], grace=0)
+    invalid = rollup.invalid.value
+    rollup.add("c", points("inf", "nan", "-inf", 2, start=100))
+    assert rollup.invalid.value == invalid + 3
+    assert emitted(rollup.flush(110)) == {"m.count": "1", "m.sum": "2", "m.p50": "2"}
+
+
+def test_overflowing_sum_is_formatted():
+    rollup = Rollup([Rule(window=10, aggregates=("sum",))], grace=0)
+    rollup.add("c", points(1e308, 1e308, start=100))
+    assert emitted(rollup.flush(110)) == {"m.sum": "inf"}
+
+
+def test_sketch_merges_smallest_bins():
+    sketch = DDSketch(0.01, max_bins=8)
+    for v in range(1, 10000):
+        sketch.add(v)
+    assert len(sketch.positive) <= 8
+    assert abs(sketch.quantile(1.0) - 9999) <= 9999 * 0.02
@@ -0,0 +1,88 @@
+import fcntl
+import multiprocessing
+import os
+import time
+
+from octopus.comm.sender import MiddlewareChain
+from octopus.middlewares import send_file
+from octopus.middlewares.send_file import SendFileMiddleware, compress_segment, replay
+
+
+def segments(directory, suffix=".log"):
+    return sorted(name for name in os.listdir(directory) if name.endswith(suffix))
+
+
+def test_idle_chain_flush_rotates_by_time(tmp_path):
+    sink = SendFileMiddleware(tmp_path, segment_seconds=0.05, compression=None)
+    chain = MiddlewareChain({})
+    chain.add(sink)
+    chain.send_batch([("c", "m 1 1")])
+    assert sink.fd is not None
+    chain.flush()
+    assert sink.fd is not None  # 还没有到时间
+    time.sleep(0.06)
+    chain.flush()
+    assert sink.fd is None
+    assert list(replay(tmp_path)) == ["m 1 1"]
+    sink.close()
+
+
+def test_rotated_segment_is_compressed(tmp_path):
+    sink = SendFileMiddleware(tmp_path, segment_seconds=0.01, compression="gzip")
+    sink.send_batch(["m 1 1", "m 1 2"])
+    time.sleep(0.02)
+    sink.flush(timeout=0)
+    sink.close()
+    assert segments(tmp_path) == []
+    assert len(segments(tmp_path, ".gz")) == 1
+    assert list(replay(tmp_path)) == ["m 1 1", "m 1 2"]
+
+
+def test_segment_compressed_during_replay_is_read_from_the_compressed_file(tmp_path, monkeypatch):
+    sink = SendFileMiddleware(tmp_path, segment_seconds=0.01, compression=None)
+    sink.send_batch(["m 1 1", "m 1 2"])
+    time.sleep(0.02)
+    sink.flush(timeout=0)
+    sink.close()
+    [name] = segments(tmp_path)
+    read_index = send_file.read_index
+
+    def compress_after_listing(path):
+        entries = read_index(path)
+        if path.endswith(".log.idx"):
+            compress_segment(path[:-len(".idx")], "gzip")  # 压缩线程刚好在列目录之后压缩完
+        return entries
+
+    monkeypatch.setattr(send_file, "read_index", compress_after_listing)
+    assert list(replay(tmp_path)) == ["m 1 1", "m 1 2"]
+    assert segments(tmp_path, ".gz") == [name + ".gz"]
+
+
+def write_segment(directory, pid, lines):
+    path = os.path.join(str(directory), "octopus-%d-1000.log" % pid)
+    with open(path, "w") as f:
+        f.write("".join(line + "\n" for line in lines))
+    return path
+
+
+def test_locked_segment_is_left_to_its_owner(tmp_path):
+    path = write_segment(tmp_path, 99999999, ["m 1 1"])
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        assert compress_segment(path, "gzip") is None
+        assert os.path.exists(path)
+    finally:
+        os.close(fd)
+    assert compress_segment(path, "gzip") == path + ".gz"
+    assert compress_segment(path, "gzip") is None
+
+
+def test_concurrent_recovery_compresses_once(tmp_path):
+    lines = ["m %d %d" % (i, i) for i in range(20000)]
+    path = write_segment(tmp_path, 99999999, lines)
+    with multiprocessing.get_context("fork").Pool(4) as pool:
+        results = pool.starmap(compress_segment, [(path, "gzip")] * 8)
+    assert [r for r in results if r is not None] == [path + ".gz"]
+    assert sorted(os.listdir(tmp_path)) == ["octopus-99999999-1000.log.gz", "octopus-99999999-1000.log.gz.idx"]
+    assert list(replay(tmp_path)) == lines
@@ -0,0 +1,95 @@
+import pytest
+
+from octopus.middlewares.kafka_producer import MemoryProducer, create_producer
+from octopus.middlewares.send_kafka import KafkaDeliveryError, SendKafkaMiddleware
+
+
+class TrackingProducer(MemoryProducer):
+    """记录还没有触发投递回调的消息数量的最大值"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.max_pending = 0
+
+    def produce(self, topic, value, key=None, on_delivery=None):
+        super().produce(topic, value, key=key, on_delivery=on_delivery)
+        self.max_pending = max(self.max_pending, len(self._callbacks))
+
+
+def messages(producer, topic="octopus"):
+    return [(key, value) for (t, _), items in sorted(producer.partitions.items()) if t == topic
+            for key, value in items]
+
+
+def test_batch_is_keyed_by_collector():
+    producer = MemoryProducer()
+    sink = SendKafkaMiddleware(producer=producer)
+    sink.send_batch(["a 1 1", "b 1 1", "a 1 2"], collectors=["ca", "cb", "ca"])
+    assert sorted(messages(producer)) == [(b"ca", b"a 1 1\na 1 2"), (b"cb", b"b 1 1")]
+    assert sink.messages_delivered == 2
+    # 同一个采集器的数据总是在同一个分区
+    sink.send_batch(["a 1 3"], collectors=["ca"])
+    partition = producer.partition_for(b"ca")
+    assert [key for key, _ in producer.partitions[("octopus", partition)]].count(b"ca") == 2
+
+
+def test_without_collectors_sends_one_unkeyed_message():
+    producer = MemoryProducer()
+    SendKafkaMiddleware(producer=producer).send_batch(["a 1 1", "b 1 1"])
+    assert messages(producer) == [(None, b"a 1 1\nb 1 1")]
+
+
+def test_in_flight_is_bounded():
+    producer = TrackingProducer()
+    sink = SendKafkaMiddleware(producer=producer, max_in_flight=3)
+    lines = ["m 1 %d" % i for i in range(20)]
+    sink.send_batch(lines, collectors=["c%d" % i for i in range(20)])
+    assert producer.max_pending == 3
+    assert sink.messages_delivered == 20
+
+
+def test_delivery_failure_is_counted_and_frees_the_slot():
+    producer = MemoryProducer(fail=lambda topic, value: RuntimeError("broker down")
+                              if value.startswith(b"bad") else None)
+    sink = SendKafkaMiddleware(producer=producer, max_in_flight=1)
+    sink.send_batch(["bad 1 1", "good 1 1", "bad 1 2"], collectors=["c1", "c2", "c3"])
+    assert sink.messages_failed == 2
+    assert sink.messages_delivered == 1
+    assert messages(producer) == [(b"c2", b"good 1 1")]
+    assert len(sink.failed) == 2
+
+
+def test_failed_messages_are_resent_before_the_next_batch():
+    down = [True]
+    producer = MemoryProducer(fail=lambda topic, value: RuntimeError("broker down") if down[0] else None)
+    sink = SendKafkaMiddleware(producer=producer)
+    sink.send_batch(["m 1 1"], collectors=["c1"])
+    producer.poll()
+    assert sink.flush(0) == 1  # 重新发送之后又失败了
+    down[0] = False
+    # 下一批之前先重新发送, 抛出异常让发送端退避后重试这一批, 这一批不会被 ack
+    with pytest.raises(KafkaDeliveryError):
+        sink.send_batch(["m 1 2"], collectors=["c1"])
+    producer.poll()
+    sink.send_batch(["m 1 2"], collectors=["c1"])
+    assert sink.flush(0) == 0
+    assert messages(producer) == [(b"c1", b"m 1 1"), (b"c1", b"m 1 2")]
+    stats = {name: value for name, _, _, _, value in sink.stats()}
+    assert stats["octopus_kafka_messages_failed_total"] == 2
+    assert stats["octopus_kafka_messages_delivered_total"] == 2
+
+
+def test_close_flushes_pending_deliveries():
+    producer = MemoryProducer()
+    sink = SendKafkaMiddleware(producer=producer)
+    producer.produce("octopus", b"x", on_delivery=sink._on_delivery)
+    sink.in_flight.acquire()
+    sink.close()
+    assert sink.messages_delivered == 1
+    assert not producer._callbacks
+
+
+def test_create_memory_producer_with_compression():
+    producer = create_producer("memory", "localhost:9092", "gzip")
+    producer.produce("t", b"m 1 1\n" * 100)
+    assert producer.bytes_compressed < producer.bytes_in
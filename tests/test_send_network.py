@@ -0,0 +1,185 @@
+import json
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from octopus.middlewares.send_network import SendHttpMiddleware, SendTsdbMiddleware, SinkError
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 长连接, 同一个连接上可以连续收到多个请求
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        with server.lock:
+            status = server.statuses.pop(0) if server.statuses else 200
+            server.requests.append((self.client_address, status, json.loads(body)))
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TsdbHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            with self.server.lock:
+                self.server.lines.append(line.decode().strip())
+
+
+def serve(server):
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def http_server():
+    servers = []
+
+    def start(statuses=()):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        server.statuses = list(statuses)
+        server.requests = []
+        servers.append(serve(server))
+        return server, "http://127.0.0.1:%d/api/put" % server.server_address[1]
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return "http://127.0.0.1:%d/api/put" % port
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def batch(i):
+    return ["m %d %d host=a" % (1000 + i, i)]
+
+
+def test_http_pipelines_on_one_connection(http_server):
+    server, url = http_server()
+    sink = SendHttpMiddleware([url], pool_size=1, pipeline=4)
+    sink.send_batch(batch(0))
+    conn = sink.endpoints[0].connections[0]
+    # 不等响应就返回
+    assert list(conn.inflight) == [batch(0)]
+    for i in range(1, 10):
+        sink.send_batch(batch(i))
+        assert len(conn.inflight) < 4
+    sink.flush()
+    assert not conn.inflight
+    assert sorted(body[0]["value"] for _, _, body in server.requests) == list(range(10))
+    assert len({address for address, _, _ in server.requests}) == 1
+    sink.close()
+
+
+def test_http_server_error_fails_over_to_next_endpoint(http_server):
+    first, first_url = http_server(statuses=[503])
+    second, second_url = http_server()
+    sink = SendHttpMiddleware([first_url, second_url], pipeline=1, backoff_base=10)
+    sink.send_batch(batch(1))
+    sink.flush()
+    assert [status for _, status, _ in first.requests] == [503]
+    assert [body[0]["value"] for _, _, body in second.requests] == [1]
+    assert sink.batches_retried == 1
+    assert sink.endpoints[0].retry_at > time.monotonic()
+    # 第一个节点退避期间后面的批次直接发给第二个节点
+    sink.send_batch(batch(2))
+    sink.flush()
+    assert len(first.requests) == 1
+    assert [body[0]["value"] for _, _, body in second.requests] == [1, 2]
+    sink.close()
+
+
+def test_http_unreachable_endpoint_is_skipped(http_server):
+    server, url = http_server()
+    sink = SendHttpMiddleware([closed_port(), url], pipeline=1)
+    sink.send_batch(batch(1))
+    sink.flush()
+    assert [body[0]["value"] for _, _, body in server.requests] == [1]
+    assert sink.batches_retried == 0
+    assert sink.endpoints[0].failures == 1
+    sink.close()
+
+
+def test_all_endpoints_backing_off_fails_fast():
+    sink = SendHttpMiddleware([closed_port(), closed_port()], pipeline=1,
+                              backoff_base=30, backoff_max=30)
+    start = time.monotonic()
+    with pytest.raises(SinkError):
+        sink.send_batch(batch(1))
+    # 不会在 _acquire 里等待退避结束
+    assert time.monotonic() - start < 1
+    assert sink.batches_failed == 1
+    assert not sink.deferred
+    with pytest.raises(SinkError, match="backing off"):
+        sink.send_batch(batch(2))
+    sink.close()
+
+
+def test_failed_earlier_batch_is_deferred_to_the_next_call(http_server):
+    server, url = http_server(statuses=[503])
+    sink = SendHttpMiddleware([url], pool_size=1, pipeline=4, backoff_base=30, backoff_max=30)
+    sink.send_batch(batch(1))
+    wait_for(lambda: server.requests)
+    time.sleep(0.1)  # 503 已经到达, 下一次调用时读取
+    # 这一次的批次已经发出, 只有流水线上之前的批次失败, 不抛出异常
+    sink.send_batch(batch(2))
+    assert list(sink.deferred) == [batch(1)]
+    sink.endpoints[0].succeed()
+    sink.send_batch(batch(3))
+    sink.flush()
+    assert not sink.deferred
+    assert [(status, body[0]["value"]) for _, status, body in server.requests] == \
+        [(503, 1), (200, 2), (200, 1), (200, 3)]
+    sink.close()
+
+
+def test_http_client_error_drops_only_that_batch(http_server):
+    server, url = http_server(statuses=[400])
+    sink = SendHttpMiddleware([url], pipeline=1)
+    sink.send_batch(batch(1))
+    sink.send_batch(batch(2))
+    sink.flush()
+    assert [status for _, status, _ in server.requests] == [400, 200]
+    assert sink.batches_failed == 1
+    assert sink.batches_retried == 0
+    sink.close()
+
+
+def test_tsdb_put_lines():
+    server = serve(socketserver.ThreadingTCPServer(("127.0.0.1", 0), TsdbHandler))
+    server.daemon_threads = True
+    server.lines = []
+    try:
+        sink = SendTsdbMiddleware(["127.0.0.1:%d" % server.server_address[1]])
+        sink.send_batch(["m 1 1 host=a", "m 2 2 host=a"])
+        sink.send_batch(["m 3 3 host=a"])
+        wait_for(lambda: len(server.lines) == 3)
+        assert server.lines == ["put m 1 1 host=a", "put m 2 2 host=a", "put m 3 3 host=a"]
+        sink.close()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,121 @@
+import asyncio
+import queue
+import time
+
+import pytest
+
+from octopus.comm import sender
+from octopus.comm.sender import MiddlewareChain
+from octopus.thread import thread_sender
+
+
+class Recorder:
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.lines = []
+
+    def send_batch(self, lines, collectors=None):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("sink down")
+        self.lines.extend(lines)
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(sender, "SENDER_RETRY_BACKOFF", 0.001)
+    monkeypatch.setattr(sender, "SENDER_RETRY_BACKOFF_MAX", 0.002)
+
+
+def make_chain(*middlewares):
+    chain = MiddlewareChain({})
+    for obj in middlewares:
+        chain.add(obj)
+    return chain
+
+
+def test_send_batch_reports_failed_middlewares():
+    ok, broken = Recorder(), Recorder(failures=1)
+    chain = make_chain(ok, broken)
+    assert chain.send_batch([("a", "m 1 1")]) == [broken]
+    assert chain.send_batch([("a", "m 1 2")]) == []
+    assert ok.lines == ["m 1 1", "m 1 2"]
+    assert broken.lines == ["m 1 2"]
+
+
+def test_deliver_retries_only_failed_middlewares():
+    ok, flaky = Recorder(), Recorder(failures=3)
+    chain = make_chain(ok, flaky)
+    chain.deliver([("a", "m 1 1"), ("b", "m 1 2")])
+    assert ok.lines == ["m 1 1", "m 1 2"]
+    assert flaky.lines == ["m 1 1", "m 1 2"]
+
+
+def test_deliver_async_retries():
+    flaky = Recorder(failures=2)
+    chain = make_chain(flaky)
+    asyncio.run(chain.deliver_async([("a", "m 1 1")]))
+    assert flaky.lines == ["m 1 1"]
+
+
+class Buffered(Recorder):
+    """send_batch 只是放进缓冲区, flush 之后才算投递"""
+
+    def __init__(self):
+        super().__init__()
+        self.buffer = []
+
+    def send_batch(self, lines, collectors=None):
+        self.buffer.extend(lines)
+
+    def flush(self, timeout=None):
+        if timeout:
+            self.lines.extend(self.buffer)
+            self.buffer = []
+        return len(self.buffer)
+
+
+class Broken:
+
+    def flush(self, timeout=None):
+        raise ConnectionError("sink down")
+
+
+def test_flush_reports_undelivered_items():
+    buffered = Buffered()
+    chain = make_chain(buffered, Recorder())
+    chain.send_batch([("a", "m 1 1"), ("a", "m 1 2")])
+    assert chain.flush() == 2
+    assert chain.flush(1) == 0
+    assert buffered.lines == ["m 1 1", "m 1 2"]
+    assert make_chain(Broken()).flush(1) == 1
+
+
+class ListQueue(queue.Queue):
+    spool = None
+
+    def put_queue(self, name, value):
+        self.put((name, value, time.monotonic()))
+
+    def get_queue(self, block=True, timeout=None):
+        return self.get(block=block, timeout=timeout)
+
+    def ack(self):
+        pass
+
+
+def test_drain_waits_for_middleware_acks(monkeypatch):
+    buffered = Buffered()
+    chain = make_chain(buffered)
+    monkeypatch.setattr(thread_sender, "MiddlewareChain", lambda: chain)
+    monkeypatch.setattr(thread_sender, "SENDER_FLUSH_INTERVAL", 0.01)
+    items = ListQueue()
+    for i in range(3):
+        items.put_queue("a", "m 1 %d" % i)
+    sender_thread = thread_sender.SenderThread(items, daemon=True)
+    sender_thread.emit_interval = 0
+    sender_thread.start()
+    assert sender_thread.drain(5)
+    assert not items.qsize()
+    assert buffered.lines == ["m 1 0", "m 1 1", "m 1 2"]
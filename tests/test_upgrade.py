@@ -0,0 +1,26 @@
+import os
+import subprocess
+
+from octopus.comm.upgrade import AdoptedProcess
+
+
+def adopted(proc):
+    return AdoptedProcess(proc.pid, os.pidfd_open(proc.pid), None, None)
+
+
+def test_exit_status_of_an_unreaped_collector():
+    proc = subprocess.Popen(["sh", "-c", "exit 13"])
+    try:
+        col_proc = adopted(proc)
+        assert col_proc.wait(5) == 13
+        assert col_proc.status_known
+    finally:
+        proc.wait()
+
+
+def test_reaped_collector_is_treated_as_exit_0():
+    proc = subprocess.Popen(["sh", "-c", "exit 13"])
+    col_proc = adopted(proc)
+    proc.wait()  # 被别的进程回收, 拿不到退出码
+    assert col_proc.wait(5) == 0
+    assert not col_proc.status_known